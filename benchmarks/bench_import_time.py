@@ -0,0 +1,139 @@
+"""Measure cold-start import time of each service's entry module.
+
+Runs `python -X importtime -c "import main"` in a fresh interpreter per service and
+reports the total import time plus the slowest modules, so regressions show up release
+over release.
+
+    python benchmarks/bench_import_time.py                  # against the installed SDKs
+    python benchmarks/bench_import_time.py --stub-sdks      # no GCP SDKs needed
+    python benchmarks/bench_import_time.py --stub-sdks --stub-delay-ms 300 --json
+
+With --stub-sdks every GCP SDK (and cv2) is replaced by an empty stub that sleeps
+--stub-delay-ms on import, which makes any eager import of a heavy SDK visible
+without installing it.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+SERVICES = {
+    "digestion": "services_data-digestion-engine_1753589831.471000",
+    "gmail": "services_gmail-extract-engine_1753592359.317000",
+    "predictor": "services_ml-predictor-engine_1753592235.289000",
+    "insights": "insights-engine_function-source",
+}
+
+# module -> source of the stub; "{delay}" is replaced with the simulated import cost
+_SLEEP = "import time as _t\n_t.sleep({delay})\n"
+_CLIENT = "class Client:\n    def __init__(self, *args, **kwargs):\n        pass\n"
+STUBS = {
+    "functions_framework": "def cloud_event(fn):\n    return fn\n\ndef http(fn):\n    return fn\n",
+    "google/cloud/storage": _SLEEP + _CLIENT,
+    "google/cloud/firestore": _SLEEP + _CLIENT,
+    "google/cloud/bigquery": _SLEEP + _CLIENT,
+    "google/api_core/exceptions": "class NotFound(Exception):\n    pass\n\nclass PreconditionFailed(Exception):\n    pass\n",
+    "vertexai": _SLEEP + "def init(**kwargs):\n    pass\n",
+    "vertexai/preview": "",
+    "vertexai/preview/generative_models": "class GenerativeModel:\n    def __init__(self, *args, **kwargs):\n        pass\n\n"
+                                          "class Part:\n    @staticmethod\n    def from_data(data, mime_type):\n        return data\n",
+    "cv2": _SLEEP,
+    "googleapiclient": _SLEEP,
+    "googleapiclient/discovery": "def build(*args, **kwargs):\n    return None\n",
+    "googleapiclient/errors": "class HttpError(Exception):\n    pass\n",
+    "google/oauth2/credentials": _SLEEP + "class Credentials:\n    pass\n",
+    "google_auth_oauthlib": _SLEEP,
+    "google_auth_oauthlib/flow": "class InstalledAppFlow:\n    pass\n",
+    "google/auth/transport/requests": "class Request:\n    pass\n",
+}
+
+REGULAR_PACKAGES = ("google/api_core", "google/oauth2", "google/auth", "google/auth/transport")
+
+
+def write_stubs(directory, delay_ms):
+    for module, source in STUBS.items():
+        package = os.path.join(directory, module)
+        os.makedirs(package, exist_ok=True)
+        with open(os.path.join(package, "__init__.py"), "w") as f:
+            f.write(source.format(delay=delay_ms / 1000))
+    # google and google.cloud stay namespace packages (no __init__), matching the real SDK layout
+    for package in REGULAR_PACKAGES:
+        open(os.path.join(directory, package, "__init__.py"), "a").close()
+
+
+def import_profile(service_dir, stub_dir=None):
+    env = dict(os.environ)
+    paths = [service_dir] + ([stub_dir] if stub_dir else [])
+    env["PYTHONPATH"] = os.pathsep.join(paths)
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=service_dir, env=env, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"import main failed in {service_dir}:\n{proc.stderr[-2000:]}")
+
+    # Children are listed before their parent, so keep only the subtree that ends at "main"
+    modules = []
+    main_entry = None
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, raw_name = line[len("import time:"):].split("|")
+        name = raw_name.strip()
+        entry = (name, int(self_us), int(cumulative_us))
+        if len(raw_name) - len(raw_name.lstrip()) <= 2:  # top-level import
+            if name == "main":
+                main_entry = entry
+                break
+            modules = []
+            continue
+        modules.append(entry)
+    return {
+        "total_ms": main_entry[2] / 1000 if main_entry else 0.0,
+        "top": sorted(modules, key=lambda m: m[2], reverse=True),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stub-sdks", action="store_true", help="replace GCP SDKs and cv2 with stubs")
+    parser.add_argument("--stub-delay-ms", type=float, default=200.0, help="simulated import cost per stubbed SDK")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--top", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    parser.add_argument("services", nargs="*", help=f"any of {', '.join(SERVICES)} (default: all)")
+    args = parser.parse_args()
+    services = args.services or list(SERVICES)
+    unknown = set(services) - set(SERVICES)
+    if unknown:
+        parser.error(f"unknown service(s): {', '.join(sorted(unknown))}")
+
+    with tempfile.TemporaryDirectory() as stub_dir:
+        if args.stub_sdks:
+            write_stubs(stub_dir, args.stub_delay_ms)
+        results = {}
+        for name in services:
+            runs = [import_profile(os.path.join(ROOT, SERVICES[name]), stub_dir if args.stub_sdks else None)
+                    for _ in range(args.repeat)]
+            results[name] = {
+                "median_ms": round(statistics.median(r["total_ms"] for r in runs), 1),
+                "min_ms": round(min(r["total_ms"] for r in runs), 1),
+                "top_modules": [(m[0], round(m[2] / 1000, 1)) for m in runs[-1]["top"]
+                                if m[0] != "main"][:args.top],
+            }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for name, r in results.items():
+        print(f"{name:<10} median {r['median_ms']:>8.1f} ms   min {r['min_ms']:>8.1f} ms")
+        for module, ms in r["top_modules"]:
+            print(f"    {module:<50} {ms:>8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,460 @@
+"""End-to-end pipeline benchmark against in-memory backends.
+
+Drives gmail_push -> process_receipt -> enrich_and_push -> run_insights / run_all_predictions
+with every external service replaced by the fakes in benchmarks/fakes.py. The synthetic corpus
+has PDFs, PNG images and MP4 clips uploaded straight to the bucket, plus HTML emails that arrive
+through Gmail. Each bucket write fires process_receipt on a worker pool, as the GCS trigger would.
+The benchmark reports receipts/sec, p50/p99 per-receipt latency, time per pipeline stage and
+calls/time per backend operation.
+
+    python benchmarks/bench_pipeline.py [--receipts 200] [--concurrency 16] [--json]
+    python benchmarks/bench_pipeline.py --gemini-latency-ms 800 --gemini-error-rate 0.05 --gemini-rate 20
+    python benchmarks/bench_pipeline.py --templates   # emails parsed by a registered merchant template
+    python benchmarks/bench_pipeline.py --attach-rate 0.5   # half the PDFs/images arrive as mail attachments
+
+Latency and error rates can be set per backend (--{gcs,firestore,bq,gmail,gemini}-latency-ms,
+-jitter-ms, -error-rate). Nothing leaves the machine: Gemini answers come from the digestion
+engine's fake model.
+"""
+import argparse
+import atexit
+import base64
+import contextlib
+import importlib
+import io
+import json
+import os
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+SERVICES = {
+    "digestion": "services_data-digestion-engine_1753589831.471000",
+    "gmail": "services_gmail-extract-engine_1753592359.317000",
+    "predictor": "services_ml-predictor-engine_1753592235.289000",
+    "insights": "insights-engine_function-source",
+}
+BACKENDS = ("gcs", "firestore", "bq", "gmail", "gemini")
+KINDS = ("pdf", "image", "video", "email")
+SHARED_MODULES = ("main", "clients", "tracing")  # present in every service dir
+MERCHANTS = ["Corner Cafe", "FreshMart", "City Pharmacy", "Metro Fuel", "Book Nook"]
+ITEMS = ["Tea", "Coffee", "Bread", "Milk", "Paracetamol", "Diesel", "Notebook", "Rice 5kg"]
+
+import fakes  # noqa: E402
+from bench_video_frames import receipt_canvas, write_clip  # noqa: E402
+
+
+def load_service(name):
+    # Every service has its own `main`, `clients` and `tracing`; import them in isolation and keep the
+    # module objects. The other module names are unique, so all service dirs stay on sys.path.
+    path = os.path.join(ROOT, SERVICES[name])
+    if path not in sys.path:
+        sys.path.append(path)
+    sys.path.insert(0, path)
+    for module in SHARED_MODULES:
+        sys.modules.pop(module, None)
+    try:
+        main = importlib.import_module("main")
+        return main, sys.modules["clients"]
+    finally:
+        sys.path.remove(path)
+        for module in SHARED_MODULES:
+            sys.modules.pop(module, None)
+
+
+# ---------- Corpus ----------
+
+def receipt_lines(rng, n):
+    items = [(ITEMS[rng.integers(len(ITEMS))], int(rng.integers(1, 4)), round(float(rng.uniform(1, 60)), 2))
+             for _ in range(rng.integers(1, 8))]
+    return [MERCHANTS[n % len(MERCHANTS)], f"{rng.integers(1, 13):02d}-{rng.integers(1, 29):02d}-2025",
+            f"INV-{n:06d}"] + [f"{name} x{qty} {price:.2f}" for name, qty, price in items] + [
+            f"TOTAL {sum(price for _, _, price in items):.2f}"]
+
+
+def make_pdf(lines):
+    # Smallest valid-looking PDF carrying the receipt text; the fake model only hashes the bytes
+    text = " ".join(f"({line}) Tj T*" for line in lines)
+    return (f"%PDF-1.4\n1 0 obj << /Type /Catalog /Pages 2 0 R >> endobj\n"
+            f"4 0 obj << /Length {len(text)} >> stream\nBT {text} ET\nendstream endobj\n%%EOF\n").encode()
+
+
+def make_image(lines, rng):
+    canvas = receipt_canvas(480, 640, rng)
+    cv2.putText(canvas, lines[2], (170, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1)
+    return cv2.imencode(".png", canvas)[1].tobytes()
+
+
+def make_video(rng, seconds):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "clip.mp4")
+        write_clip(path, seconds, 15, (320, 240), rng)
+        with open(path, "rb") as f:
+            return f.read()
+
+
+def make_email(lines):
+    rows = "".join(f"<tr><td>{line}</td></tr>" for line in lines)
+    return (f"<html><head><style>td {{ padding: 4px; font-family: Arial; }}</style></head>"
+            f"<body><h2>Thanks for shopping at {lines[0]}</h2><table>{rows}</table></body></html>")
+
+
+def email_template(sample):
+    # What a maintainer would register for the corpus emails' layout (see templates.py)
+    templates = sys.modules["templates"]
+    return {"template_id": "bench-email", "sender_domain": "example.com", "fingerprint": templates.fingerprint(sample),
+            "fields": {"merchant": r"^Thanks for shopping at (?P<value>.+)$", "date": r"^(?P<value>\d{2}-\d{2}-\d{4})$",
+                       "receipt_id": r"^(?P<value>INV-\d+)$", "total": r"^TOTAL (?P<value>[\d.]+)$"},
+            "date_format": "%m-%d-%Y", "item_pattern": r"^(?P<name>.+?) x(?P<qty>\d+) (?P<price>[\d.]+)$"}
+
+
+def build_corpus(receipts, mix, duplicate_rate, video_seconds, seed=7):
+    # Returns [(kind, name, payload)]; duplicates repeat an earlier payload under a new name
+    rng = np.random.default_rng(seed)
+    weights = np.array([mix[k] for k in KINDS], dtype=float)
+    kinds = rng.choice(KINDS, size=receipts, p=weights / weights.sum())
+    videos = []  # clips are slow to encode, so a handful is reused with a per-upload trailer
+    corpus = []
+    for n, kind in enumerate(kinds):
+        if corpus and rng.random() < duplicate_rate:
+            prev_kind, _, payload = corpus[rng.integers(len(corpus))]
+            kind = prev_kind
+        elif kind == "video":
+            if len(videos) < 4:
+                videos.append(make_video(rng, video_seconds))
+            payload = videos[n % len(videos)] + f"\0{n}".encode()
+        else:
+            lines = receipt_lines(rng, n)
+            payload = {"pdf": lambda: make_pdf(lines), "image": lambda: make_image(lines, rng),
+                       "email": lambda: make_email(lines)}[kind]()
+        ext = {"pdf": "pdf", "image": "png", "video": "mp4", "email": "html"}[kind]
+        corpus.append((kind, f"uploads/receipt-{n:05d}.{ext}", payload))
+    return corpus
+
+
+# ---------- Warehouse ----------
+
+class Warehouse:
+    # Answers the insights and predictor SQL from the rows the pipeline streamed into FakeBigQuery,
+    # touching only rows past each job's watermark, like the incremental SQL does
+    def __init__(self, bq, digestion, enrich, insights, predictor):
+        self.bq = bq
+        self.raw_table = digestion.RAW_RECEIPTS_TABLE
+        self.enriched_table = enrich.ENRICHED_TABLE
+        self.monthly_table = insights.MONTHLY_AGG_TABLE
+        self.merchant_table = insights.MERCHANT_AGG_TABLE
+        self.lock = threading.Lock()
+        self.raw_seen = None
+        self.monthly = defaultdict(lambda: [0.0, 0])
+        self.merchants = defaultdict(lambda: [0.0, 0])
+        self.predicted = defaultdict(set)
+        self.enriched_seen = defaultdict(int)
+        bq.on_query(insights.WATERMARK_TABLE, self.refresh_aggregates)
+        bq.on_query(f"FROM `{self.monthly_table}`", self.monthly_rows)
+        bq.on_query(f"FROM `{self.merchant_table}`", self.merchant_rows)
+        bq.on_query(f"MERGE `{predictor.PREDICTION_TABLE}`", self.receipt_predictions)
+        bq.on_query(predictor.WATERMARK_TABLE, self.user_predictions)
+
+    def refresh_aggregates(self, sql, bq):
+        with self.lock:
+            full = self.raw_seen is None or "SET full_recompute = TRUE" in sql
+            rows = bq.tables[self.raw_table]
+            delta = rows if full else rows[self.raw_seen:]
+            if full:
+                self.monthly.clear()
+                self.merchants.clear()
+            for row in delta:
+                total = row.get("total") or 0.0
+                if row.get("date"):
+                    entry = self.monthly[(row.get("category"), row["date"][:7])]
+                    entry[0] += total
+                    entry[1] += 1
+                entry = self.merchants[row.get("merchant")]
+                entry[0] += total
+                entry[1] += 1 if row.get("receipt_id") else 0
+            self.raw_seen = len(rows)
+            if delta:
+                bq.touch(self.monthly_table)
+                bq.touch(self.merchant_table)
+        return fakes.FakeQueryJob(rows=[{"full_recompute": full, "new_rows": len(delta), "pending_rows": 0}],
+                                  total_bytes_billed=len(delta) * 256)
+
+    def monthly_rows(self, sql, bq):
+        with self.lock:
+            rows = [{"category": c, "month": m, "total_spend": round(s, 2)} for (c, m), (s, _) in self.monthly.items()]
+        return fakes.FakeQueryJob(rows=sorted(rows, key=lambda r: (r["month"], r["total_spend"]), reverse=True))
+
+    def merchant_rows(self, sql, bq):
+        with self.lock:
+            rows = [{"merchant": m, "txn_count": n, "total_spend": round(s, 2)} for m, (s, n) in self.merchants.items()]
+        limit = int(re.search(r"LIMIT (\d+)", sql).group(1))
+        return fakes.FakeQueryJob(rows=sorted(rows, key=lambda r: r["total_spend"], reverse=True)[:limit])
+
+    def receipt_predictions(self, sql, bq):
+        model_type = re.search(r"'(\w+)' AS model_type", sql).group(1)
+        with self.lock:
+            fresh = {row["receipt_id"] for row in bq.tables[self.enriched_table] if row.get("receipt_id")}
+            fresh -= self.predicted[model_type]
+            self.predicted[model_type] |= fresh
+        return fakes.FakeQueryJob(num_dml_affected_rows=len(fresh), total_bytes_billed=len(fresh) * 64)
+
+    def user_predictions(self, sql, bq):
+        model_type = re.search(r"model_type = '(\w+)'", sql).group(1)
+        with self.lock:
+            rows = bq.tables[self.enriched_table]
+            users = {row.get("user_id") or "" for row in rows[self.enriched_seen[model_type]:]}
+            self.enriched_seen[model_type] = len(rows)
+        insert = fakes.FakeQueryJob(num_dml_affected_rows=len(users), statement_type="INSERT")
+        return fakes.FakeQueryJob(children=[insert], total_bytes_billed=len(users) * 512)
+
+
+# ---------- Run ----------
+
+class StageTimer:
+    def __init__(self):
+        self.seconds = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.seconds[stage].append(seconds)
+
+    def wrap(self, module, attr, stage):
+        fn = getattr(module, attr)
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - started)
+        setattr(module, attr, timed)
+
+    def summary(self):
+        with self.lock:
+            return {stage: {"calls": len(s), "total_s": round(sum(s), 3), "mean_ms": round(statistics.mean(s) * 1000, 2),
+                            "max_ms": round(max(s) * 1000, 2)} for stage, s in self.seconds.items()}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, len(values) * p // 100)] if values else None
+
+
+def faults(args, backend, error):
+    return fakes.Faults(latency_ms=getattr(args, f"{backend}_latency_ms"), jitter_ms=getattr(args, f"{backend}_jitter_ms"),
+                        error_rate=getattr(args, f"{backend}_error_rate"), error=error, seed=hash(backend) & 0xffff)
+
+
+def pubsub_envelope(history_id):
+    data = json.dumps({"emailAddress": "me@example.com", "historyId": history_id})
+    return SimpleNamespace(get_json=lambda force=False: {"message": {"data": base64.b64encode(data.encode()).decode()}})
+
+
+def run(args):
+    from google.api_core import exceptions
+
+    digestion, digestion_clients = load_service("digestion")
+    gmail, gmail_clients = load_service("gmail")
+    predictor, predictor_clients = load_service("predictor")
+    insights, insights_clients = load_service("insights")
+    enrich = sys.modules["enrich_receipt"]
+    sinks = sys.modules["sinks"]
+    enrichment = sys.modules["enrichment_queue"]
+
+    timer = StageTimer()
+    pool = ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="process_receipt")
+    futures = []
+    latencies = []
+    statuses = defaultdict(int)
+    lock = threading.Lock()
+
+    def process(bucket_name, name):
+        # Like a GCS finalize event, the payload carries the object's custom metadata
+        metadata = storage.objects[(bucket_name, name)]["metadata"]
+        started = time.perf_counter()
+        _, status = digestion.process_receipt(
+            SimpleNamespace(data={"bucket": bucket_name, "name": name, "metadata": metadata}))
+        elapsed = time.perf_counter() - started
+        with lock:
+            statuses[status] += 1
+            if status == 200:
+                latencies.append(elapsed)
+
+    def on_finalize(bucket_name, name):
+        # The trigger only watches the upload bucket, not HISTORY_STATE_BUCKET
+        if bucket_name == gmail.BUCKET_NAME:
+            futures.append(pool.submit(process, bucket_name, name))
+
+    storage = fakes.FakeStorage(faults(args, "gcs", exceptions.ServiceUnavailable), on_finalize=on_finalize)
+    firestore = fakes.FakeFirestore(faults(args, "firestore", exceptions.ServiceUnavailable))
+    bq = fakes.FakeBigQuery(faults(args, "bq", exceptions.ServiceUnavailable), storage=storage)
+    mailbox = fakes.FakeMailbox()
+    gmail_service = fakes.FakeGmail(mailbox, faults(args, "gmail", exceptions.ServiceUnavailable))
+    Warehouse(bq, digestion, enrich, insights, predictor)
+
+    fakes.install(digestion_clients, storage=storage, firestore=firestore, bigquery=bq)
+    fakes.install(gmail_clients, storage=storage)
+    fakes.install(predictor_clients, bigquery=bq)
+    fakes.install(insights_clients, bigquery=bq, firestore=firestore)
+    gemini = fakes.install_gemini(digestion_clients, faults(args, "gemini", exceptions.TooManyRequests))
+    fakes.install_gmail(gmail_clients, gmail_service)
+    storage.put(gmail.STATE_BUCKET, gmail.STATE_OBJECT, str(mailbox.history_id).encode())
+
+    timer.wrap(digestion, "extract_receipt", "extract")
+    timer.wrap(digestion, "push_to_bigquery", "bigquery_raw")
+    timer.wrap(digestion, "enrich_and_push", "enrich")
+    timer.wrap(enrichment, "enrich_batch", "enrich_batch")
+
+    corpus = build_corpus(args.receipts, dict(zip(KINDS, args.mix)), args.duplicate_rate, args.video_seconds)
+    templates = sys.modules["templates"]
+    if args.templates:
+        templates.register_template(email_template(make_email(receipt_lines(np.random.default_rng(0), 0))),
+                                    persist=False)
+    started = time.perf_counter()
+    pending_emails = 0
+    attach = np.random.default_rng(11).random(len(corpus)) < args.attach_rate
+    for n, (kind, name, payload) in enumerate(corpus):
+        if kind == "email" or (attach[n] and kind in ("pdf", "image")):
+            if kind == "email":
+                mailbox.add_message(payload, subject=f"Receipt {name}")
+            else:
+                filename = os.path.basename(name)
+                mime_type = "application/pdf" if kind == "pdf" else "image/png"
+                mailbox.add_message("<p>Your receipt is attached.</p>", subject=f"Receipt {name}",
+                                    attachments=[(filename, mime_type, payload)])
+            pending_emails += 1
+            if pending_emails >= args.emails_per_push:
+                t = time.perf_counter()
+                gmail.gmail_push(pubsub_envelope(mailbox.history_id))
+                timer.record("gmail_push", time.perf_counter() - t)
+                pending_emails = 0
+        else:
+            storage.put(gmail.BUCKET_NAME, name, payload)
+    if pending_emails:
+        t = time.perf_counter()
+        gmail.gmail_push(pubsub_envelope(mailbox.history_id))
+        timer.record("gmail_push", time.perf_counter() - t)
+    while futures:
+        futures.pop().result()
+    ingest_seconds = time.perf_counter() - started
+    if enrichment.ENRICHMENT_DISPATCH == "local":
+        t = time.perf_counter()
+        enrichment.get_enrichment_queue().join()
+        timer.record("enrichment_drain", time.perf_counter() - t)
+    # Buffered sinks hold rows until a threshold; the scheduled jobs below need them in the tables
+    t = time.perf_counter()
+    sinks.flush_all()
+    timer.record("sink_flush", time.perf_counter() - t)
+    pipeline_seconds = time.perf_counter() - started
+    pool.shutdown()
+
+    t = time.perf_counter()
+    try:
+        insights.run_insights(None)
+    except Exception as e:
+        # Injected BigQuery/Firestore errors fail the event, which Eventarc would retry
+        statuses[f"run_insights: {type(e).__name__}"] += 1
+    timer.record("run_insights", time.perf_counter() - t)
+    t = time.perf_counter()
+    predictions, _ = predictor.run_all_predictions(SimpleNamespace(method="GET", args={}))
+    timer.record("run_all_predictions", time.perf_counter() - t)
+
+    ok = statuses.get(200, 0)
+    atexit.unregister(sinks.flush_all)  # the in-memory warehouse goes away with the process anyway
+    return {
+        "receipts": len(corpus),
+        "by_kind": {kind: sum(1 for k, _, _ in corpus if k == kind) for kind in KINDS},
+        "attached": sum(1 for n, (k, _, _) in enumerate(corpus) if attach[n] and k in ("pdf", "image")),
+        "statuses": dict(statuses),
+        "ingest_seconds": round(ingest_seconds, 3),
+        "pipeline_seconds": round(pipeline_seconds, 3),
+        "receipts_per_sec": round(ok / ingest_seconds, 2) if ingest_seconds else None,
+        "latency_ms": {"p50": round(percentile(latencies, 50) * 1000, 1) if latencies else None,
+                       "p99": round(percentile(latencies, 99) * 1000, 1) if latencies else None},
+        "stages": timer.summary(),
+        "backends": {"gcs": storage.recorder.stats(), "firestore": firestore.recorder.stats(), "bq": bq.recorder.stats(),
+                     "gmail": gmail_service.recorder.stats(), "gemini": gemini.stats()},
+        "scheduler": sys.modules["scheduler"].gemini_scheduler.stats(),
+        "templates": templates.template_stats(),
+        "sinks": sinks.sink_stats(),
+        "predictions": {name: job.get("rows") for name, job in predictions["jobs"].items()},
+        "rows": {"raw": len(bq.tables[digestion.RAW_RECEIPTS_TABLE]), "enriched": len(bq.tables[enrich.ENRICHED_TABLE]),
+                 "insight_docs": len(firestore.docs[insights.INSIGHTS_COLLECTION])},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--receipts", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16, help="process_receipt workers")
+    parser.add_argument("--mix", type=float, nargs=4, default=(0.35, 0.3, 0.05, 0.3), metavar=("PDF", "IMAGE", "VIDEO", "EMAIL"))
+    parser.add_argument("--duplicate-rate", type=float, default=0.1, help="share of uploads repeating earlier bytes")
+    parser.add_argument("--video-seconds", type=float, default=4)
+    parser.add_argument("--emails-per-push", type=int, default=10)
+    parser.add_argument("--gemini-rate", type=float, help="GEMINI_RATE_PER_SEC for the run (0 = unlimited)")
+    parser.add_argument("--enrichment-dispatch", choices=("inline", "local"), help="ENRICHMENT_DISPATCH for the run")
+    parser.add_argument("--sink-mode", choices=("streaming", "buffered"), help="BIGQUERY_SINK_MODE for the run")
+    parser.add_argument("--templates", action="store_true", help="register a merchant template for the emails")
+    parser.add_argument("--attach-rate", type=float, default=0.0,
+                        help="share of PDF/image receipts sent as Gmail attachments instead of direct uploads")
+    defaults = {"gcs": 5, "firestore": 5, "bq": 10, "gmail": 20, "gemini": 50}
+    for backend in BACKENDS:
+        parser.add_argument(f"--{backend}-latency-ms", type=float, default=defaults[backend])
+        parser.add_argument(f"--{backend}-jitter-ms", type=float, default=defaults[backend])
+        parser.add_argument(f"--{backend}-error-rate", type=float, default=0.0)
+    parser.add_argument("--verbose", action="store_true", help="show the services' own logs")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    # Read by the services at import time
+    os.environ["GEMINI_BACKEND"] = "fake"
+    os.environ.setdefault("EXTRACTION_CACHE_BACKEND", "memory")
+    os.environ.setdefault("GEMINI_BACKOFF_BASE_S", "0.05")
+    if args.gemini_rate is not None:
+        os.environ["GEMINI_RATE_PER_SEC"] = str(args.gemini_rate)
+    if args.enrichment_dispatch:
+        os.environ["ENRICHMENT_DISPATCH"] = args.enrichment_dispatch
+    if args.sink_mode:
+        os.environ["BIGQUERY_SINK_MODE"] = args.sink_mode
+
+    logs = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with logs:
+        results = run(args)
+
+    if args.json:
+        print(json.dumps(results, indent=2, default=str))
+        return
+    print(f"receipts: {results['receipts']} {results['by_kind']} ({results['attached']} as attachments)  "
+          f"statuses: {results['statuses']}")
+    print(f"throughput: {results['receipts_per_sec']} receipts/s over {results['ingest_seconds']}s "
+          f"({results['pipeline_seconds']}s until enriched and flushed)  "
+          f"latency p50 {results['latency_ms']['p50']} ms  p99 {results['latency_ms']['p99']} ms")
+    print(f"\n{'stage':<22} {'calls':>6} {'total s':>9} {'mean ms':>9} {'max ms':>9}")
+    for stage, s in results["stages"].items():
+        print(f"{stage:<22} {s['calls']:>6} {s['total_s']:>9} {s['mean_ms']:>9} {s['max_ms']:>9}")
+    print(f"\n{'backend op':<32} {'calls':>6} {'seconds':>9}")
+    for backend, ops in results["backends"].items():
+        for op, s in ops.items():
+            print(f"{backend + '.' + op:<32} {s['calls']:>6} {s['seconds']:>9}")
+    scheduler = results["scheduler"]
+    print(f"\ngemini scheduler: {scheduler['calls']} calls, {scheduler['retries']} retries, {scheduler['failures']} failures, "
+          f"p50 {scheduler['p50_ms']} ms, p99 {scheduler['p99_ms']} ms")
+    tpl = results["templates"]
+    print(f"receipt templates: {tpl['lookups']} lookups, {tpl['hits']} hits, {tpl['no_match']} no match, "
+          f"{tpl['mismatch']} mismatches (hit rate {tpl['hit_rate']})")
+    print(f"rows: {results['rows']}  predictions: {results['predictions']}")
+
+
+if __name__ == "__main__":
+    main()
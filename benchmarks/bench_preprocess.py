@@ -0,0 +1,167 @@
+"""Benchmark model-input preprocessing on a synthetic receipt corpus.
+
+Marketing-heavy HTML emails, large phone-camera JPEGs and PNG screenshots, and multi-page
+PDFs with terms and promo pages. Reports bytes and estimated Gemini input tokens before and
+after preprocess.prepare_*, and the time spent per item.
+
+    python benchmarks/bench_preprocess.py [--items 20] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services_data-digestion-engine_1753589831.471000"))
+import preprocess  # noqa: E402
+from bench_video_frames import receipt_canvas  # noqa: E402
+
+PROMO = ("Discover our new autumn collection and enjoy exclusive member benefits. Follow us on social media "
+         "for daily inspiration, recipes and style tips. Unsubscribe or manage your email preferences anytime.")
+TERMS = ("Terms and conditions. Goods once sold may be exchanged within seven days with the original slip. "
+         "Warranty claims are handled by the manufacturer. Personal data is processed according to our privacy "
+         "policy, available on our website. Loyalty points expire twelve months after they are earned.")
+
+
+def receipt_lines(rng, n):
+    items = [(f"ITEM {k:02d}", int(rng.integers(1, 4)), round(float(rng.uniform(1, 60)), 2))
+             for k in range(int(rng.integers(3, 12)))]
+    return items, f"INV-{n:06d}"
+
+
+def make_email(rng, n):
+    # Shaped like real order confirmations: head styles, hidden preheader, nested layout tables,
+    # inline CSS everywhere, tracking pixels and a long footer
+    items, invoice = receipt_lines(rng, n)
+    style = "font-family:Helvetica,Arial,sans-serif;font-size:14px;color:#333333;padding:8px 12px;"
+    rows = "".join(
+        f'<tr><td style="{style}border-bottom:1px solid #eeeeee;">{name}</td>'
+        f'<td style="{style}text-align:center;">{qty}</td>'
+        f'<td style="{style}text-align:right;">&#8377;{price:.2f}</td></tr>' for name, qty, price in items)
+    total = sum(price for _, _, price in items)
+    css = "".join(f".c{k} {{ margin:0; padding:{k}px; line-height:1.{k}; }}\n" for k in range(60))
+    pixels = "".join(f'<img src="https://t.example.com/o/{n}/{k}.gif" width="1" height="1" alt="">' for k in range(6))
+    footer = "".join(f'<p style="font-size:11px;color:#999999;margin:0 0 6px 0;">{PROMO}</p>' for _ in range(4))
+    return (
+        f"<!DOCTYPE html><html><head><meta charset='utf-8'><title>Your order</title><style>{css}</style>"
+        f"<script>window.dataLayer=[{{'order':'{invoice}'}}];</script></head><body style='margin:0'>"
+        f'<div style="display:none;max-height:0;overflow:hidden;">Your order is confirmed! {PROMO}</div>'
+        f'<table width="100%" cellpadding="0" cellspacing="0" role="presentation"><tr><td align="center">'
+        f'<table width="600" cellpadding="0" cellspacing="0" role="presentation" style="{style}">'
+        f'<tr><td><img src="https://cdn.example.com/logo.png" alt="Corner Cafe" width="180" height="48"></td></tr>'
+        f"<tr><td><h2 style='{style}'>Thanks for your order {invoice}</h2>"
+        f"<p style='{style}'>Placed on 04-12-2025 09:41 AM</p></td></tr>"
+        f'<tr><td><table width="100%" role="presentation"><tr><th style="{style}">Item</th>'
+        f'<th style="{style}">Qty</th><th style="{style}">Price</th></tr>{rows}'
+        f'<tr><td style="{style}"><b>Total</b></td><td></td><td style="{style}"><b>&#8377;{total:.2f}</b></td></tr>'
+        f"</table></td></tr><tr><td>{footer}</td></tr></table></td></tr></table>{pixels}</body></html>"
+    ).encode("utf-8")
+
+
+def make_photo(rng, size=(3024, 4032)):
+    # Phone-camera receipt photo: full sensor resolution, noisy background, quality-95 JPEG
+    width, height = size
+    canvas = receipt_canvas(width, height, rng)
+    noise = rng.normal(0, 6, canvas.shape).astype(np.int16)
+    canvas = np.clip(canvas.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+    return cv2.imencode(".jpg", canvas, [cv2.IMWRITE_JPEG_QUALITY, 95])[1].tobytes()
+
+
+def make_screenshot(rng, size=(1170, 2532)):
+    # App screenshot of an e-receipt: flat colours, saved as PNG
+    width, height = size
+    return cv2.imencode(".png", receipt_canvas(width, height, rng))[1].tobytes()
+
+
+def make_pdf(rng, n, extra_pages=3):
+    # Receipt page followed by terms and promo pages, with a proper xref so real PDF readers accept it
+    items, invoice = receipt_lines(rng, n)
+    total = sum(price for _, _, price in items)
+    receipt = ["CORNER CAFE", f"Invoice {invoice}", "04-12-2025"] + [
+        f"{name} x{qty} {price:.2f}" for name, qty, price in items] + [f"TOTAL {total:.2f}"]
+    pages = [receipt] + [[TERMS[i:i + 80] for i in range(0, len(TERMS), 80)] if k % 2 else
+                         [PROMO[i:i + 80] for i in range(0, len(PROMO), 80)] for k in range(extra_pages)]
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None,
+               "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for lines in pages:
+        text = " ".join(f"({line}) Tj T*" for line in lines)
+        stream = f"BT /F1 11 Tf 14 TL 50 780 Td {text} ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+    out = "%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{body}\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n" + "".join(f"{o:010d} 00000 n \n" for o in offsets)
+    out += f"trailer << /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n"
+    return out.encode("latin-1")
+
+
+def build_corpus(items, seed=7):
+    rng = np.random.default_rng(seed)
+    corpus = []
+    for n in range(items):
+        corpus.append(("html", make_email(rng, n)))
+        corpus.append(("jpeg photo", make_photo(rng)))
+        corpus.append(("png screenshot", make_screenshot(rng)))
+        corpus.append(("pdf", make_pdf(rng, n, extra_pages=int(rng.integers(1, 5)))))
+    return corpus
+
+
+def prepare(kind, data):
+    if kind == "html":
+        return preprocess.prepare_html(data)[1]
+    if kind == "pdf":
+        return preprocess.prepare_pdf(data)[1]
+    return preprocess.prepare_image(data)[2]
+
+
+def run(items):
+    totals = {}
+    for kind, data in build_corpus(items):
+        started = time.perf_counter()
+        stats = prepare(kind, data)
+        ms = (time.perf_counter() - started) * 1000
+        t = totals.setdefault(kind, {"items": 0, "bytes_in": 0, "bytes_out": 0, "tokens_in": 0, "tokens_out": 0,
+                                     "ms": 0.0})
+        t["items"] += 1
+        t["ms"] += ms
+        for key in ("bytes_in", "bytes_out", "tokens_in", "tokens_out"):
+            t[key] += stats[key] or 0
+    for t in totals.values():
+        t["ms_per_item"] = round(t.pop("ms") / t["items"], 2)
+        t["bytes_saved_pct"] = round(100 * (1 - t["bytes_out"] / t["bytes_in"]), 1)
+        t["tokens_saved_pct"] = round(100 * (1 - t["tokens_out"] / t["tokens_in"]), 1) if t["tokens_in"] else None
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=20, help="receipts per kind")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    totals = run(args.items)
+    if args.json:
+        print(json.dumps(totals, indent=2))
+        return
+    print(f"{'kind':<16} {'items':>5} {'KB in':>9} {'KB out':>9} {'bytes':>7} {'tok in':>8} {'tok out':>8} "
+          f"{'tokens':>7} {'ms/item':>8}")
+    for kind, t in totals.items():
+        tokens_saved = f"-{t['tokens_saved_pct']}%" if t["tokens_saved_pct"] is not None else "n/a"
+        print(f"{kind:<16} {t['items']:>5} {t['bytes_in'] / 1024:>9.1f} {t['bytes_out'] / 1024:>9.1f} "
+              f"{'-' + str(t['bytes_saved_pct']) + '%':>7} {t['tokens_in']:>8} {t['tokens_out']:>8} "
+              f"{tokens_saved:>7} {t['ms_per_item']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
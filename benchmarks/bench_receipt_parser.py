@@ -0,0 +1,219 @@
+"""Benchmark receipt_parser against the old fence-strip + json.loads parsing.
+
+Builds a corpus of model outputs with the defects seen in production (code fences,
+trailing prose, single quotes, trailing commas, Python literals, comments, currency
+strings, European and Indian (lakh) amount formats, unreadable prices, truncation) and reports, per defect, how many outputs
+each parser turns into a usable receipt, how many keep the right total, and the time per parse.
+
+    python benchmarks/bench_receipt_parser.py [--per-defect 200] [--repeat 5] [--json]
+"""
+import argparse
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services_data-digestion-engine_1753589831.471000"))
+from receipt_parser import ReceiptParseError, parse_model_output  # noqa: E402
+
+MERCHANTS = ["Corner Cafe", "FreshMart", "City Pharmacy", "Metro Fuel", "Book Nook"]
+ITEMS = ["Tea", "Coffee", "Bread", "Milk", "Paracetamol", "Diesel", "Notebook", "Rice 5kg"]
+
+
+def legacy_parse(text):
+    # What process_receipt did before: strip fences, json.loads, then prepare_bigquery_row's coercion
+    cleaned = text.strip()
+    if cleaned.startswith("```"):
+        cleaned = re.sub(r"```json|```", "", cleaned).strip()
+    receipt = json.loads(cleaned)
+    for item in receipt.get("items", []):
+        item["qty"] = float(item.get("qty", 1))
+        item["price"] = float(item.get("price", 0))
+    if "date" in receipt:
+        try:
+            receipt["date"] = datetime.strptime(receipt["date"], "%m-%d-%Y").date().isoformat()
+        except Exception:
+            receipt["date"] = None
+    return receipt
+
+
+def make_receipt(rng):
+    items = [{"name": rng.choice(ITEMS), "qty": rng.randint(1, 3), "price": round(rng.uniform(1, 60), 2),
+              "category": "Grocery"} for _ in range(rng.randint(1, 8))]
+    return {
+        "merchant": rng.choice(MERCHANTS),
+        "phone": "+91 98765 43210",
+        "date": f"{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}-2025",
+        "time": "09:41 AM",
+        "items": items,
+        "total": round(sum(i["price"] for i in items), 2),
+        "currency": "INR",
+        "receipt_id": f"INV-{rng.randint(1000, 9999)}",
+        "is_subscription": False,
+    }
+
+
+def python_repr(receipt):
+    return repr(receipt)  # single quotes, True/False/None
+
+
+def with_trailing_commas(receipt):
+    return json.dumps(receipt, indent=2).replace('"\n', '",\n').replace("}\n", "},\n")
+
+
+def with_comments(receipt):
+    lines = json.dumps(receipt, indent=2).splitlines()
+    lines.insert(2, "  // extracted from a blurry image")
+    return "\n".join(lines)
+
+
+def with_currency_strings(receipt):
+    receipt = json.loads(json.dumps(receipt))
+    for item in receipt["items"]:
+        item["price"] = f"₹{item['price']:,.2f}"
+        item["qty"] = str(item["qty"])
+    receipt["total"] = f"₹ {receipt['total']:,.2f}"
+    return json.dumps(receipt, ensure_ascii=False)
+
+
+def european(amount):
+    # 1234.5 -> "1.234,50"; short amounts sometimes lose the trailing zero ("12,5")
+    text = f"{amount:,.2f}".replace(",", " ").replace(".", ",").replace(" ", ".")
+    return text[:-1] if text.endswith("0") and amount < 100 else text
+
+
+def with_european_amounts(receipt, rng):
+    # Scales the receipt in place (build_corpus reads the expected total back) so thousands show up
+    scale = rng.choice((1, 40))
+    for item in receipt["items"]:
+        item["price"] = round(item["price"] * scale, 2)
+    receipt["total"] = round(sum(i["price"] for i in receipt["items"]), 2)
+    receipt["currency"] = "EUR"
+    written = json.loads(json.dumps(receipt))
+    for item in written["items"]:
+        item["price"] = european(item["price"])
+    written["total"] = f"€ {european(receipt['total'])}"
+    return json.dumps(written, ensure_ascii=False)
+
+
+def lakh(amount):
+    # 123456.5 -> "1,23,456.50"
+    whole, fraction = f"{amount:.2f}".split(".")
+    head, tail = whole[:-3], whole[-3:]
+    groups = [head[max(0, i - 2):i] for i in range(len(head), 0, -2)][::-1]
+    return ",".join(groups + [tail]) + f".{fraction}"
+
+
+def with_lakh_amounts(receipt, rng):
+    # Large INR amounts as Indian receipts print them; scaled in place like with_european_amounts
+    for item in receipt["items"]:
+        item["price"] = round(item["price"] * rng.choice((100, 2000)), 2)
+    receipt["total"] = round(sum(i["price"] for i in receipt["items"]), 2)
+    written = json.loads(json.dumps(receipt))
+    for item in written["items"]:
+        item["price"] = f"₹{lakh(item['price'])}"
+    written["total"] = rng.choice(("₹ ", "Rs. ")) + lakh(receipt["total"])
+    return json.dumps(written, ensure_ascii=False)
+
+
+def with_unreadable_price(receipt, rng):
+    # No printed total and one price the model could not read: the total must stay empty, not be a short sum
+    receipt["total"] = None
+    written = json.loads(json.dumps(receipt))
+    del written["total"]
+    written["items"][rng.randrange(len(written["items"]))]["price"] = "illegible"
+    return json.dumps(written)
+
+
+DEFECTS = {
+    "clean": lambda r, rng: json.dumps(r),
+    "fenced": lambda r, rng: f"```json\n{json.dumps(r, indent=2)}\n```",
+    "trailing_prose": lambda r, rng: json.dumps(r) + "\n\nLet me know if you need anything else!",
+    "leading_prose": lambda r, rng: "Here is the extracted receipt:\n" + json.dumps(r),
+    "single_quotes": lambda r, rng: python_repr(r),
+    "trailing_commas": lambda r, rng: with_trailing_commas(r),
+    "comments": lambda r, rng: with_comments(r),
+    "currency_strings": lambda r, rng: with_currency_strings(r),
+    "european_amounts": lambda r, rng: with_european_amounts(r, rng),
+    "lakh_amounts": lambda r, rng: with_lakh_amounts(r, rng),
+    "unreadable_price": lambda r, rng: with_unreadable_price(r, rng),
+    "truncated": lambda r, rng: (lambda s: s[:rng.randint(len(s) // 2, len(s) - 2)])(json.dumps(r)),
+}
+
+
+def build_corpus(per_defect, seed=7):
+    # {defect: [(text, expected total)]}; None means no total should come out
+    rng = random.Random(seed)
+    corpus = {}
+    for name, make in DEFECTS.items():
+        corpus[name] = []
+        for _ in range(per_defect):
+            receipt = make_receipt(rng)
+            text = make(receipt, rng)
+            corpus[name].append((text, receipt["total"]))
+    return corpus
+
+
+def usable(receipt):
+    # Something worth storing: a merchant or a total that is a real number
+    return bool(receipt.get("merchant")) or isinstance(receipt.get("total"), float)
+
+
+def run(parse, cases, repeat):
+    ok = right_total = 0
+    for text, total in cases:
+        try:
+            receipt = parse(text)
+        except (ValueError, TypeError, ReceiptParseError):
+            continue
+        ok += usable(receipt)
+        if total is None:
+            right_total += receipt.get("total") is None
+        else:
+            right_total += isinstance(receipt.get("total"), (int, float)) and abs(receipt["total"] - total) < 0.005
+    texts = [text for text, _ in cases]
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for text in texts:
+            try:
+                parse(text)
+            except (ValueError, TypeError, ReceiptParseError):
+                pass
+        timings.append((time.perf_counter() - started) / len(texts))
+    return {"usable": ok, "right_total": right_total, "total": len(texts), "us_per_parse": round(statistics.median(timings) * 1e6, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--per-defect", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.per_defect)
+    results = {}
+    for defect, texts in corpus.items():
+        results[defect] = {
+            "legacy": run(legacy_parse, texts, args.repeat),
+            "parser": run(lambda t: parse_model_output(t).data, texts, args.repeat),
+        }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'defect':<18} {'legacy ok':>10} {'total ok':>10} {'legacy us':>10} "
+          f"{'parser ok':>10} {'total ok':>10} {'parser us':>10}")
+    for defect, r in results.items():
+        legacy, new = r["legacy"], r["parser"]
+        print(f"{defect:<18} {legacy['usable']:>5}/{legacy['total']:<4} {legacy['right_total']:>5}/{legacy['total']:<4} "
+              f"{legacy['us_per_parse']:>10} {new['usable']:>5}/{new['total']:<4} "
+              f"{new['right_total']:>5}/{new['total']:<4} {new['us_per_parse']:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Benchmark the Gemini call scheduler (digestion engine scheduler.py) when calls hang.
+
+Runs a burst of calls through a small CallScheduler while some of them never return on their own,
+and reports how long each caller waited, how the calls ended and whether the in-flight slots come
+back. A caller must never wait much past max_attempts x (queue timeout + deadline).
+
+    healthy          every call answers after --latency-ms
+    hung-honours     the hung calls honour the request timeout the scheduler passes (like the SDK does)
+    hung-ignores     the hung calls ignore it and hold their slots; later callers fail on the queue timeout
+
+    python benchmarks/bench_scheduler.py [--calls 24] [--slots 4] [--hung-every 3] [--deadline-s 0.3]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services_data-digestion-engine_1753589831.471000"))
+from scheduler import CallScheduler  # noqa: E402
+from google.api_core import exceptions  # noqa: E402
+
+
+def scenario(name, args):
+    release = threading.Event()  # set at the end, so hung calls let the process exit
+    scheduler = CallScheduler(name, rate=0, max_in_flight=args.slots, max_attempts=args.attempts,
+                              backoff_base=0.01, backoff_max=0.05, deadline=args.deadline_s,
+                              queue_timeout=args.queue_timeout_s, timeout_kwarg="timeout")
+
+    def model_call(n, timeout=None):
+        if name == "healthy" or n % args.hung_every:
+            time.sleep(args.latency_ms / 1000)
+            return "ok"
+        wait_s = timeout if name == "hung-honours" else None
+        if not release.wait(wait_s):
+            raise exceptions.DeadlineExceeded(f"request {n} timed out after {timeout}s")
+        return "released"
+
+    def caller(n):
+        started = time.perf_counter()
+        try:
+            outcome = scheduler.call(model_call, n)
+        except Exception as e:
+            outcome = type(e).__name__
+        return outcome, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.calls) as pool:
+        results = list(pool.map(caller, range(args.calls)))
+    seconds = time.perf_counter() - started
+    stats = scheduler.stats()
+    release.set()
+    scheduler.pool.shutdown(wait=True)
+    return {
+        "seconds": seconds,
+        "outcomes": Counter(outcome for outcome, _ in results),
+        "max_wait_s": max(wait for _, wait in results),
+        "bound_s": args.attempts * (args.queue_timeout_s + args.deadline_s) + args.attempts * 0.05,
+        "in_flight_at_end": stats["in_flight"],
+        "deadline_exceeded": stats["deadline_exceeded"],
+        "queue_timeouts": stats["queue_timeouts"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=24)
+    parser.add_argument("--slots", type=int, default=4, help="max_in_flight")
+    parser.add_argument("--attempts", type=int, default=2, help="max_attempts")
+    parser.add_argument("--hung-every", type=int, default=3, help="every n-th call hangs")
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--deadline-s", type=float, default=0.3)
+    parser.add_argument("--queue-timeout-s", type=float, default=0.5)
+    parser.add_argument("--verbose", action="store_true", help="show the scheduler's retry logs")
+    args = parser.parse_args()
+
+    print(f"{'scenario':<14} {'s':>6} {'max wait s':>10} {'bound s':>8} {'in flight':>9} {'deadline':>8} {'queue to':>8}  outcomes")
+    for name in ("healthy", "hung-honours", "hung-ignores"):
+        logs = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        with logs:
+            r = scenario(name, args)
+        print(f"{name:<14} {r['seconds']:>6.2f} {r['max_wait_s']:>10.2f} {r['bound_s']:>8.2f} {r['in_flight_at_end']:>9} "
+              f"{r['deadline_exceeded']:>8} {r['queue_timeouts']:>8}  {dict(r['outcomes'])}")
+
+
+if __name__ == "__main__":
+    main()
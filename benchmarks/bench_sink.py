@@ -0,0 +1,144 @@
+"""Benchmark the BigQuery sink (digestion engine sinks.py) and check where acknowledged rows end up.
+
+Writes one row per call, as process_receipt does, then counts for every scenario how many rows the
+callers could ack (write() returned no error for them) and where those rows are: loaded into the
+table, set aside under the dead-letter prefix, still staged, or lost. Lost must stay 0.
+
+    streaming            insert_rows_json per write
+    buffered             staged per write, loaded in bulk by flush
+    crash-before-flush   the instance stops before any flush; a new instance adopts its staged files
+    bigquery-outage      every load fails while rows are written; nothing is dropped, the next flush loads them
+    rejected-rows        some rows are invalid: the rest load, the invalid ones go to the dead-letter prefix
+    gcs-outage           staging fails, so write() reports every row and the caller must not ack
+
+    python benchmarks/bench_sink.py [--rows 200] [--max-rows 50] [--bq-latency-ms 10] [--gcs-latency-ms 5]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services_data-digestion-engine_1753589831.471000"))
+import clients  # noqa: E402
+import fakes  # noqa: E402
+import sinks  # noqa: E402
+from google.api_core import exceptions  # noqa: E402
+
+TABLE = "agenticai-467004.raw_dataset.raw_receipts"
+BUCKET = "bench-bigquery-staging"
+
+
+def make_rows(n):
+    return [{"receipt_id": f"r{i:05d}", "merchant_name": "Shop", "total_amount": "bad" if i % 37 == 5 else 10.0 + i}
+            for i in range(n)]
+
+
+def backends(args, reject=None):
+    storage = fakes.FakeStorage(fakes.Faults(latency_ms=args.gcs_latency_ms, error=exceptions.ServiceUnavailable))
+    bq = fakes.FakeBigQuery(fakes.Faults(latency_ms=args.bq_latency_ms, error=exceptions.ServiceUnavailable),
+                            storage=storage, reject=reject)
+    clients._clients.clear()
+    fakes.install(clients, storage=storage, bigquery=bq)
+    return storage, bq
+
+
+def new_sink(args, mode="buffered", orphan_age=sinks.SINK_ORPHAN_AGE_S):
+    return sinks.BigQuerySink(TABLE, mode=mode, bucket=BUCKET, max_rows=args.max_rows, max_age=3600,
+                              orphan_age=orphan_age)
+
+
+def write_all(sink, rows):
+    # Returns the rows a caller would ack: those write() reported no error for
+    acked = []
+    for row in rows:
+        if not sink.write([row], keys=[row["receipt_id"]]):
+            acked.append(row["receipt_id"])
+    return acked
+
+
+def drain(sink, attempts=5):
+    for _ in range(attempts):
+        if not sink.stats()["pending_files"]:
+            return
+        sink.flush()
+
+
+def staged_ids(storage, prefix):
+    ids = set()
+    for (bucket, name), stored in list(storage.objects.items()):
+        if bucket == BUCKET and name.startswith(prefix):
+            for line in stored["data"].decode().splitlines():
+                entry = json.loads(line)
+                ids.add(entry.get("row", entry)["receipt_id"])  # dead-letter lines wrap the row with its errors
+    return ids
+
+
+def scenario(name, args):
+    reject = (lambda row: row["total_amount"] == "bad") if name == "rejected-rows" else None
+    storage, bq = backends(args, reject)
+    rows = make_rows(args.rows)
+    sink = new_sink(args, mode="streaming" if name == "streaming" else "buffered")
+    started = time.perf_counter()
+
+    if name == "gcs-outage":
+        storage.recorder.faults.error_rate = 1.0
+    if name == "bigquery-outage":
+        bq.recorder.faults.error_rate = 1.0
+    acked = write_all(sink, rows)
+    storage.recorder.faults.error_rate = 0.0
+
+    if name == "bigquery-outage":
+        drain(sink, attempts=2)  # still failing: the rows must stay pending and staged
+        bq.recorder.faults.error_rate = 0.0
+    if name == "crash-before-flush":
+        # The instance is gone with its memory; only the staged objects survive. A new instance adopts
+        # them once they are past the orphan age (0 here, so right away)
+        sink = new_sink(args, orphan_age=0)
+        sink.recover()
+    if name != "streaming":
+        drain(sink)
+    seconds = time.perf_counter() - started
+
+    loaded = {row["receipt_id"] for row in bq.tables[TABLE]}
+    dead = staged_ids(storage, sinks.SINK_DEAD_LETTER_PREFIX)
+    staged = staged_ids(storage, sinks.SINK_STAGING_PREFIX)
+    bq_calls = sum(op["calls"] for op in bq.recorder.stats().values())
+    return {
+        "ms": 1000 * seconds,
+        "acked": len(acked),
+        "loaded": len(loaded),
+        "dead_letter": len(dead),
+        "staged": len(staged),
+        "lost": len(set(acked) - loaded - dead - staged),
+        "duplicates": len(bq.tables[TABLE]) - len(loaded),
+        "bq_calls": bq_calls,
+        "gcs_calls": sum(op["calls"] for op in storage.recorder.stats().values()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=200)
+    parser.add_argument("--max-rows", type=int, default=50, help="BIGQUERY_SINK_MAX_ROWS")
+    parser.add_argument("--bq-latency-ms", type=float, default=10)
+    parser.add_argument("--gcs-latency-ms", type=float, default=5)
+    parser.add_argument("--verbose", action="store_true", help="show the sink's own logs")
+    args = parser.parse_args()
+
+    names = ("streaming", "buffered", "crash-before-flush", "bigquery-outage", "rejected-rows", "gcs-outage")
+    print(f"{'scenario':<20} {'ms':>8} {'acked':>6} {'loaded':>7} {'dead':>5} {'staged':>7} {'lost':>5} "
+          f"{'dupes':>6} {'bq':>5} {'gcs':>5}")
+    for name in names:
+        logs = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        with logs:
+            r = scenario(name, args)
+        print(f"{name:<20} {r['ms']:>8.1f} {r['acked']:>6} {r['loaded']:>7} {r['dead_letter']:>5} {r['staged']:>7} "
+              f"{r['lost']:>5} {r['duplicates']:>6} {r['bq_calls']:>5} {r['gcs_calls']:>5}")
+
+
+if __name__ == "__main__":
+    main()
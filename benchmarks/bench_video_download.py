@@ -0,0 +1,125 @@
+"""Benchmark ranged downloads of video receipts (main.extract_frames_from_blob).
+
+Writes a synthetic clip twice, with the moov atom at the end (how most phones and OpenCV write it) and
+moved to the front ("faststart"), sets VIDEO_PREFIX_BYTES below the file size and reports the byte
+ranges downloaded, the frames sent and their sharpness, next to a plain full download.
+
+    python benchmarks/bench_video_download.py [--seconds 10] [--prefix-fraction 0.3] [--repeat 3]
+"""
+import argparse
+import os
+import struct
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services_data-digestion-engine_1753589831.471000"))
+import main as digestion  # noqa: E402
+from bench_video_frames import sharpness, write_clip  # noqa: E402
+
+CONTAINERS = {b"moov", b"trak", b"mdia", b"minf", b"stbl"}  # the path from moov down to the chunk offsets
+
+
+def boxes(data, start=0, end=None):
+    # [(type, start, end, header size)] of the MP4 boxes in data[start:end]
+    end = len(data) if end is None else end
+    found = []
+    while start + 8 <= end:
+        size, kind = struct.unpack(">I4s", data[start:start + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", data[start + 8:start + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - start
+        found.append((kind, start, start + size, header))
+        start += size
+    return found
+
+
+def shift_chunk_offsets(moov, shift):
+    # Adds shift to every stco/co64 entry, since moving moov in front of mdat moves the media data
+    moov = bytearray(moov)
+
+    def walk(start, end):
+        for kind, box_start, box_end, header in boxes(moov, start, end):
+            body = box_start + header
+            if kind in CONTAINERS:
+                walk(body, box_end)
+            elif kind in (b"stco", b"co64"):
+                count = struct.unpack(">I", moov[body + 4:body + 8])[0]
+                fmt, width = (">I", 4) if kind == b"stco" else (">Q", 8)
+                for n in range(count):
+                    at = body + 8 + n * width
+                    moov[at:at + width] = struct.pack(fmt, struct.unpack(fmt, moov[at:at + width])[0] + shift)
+
+    walk(0, len(moov))
+    return bytes(moov)
+
+
+def faststart(data):
+    # What `ffmpeg -movflags +faststart` does: moov right after ftyp, chunk offsets moved along
+    top = boxes(data)
+    moov = next(data[s:e] for kind, s, e, _ in top if kind == b"moov")
+    rest = [data[s:e] for kind, s, e, _ in top if kind not in (b"ftyp", b"moov")]
+    ftyp = [data[s:e] for kind, s, e, _ in top if kind == b"ftyp"]
+    return b"".join(ftyp) + shift_chunk_offsets(moov, len(moov)) + b"".join(rest)
+
+
+class RangeBlob:
+    # Just enough of a GCS blob for extract_frames_from_blob, recording the byte ranges it asks for
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data)
+        self.ranges = []
+
+    def download_to_file(self, file_obj, start=None, end=None):
+        start = start or 0
+        end = self.size - 1 if end is None else end
+        self.ranges.append((start, end))
+        file_obj.write(self.data[start:end + 1])
+
+
+def run(data, prefix_bytes, repeat):
+    digestion.VIDEO_PREFIX_BYTES = prefix_bytes
+    timings = []
+    for _ in range(repeat):
+        blob = RangeBlob(data)
+        started = time.perf_counter()
+        frames = digestion.extract_frames_from_blob(blob, "clip.mp4")
+        timings.append(time.perf_counter() - started)
+    return {
+        "ms": 1000 * min(timings),
+        "downloaded": sum(end - start + 1 for start, end in blob.ranges),
+        "ranges": blob.ranges,
+        "frames": len(frames),
+        "sharpness": [round(float(sharpness(f)), 1) for f in frames],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--prefix-fraction", type=float, default=0.3, help="VIDEO_PREFIX_BYTES as a share of the file")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "clip.mp4")
+        write_clip(path, args.seconds, 30, (1280, 720), np.random.default_rng(7))
+        with open(path, "rb") as f:
+            moov_last = f.read()
+    layouts = [("moov-at-end", moov_last), ("faststart", faststart(moov_last))]
+
+    print(f"{'layout':<12} {'download':<8} {'ms':>8} {'KB':>8} {'frames':>7}  sharpness / ranges")
+    for layout, data in layouts:
+        for mode, prefix in (("full", len(data)), ("prefix", int(len(data) * args.prefix_fraction))):
+            r = run(data, prefix, args.repeat)
+            print(f"{layout:<12} {mode:<8} {r['ms']:>8.1f} {r['downloaded'] / 1024:>8.1f} {r['frames']:>7}  "
+                  f"{r['sharpness']} {r['ranges']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""Benchmark video frame sampling on synthetic receipt clips.
+
+Compares the original fixed-timestamp seek sampler with video_frames.sample_frames:
+total and decode-only time, frames sent, payload bytes and sharpness of the chosen frames.
+
+    python benchmarks/bench_video_frames.py [--repeat 3]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services_data-digestion-engine_1753589831.471000"))
+import video_frames  # noqa: E402
+from video_frames import sample_frames  # noqa: E402
+
+
+def legacy_extract_frames(video_path, timestamps=(1.0, 2.5, 4.0), encode=True):
+    # The sampler process_receipt used before: seek per timestamp, full-resolution JPEGs
+    cap = cv2.VideoCapture(video_path)
+    frames = []
+    for ts in timestamps:
+        cap.set(cv2.CAP_PROP_POS_MSEC, ts * 1000)
+        success, frame = cap.read()
+        if success:
+            frames.append(cv2.imencode(".jpg", frame)[1].tobytes() if encode else frame)
+    cap.release()
+    return frames
+
+
+def adaptive_decode(video_path):
+    # The decoding half of sample_frames: candidate frames and their thumbnails, nothing encoded
+    max_frames = video_frames.VIDEO_MAX_FRAMES
+    return video_frames.read_candidates(video_path, max(video_frames.VIDEO_MAX_CANDIDATES, max_frames),
+                                        max_frames * video_frames.VIDEO_POOL_FACTOR)
+
+
+def receipt_canvas(width, height, rng):
+    canvas = np.full((height, width, 3), 235, dtype=np.uint8)
+    paper_w, paper_h = width // 3, int(height * 0.9)
+    x0, y0 = (width - paper_w) // 2, (height - paper_h) // 2
+    cv2.rectangle(canvas, (x0, y0), (x0 + paper_w, y0 + paper_h), (255, 255, 255), -1)
+    lines = ["CORNER CAFE", "123 MAIN ST", "04-12-2025 09:41 AM"]
+    lines += [f"ITEM {n:02d}   x{rng.integers(1, 4)}   {rng.uniform(1, 30):6.2f}" for n in range(12)]
+    lines += ["SUBTOTAL   84.20", "TAX   6.74", "TOTAL   90.94"]
+    step = paper_h // (len(lines) + 2)
+    for n, line in enumerate(lines):
+        cv2.putText(canvas, line, (x0 + 12, y0 + step * (n + 1)), cv2.FONT_HERSHEY_SIMPLEX,
+                    paper_w / 700, (20, 20, 20), 1, cv2.LINE_AA)
+    return canvas
+
+
+def blurred_odd_seconds(n, fps):
+    return (n // fps) % 2
+
+
+def blurred_at_seek_points(n, fps):
+    # Sharp only late in each second: the legacy timestamps (1.0, 2.5, 4.0 s) and frames at whole
+    # seconds, where evenly spaced seeks land, are all blurred, but sharper frames are a few frames away
+    return not 18 <= n % fps < 26
+
+
+def write_clip(path, seconds, fps, size, rng, blurred=blurred_odd_seconds):
+    # Slow pan over a receipt with periodic motion blur, like a handheld phone clip
+    width, height = size
+    canvas = receipt_canvas(width + 200, height + 100, rng)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    total = int(seconds * fps)
+    for n in range(total):
+        dx = int(200 * n / max(total - 1, 1))
+        dy = int(50 + 40 * np.sin(n / fps))
+        frame = canvas[dy:dy + height, dx:dx + width].copy()
+        if blurred(n, fps):
+            frame = cv2.GaussianBlur(frame, (0, 0), 3)
+        writer.write(frame)
+    writer.release()
+
+
+def sharpness(jpeg):
+    gray = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_GRAYSCALE)
+    return cv2.Laplacian(gray, cv2.CV_64F).var()
+
+
+def best_ms(fn, path, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(path)
+        timings.append(time.perf_counter() - start)
+    return 1000 * min(timings), result
+
+
+def run(name, fn, decode, path, repeat):
+    ms, frames = best_ms(fn, path, repeat)
+    return {
+        "sampler": name,
+        "ms": ms,
+        "decode_ms": best_ms(decode, path, repeat)[0],
+        "frames": len(frames),
+        "bytes": sum(len(f) for f in frames),
+        "sharpness": np.mean([sharpness(f) for f in frames]) if frames else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(7)
+    clips = [("short-2s-720p", 2, 30, (1280, 720)),
+             ("medium-6s-1080p", 6, 30, (1920, 1080)),
+             ("long-15s-720p", 15, 30, (1280, 720)),
+             ("blur-at-seeks-9s", 9, 30, (1280, 720), blurred_at_seek_points)]
+    samplers = [("legacy-seek", legacy_extract_frames, lambda p: legacy_extract_frames(p, encode=False)),
+                ("adaptive", sample_frames, adaptive_decode),
+                ("adaptive-tiled", lambda p: sample_frames(p, tile=True), adaptive_decode)]
+
+    print(f"{'clip':<18} {'sampler':<15} {'ms':>8} {'decode ms':>10} {'frames':>7} {'KB':>8} {'sharpness':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, seconds, fps, size, *blurred in clips:
+            path = os.path.join(tmp, f"{name}.mp4")
+            write_clip(path, seconds, fps, size, rng, *blurred)
+            for sampler_name, fn, decode in samplers:
+                r = run(sampler_name, fn, decode, path, args.repeat)
+                print(f"{name:<18} {r['sampler']:<15} {r['ms']:>8.1f} {r['decode_ms']:>10.1f} {r['frames']:>7} "
+                      f"{r['bytes'] / 1024:>8.1f} {r['sharpness']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
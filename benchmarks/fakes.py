@@ -0,0 +1,543 @@
+"""In-memory stand-ins for GCS, Firestore, BigQuery, Gmail and Gemini.
+
+Each fake takes a Faults object that injects latency (fixed + jitter) and errors into
+every API call, and records per-operation call counts and time. They implement only the
+surface the services use. Install them into a service through its client registry:
+
+    fakes.install(clients, storage=FakeStorage(...), bigquery=FakeBigQuery(...))
+    fakes.install_gemini(clients, Faults(latency_ms=800))
+    fakes.install_gmail(clients, FakeGmail(mailbox))
+"""
+import base64
+import hashlib
+import itertools
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from google.api_core import exceptions
+
+
+class Faults:
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, error=exceptions.ServiceUnavailable, seed=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error = error
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def __call__(self, op):
+        with self.lock:
+            delay = self.latency_ms + self.rng.uniform(0, self.jitter_ms)
+            fail = self.rng.random() < self.error_rate
+        if delay:
+            time.sleep(delay / 1000)
+        if fail:
+            raise self.error(f"injected failure in {op}")
+
+
+class Recorder:
+    # Per-operation call counts and seconds, shared by all fakes of one backend
+    def __init__(self, faults=None):
+        self.faults = faults or Faults()
+        self.ops = defaultdict(lambda: [0, 0.0])
+        self.lock = threading.Lock()
+
+    def call(self, op):
+        started = time.perf_counter()
+        try:
+            self.faults(op)
+        finally:
+            with self.lock:
+                entry = self.ops[op]
+                entry[0] += 1
+                entry[1] += time.perf_counter() - started
+
+    def stats(self):
+        with self.lock:
+            return {op: {"calls": n, "seconds": round(s, 3)} for op, (n, s) in sorted(self.ops.items())}
+
+
+# ---------- Cloud Storage ----------
+
+class FakeBlob:
+    def __init__(self, storage, bucket_name, name):
+        self.storage = storage
+        self.bucket_name = bucket_name
+        self.name = name
+        self.metadata = None
+        self.content_type = None
+        self._load()
+
+    def _load(self):
+        stored = self.storage.objects.get((self.bucket_name, self.name))
+        self.generation = stored["generation"] if stored else None
+        self.size = len(stored["data"]) if stored else None
+        self.md5_hash = base64.b64encode(hashlib.md5(stored["data"]).digest()).decode() if stored else None
+        self.crc32c = None
+        if stored:
+            self.metadata = dict(stored["metadata"] or {}) or None
+            self.content_type = stored["content_type"]
+
+    def _data(self):
+        stored = self.storage.objects.get((self.bucket_name, self.name))
+        if stored is None:
+            raise exceptions.NotFound(f"gs://{self.bucket_name}/{self.name}")
+        return stored["data"]
+
+    def exists(self):
+        self.storage.recorder.call("exists")
+        return (self.bucket_name, self.name) in self.storage.objects
+
+    def reload(self):
+        self.storage.recorder.call("reload")
+        self._data()
+        self._load()
+
+    def download_as_bytes(self, start=None, end=None):
+        self.storage.recorder.call("download")
+        data = self._data()
+        start = start or 0
+        return data[start:] if end is None else data[start:end + 1]
+
+    def download_as_text(self, encoding="utf-8"):
+        return self.download_as_bytes().decode(encoding)
+
+    def download_to_file(self, file_obj, start=None, end=None):
+        file_obj.write(self.download_as_bytes(start=start, end=end))
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        self.storage.recorder.call("upload")
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.storage.put(self.bucket_name, self.name, data, content_type or self.content_type,
+                         self.metadata, if_generation_match)
+        self._load()
+
+    def delete(self):
+        self.storage.recorder.call("delete")
+        with self.storage.lock:
+            if self.storage.objects.pop((self.bucket_name, self.name), None) is None:
+                raise exceptions.NotFound(f"gs://{self.bucket_name}/{self.name}")
+
+
+class FakeBucket:
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+
+    def blob(self, name):
+        return FakeBlob(self.storage, self.name, name)
+
+    def get_blob(self, name):
+        blob = FakeBlob(self.storage, self.name, name)
+        return blob if blob.generation is not None else None
+
+    def list_blobs(self, prefix=""):
+        self.storage.recorder.call("list")
+        with self.storage.lock:
+            names = sorted(name for bucket, name in self.storage.objects if bucket == self.name and name.startswith(prefix))
+        return [FakeBlob(self.storage, self.name, name) for name in names]
+
+    def copy_blob(self, blob, destination_bucket, new_name):
+        self.storage.recorder.call("copy")
+        stored = self.storage.objects.get((blob.bucket_name, blob.name))
+        if stored is None:
+            raise exceptions.NotFound(f"gs://{blob.bucket_name}/{blob.name}")
+        self.storage.put(destination_bucket.name, new_name, stored["data"], stored["content_type"], stored["metadata"])
+        return FakeBlob(self.storage, destination_bucket.name, new_name)
+
+
+class FakeStorage:
+    # on_finalize(bucket, name) fires after every successful write, like the GCS object trigger
+    def __init__(self, faults=None, on_finalize=None):
+        self.recorder = Recorder(faults)
+        self.objects = {}
+        self.generations = itertools.count(1)
+        self.lock = threading.Lock()
+        self.on_finalize = on_finalize
+
+    def bucket(self, name):
+        return FakeBucket(self, name)
+
+    def put(self, bucket_name, name, data, content_type=None, metadata=None, if_generation_match=None):
+        with self.lock:
+            current = self.objects.get((bucket_name, name))
+            if if_generation_match is not None and (current["generation"] if current else 0) != if_generation_match:
+                raise exceptions.PreconditionFailed(f"gs://{bucket_name}/{name} generation mismatch")
+            self.objects[(bucket_name, name)] = {"data": data, "generation": next(self.generations),
+                                                 "content_type": content_type, "metadata": metadata}
+        if self.on_finalize:
+            self.on_finalize(bucket_name, name)
+
+
+# ---------- Firestore ----------
+
+class FakeSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+class FakeDocument:
+    def __init__(self, db, collection, doc_id):
+        self.db = db
+        self.collection = collection
+        self.id = doc_id
+
+    def set(self, data, merge=False):
+        self.db.recorder.call("set")
+        self.db._write(self.collection, self.id, data, merge)
+
+    def get(self):
+        self.db.recorder.call("get")
+        with self.db.lock:
+            return FakeSnapshot(self.id, self.db.docs[self.collection].get(self.id))
+
+    def delete(self):
+        self.db.recorder.call("delete")
+        with self.db.lock:
+            self.db.docs[self.collection].pop(self.id, None)
+
+
+class FakeQuery:
+    def __init__(self, db, collection, filters=(), fields=None, limit=None):
+        self.db = db
+        self.collection = collection
+        self.filters = list(filters)
+        self.fields = fields
+        self._limit = limit
+
+    def where(self, field, op, value):
+        if op != "==":
+            raise NotImplementedError(op)
+        return FakeQuery(self.db, self.collection, self.filters + [(field, value)], self.fields, self._limit)
+
+    def select(self, fields):
+        return FakeQuery(self.db, self.collection, self.filters, list(fields), self._limit)
+
+    def limit(self, count):
+        return FakeQuery(self.db, self.collection, self.filters, self.fields, count)
+
+    def stream(self):
+        self.db.recorder.call("query")
+        with self.db.lock:
+            docs = list(self.db.docs[self.collection].items())
+        matched = (
+            (doc_id, data) for doc_id, data in docs
+            if all(data.get(field) == value for field, value in self.filters))
+        for doc_id, data in itertools.islice(matched, self._limit):
+            if self.fields is not None:
+                data = {k: v for k, v in data.items() if k in self.fields}
+            yield FakeSnapshot(doc_id, data)
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db, name):
+        super().__init__(db, name)
+
+    def document(self, doc_id=None):
+        return FakeDocument(self.db, self.collection, doc_id or hashlib.sha1(str(time.time_ns()).encode()).hexdigest()[:20])
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.ops = []
+
+    def set(self, ref, data, merge=False):
+        self.ops.append((ref, data, merge))
+
+    def delete(self, ref):
+        self.ops.append((ref, None, False))
+
+    def commit(self):
+        if len(self.ops) > 500:
+            raise exceptions.InvalidArgument("maximum 500 writes allowed per request")
+        self.db.recorder.call("batch_commit")
+        for ref, data, merge in self.ops:
+            if data is None:
+                with self.db.lock:
+                    self.db.docs[ref.collection].pop(ref.id, None)
+            else:
+                self.db._write(ref.collection, ref.id, data, merge)
+
+
+class FakeFirestore:
+    def __init__(self, faults=None):
+        self.recorder = Recorder(faults)
+        self.docs = defaultdict(dict)
+        self.lock = threading.Lock()
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def _write(self, collection, doc_id, data, merge):
+        with self.lock:
+            current = self.docs[collection].get(doc_id) if merge else None
+            self.docs[collection][doc_id] = {**(current or {}), **data}
+
+
+# ---------- BigQuery ----------
+
+class FakeQueryJob:
+    def __init__(self, rows=(), num_dml_affected_rows=None, total_bytes_billed=0, children=(), statement_type=None):
+        self.job_id = f"job_{hashlib.sha1(str(time.time_ns()).encode()).hexdigest()[:12]}"
+        self.rows = list(rows)
+        self.num_dml_affected_rows = num_dml_affected_rows
+        self.total_bytes_billed = total_bytes_billed
+        self.children = list(children)
+        self.statement_type = statement_type
+
+    def result(self):
+        return iter(self.rows)
+
+
+class FakeBigQuery:
+    # Streaming inserts are stored per table (deduped on row_ids, like insertId); queries are answered
+    # by handlers registered with on_query(pattern, fn(sql, bq) -> FakeQueryJob) since no SQL engine runs here.
+    # Load jobs read gs:// URIs from storage; reject(row) -> True makes a row invalid, which fails a whole
+    # load job and comes back as a row error from insert_rows_json.
+    def __init__(self, faults=None, storage=None, reject=None):
+        self.recorder = Recorder(faults)
+        self.storage = storage
+        self.reject = reject
+        self.tables = defaultdict(list)
+        self.row_ids = defaultdict(set)
+        self.modified = {}
+        self.handlers = []
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def on_query(self, pattern, handler):
+        self.handlers.append((pattern, handler))
+
+    def insert_rows_json(self, table, rows, row_ids=None):
+        self.recorder.call("insert_rows_json")
+        errors = []
+        with self.lock:
+            for n, (row, row_id) in enumerate(zip(rows, row_ids or [None] * len(rows))):
+                if self.reject and self.reject(row):
+                    errors.append({"index": n, "errors": [{"reason": "invalid", "message": "rejected row"}]})
+                    continue
+                if row_id is not None:
+                    if row_id in self.row_ids[table]:
+                        continue
+                    self.row_ids[table].add(row_id)
+                self.tables[table].append(dict(row))
+            self.touch(table)
+        return errors
+
+    def load_table_from_uri(self, uris, table, job_config=None):
+        self.recorder.call("load_table_from_uri")
+        rows = []
+        for uri in [uris] if isinstance(uris, str) else uris:
+            bucket_name, name = uri[len("gs://"):].split("/", 1)
+            stored = self.storage.objects.get((bucket_name, name))
+            if stored is None:
+                raise exceptions.NotFound(uri)
+            rows.extend(json.loads(line) for line in stored["data"].decode("utf-8").splitlines() if line)
+        if self.reject and any(self.reject(row) for row in rows):
+            raise exceptions.BadRequest(f"Error while reading data, {table}: rejected row")
+        with self.lock:
+            self.tables[table].extend(rows)
+            self.touch(table)
+        return FakeQueryJob(rows=[], num_dml_affected_rows=len(rows))
+
+    def touch(self, table):
+        self.modified[table] = datetime.now(timezone.utc)
+
+    def query(self, sql, job_config=None):
+        self.recorder.call("query")
+        for pattern, handler in self.handlers:
+            if pattern in sql:
+                job = handler(sql, self)
+                break
+        else:
+            job = FakeQueryJob()
+        self.jobs[job.job_id] = job
+        return job
+
+    def list_jobs(self, parent_job=None):
+        job = self.jobs.get(getattr(parent_job, "job_id", parent_job))
+        return list(job.children) if job else []
+
+    def get_table(self, table):
+        self.recorder.call("get_table")
+        return SimpleNamespace(table_id=table, modified=self.modified.get(table), num_rows=len(self.tables[table]),
+                               schema=None)
+
+
+# ---------- Gmail ----------
+
+class FakeMailbox:
+    def __init__(self):
+        self.messages = {}
+        self.history = []  # (history_id, message_id)
+        self.history_id = 1000
+        self.lock = threading.Lock()
+
+    def add_message(self, html, subject="Your receipt", sender="receipts@example.com", attachments=()):
+        # attachments: [(filename, mime_type, bytes)]
+        with self.lock:
+            self.history_id += 1
+            msg_id = f"msg{self.history_id:08x}"
+            parts = [{"partId": "0", "mimeType": "text/html", "filename": "",
+                      "body": {"size": len(html), "data": base64.urlsafe_b64encode(html.encode()).decode()}}]
+            for n, (filename, mime_type, data) in enumerate(attachments, start=1):
+                attachment_id = f"att{msg_id}{n}"
+                parts.append({"partId": str(n), "mimeType": mime_type, "filename": filename,
+                              "body": {"size": len(data), "attachmentId": attachment_id}})
+                self.messages[attachment_id] = data
+            self.messages[msg_id] = {
+                "id": msg_id,
+                "threadId": msg_id,
+                "historyId": str(self.history_id),
+                "internalDate": str(int(time.time() * 1000) + self.history_id),
+                "payload": {"mimeType": "multipart/mixed", "headers": [
+                    {"name": "Subject", "value": subject}, {"name": "From", "value": sender}], "parts": parts},
+            }
+            self.history.append((self.history_id, msg_id))
+            return msg_id
+
+
+class _Request:
+    def __init__(self, gmail, op, fn):
+        self.gmail = gmail
+        self.op = op
+        self.fn = fn
+
+    def execute(self):
+        self.gmail.recorder.call(self.op)
+        return self.fn()
+
+
+class _Batch:
+    def __init__(self, gmail, callback):
+        self.gmail = gmail
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.gmail.recorder.call("batch")
+        for request_id, request in self.requests:
+            try:
+                response, error = request.fn(), None
+            except Exception as e:
+                response, error = None, e
+            self.callback(request_id, response, error)
+
+
+class FakeGmail:
+    # Mimics the googleapiclient resource chain: service.users().messages().get(...).execute()
+    def __init__(self, mailbox, faults=None, page_size=100):
+        self.mailbox = mailbox
+        self.recorder = Recorder(faults)
+        self.page_size = page_size
+
+    def users(self):
+        return self
+
+    def history(self):
+        return SimpleNamespace(list=self._history_list)
+
+    def messages(self):
+        return SimpleNamespace(list=self._messages_list, get=self._messages_get,
+                               attachments=lambda: SimpleNamespace(get=self._attachment_get))
+
+    def getProfile(self, userId="me"):
+        return _Request(self, "getProfile", lambda: {"historyId": str(self.mailbox.history_id)})
+
+    def new_batch_http_request(self, callback=None):
+        return _Batch(self, callback)
+
+    def _history_list(self, userId="me", startHistoryId=None, historyTypes=None, labelId=None, pageToken=None):
+        def run():
+            offset = int(pageToken or 0)
+            entries = [(h, m) for h, m in self.mailbox.history if h > int(startHistoryId)]
+            page = entries[offset:offset + self.page_size]
+            response = {"historyId": str(self.mailbox.history_id),
+                        "history": [{"id": str(h), "messagesAdded": [{"message": {"id": m}}]} for h, m in page]}
+            if offset + self.page_size < len(entries):
+                response["nextPageToken"] = str(offset + self.page_size)
+            return response
+        return _Request(self, "history.list", run)
+
+    def _messages_list(self, userId="me", labelIds=None, maxResults=100, q=None):
+        def run():
+            ids = [m for _, m in self.mailbox.history][-maxResults:]
+            return {"messages": [{"id": m} for m in reversed(ids)]}
+        return _Request(self, "messages.list", run)
+
+    def _messages_get(self, userId="me", id=None, format="full"):
+        def run():
+            if id not in self.mailbox.messages:
+                raise exceptions.NotFound(id)
+            return self.mailbox.messages[id]
+        return _Request(self, "messages.get", run)
+
+    def _attachment_get(self, userId="me", messageId=None, id=None):
+        def run():
+            data = self.mailbox.messages[id]
+            return {"size": len(data), "data": base64.urlsafe_b64encode(data).decode()}
+        return _Request(self, "attachments.get", run)
+
+
+class FakeCredentials:
+    valid = True
+    refresh_token = "fake"
+
+
+# ---------- Gemini ----------
+
+class FakeGemini:
+    # fake_model.FakeModel (digestion engine) answers; Faults adds latency and 429s on top
+    def __init__(self, model_name, system_instruction=None, faults=None, recorder=None):
+        from fake_model import FakeModel
+        self.model = FakeModel(model_name, system_instruction=system_instruction)
+        self.recorder = recorder or Recorder(faults)
+
+    def generate_content(self, contents, generation_config=None, **kwargs):
+        self.recorder.call("generate_content")
+        return self.model.generate_content(contents, generation_config=generation_config, **kwargs)
+
+
+# ---------- Installation ----------
+
+def install(clients_module, **clients):
+    # Pre-populates a service's client registry, so get_storage() etc. return the fakes
+    clients_module._clients.update(clients)
+
+
+def install_gemini(clients_module, faults=None):
+    # Every model the service builds (any name, any system instruction) becomes a FakeGemini
+    # sharing one recorder, so its stats cover all model calls
+    recorder = Recorder(faults or Faults(error=exceptions.TooManyRequests))
+    clients_module.GEMINI_BACKEND = "fake"
+    clients_module._model = lambda model_name, system_instruction=None: FakeGemini(
+        model_name, system_instruction, recorder=recorder)
+    return recorder
+
+
+def install_gmail(clients_module, gmail):
+    # The real service is per thread; the fake is shared by every thread, attachment workers included
+    clients_module._clients["gmail_credentials"] = FakeCredentials()
+    clients_module._thread_local = SimpleNamespace(gmail=gmail)
@@ -0,0 +1,76 @@
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from tracing import bind, span
+
+# name -> {"sql", "tables", "map_row"}; the name doubles as the insight_type of the docs it produces
+INSIGHTS = {}
+
+# Reuse a query's rows while none of the tables it reads has changed (warm instances only)
+RESULT_CACHE_ENABLED = os.environ.get("INSIGHTS_RESULT_CACHE", "true").lower() == "true"
+INSIGHT_QUERY_WORKERS = int(os.environ.get("INSIGHT_QUERY_WORKERS", "8"))
+
+_result_cache = {}
+_cache_lock = threading.Lock()
+
+
+def insight(name, sql, tables=()):
+    # Decorator registering a row mapper: map_row(row) -> Firestore entry.
+    # tables lists what the SQL reads; their last-modified times key the result cache.
+    def register(map_row):
+        INSIGHTS[name] = {"sql": sql, "tables": tuple(tables), "map_row": map_row}
+        return map_row
+    return register
+
+
+def cache_key(bq_client, spec):
+    # None when the result can't be cached safely (no tables declared, or metadata unavailable)
+    if not RESULT_CACHE_ENABLED or not spec["tables"]:
+        return None
+    try:
+        modified = tuple(str(bq_client.get_table(table).modified) for table in spec["tables"])
+    except Exception as e:
+        print(f"Could not read table metadata, not caching: {e}")
+        return None
+    return hashlib.sha256("\n".join((spec["sql"],) + modified).encode("utf-8")).hexdigest()
+
+
+def run_query(bq_client, name, spec):
+    # Returns (rows as dicts, cache hit)
+    key = cache_key(bq_client, spec)
+    if key is not None:
+        with _cache_lock:
+            rows = _result_cache.get((name, key))
+        if rows is not None:
+            return rows, True
+
+    with span("bigquery.insight_query", insight=name) as attrs:
+        rows = [dict(row.items()) for row in bq_client.query(spec["sql"]).result()]
+        attrs["rows"] = len(rows)
+    if key is not None:
+        with _cache_lock:
+            # Only the latest result per insight is worth keeping
+            for stale in [k for k in _result_cache if k[0] == name]:
+                del _result_cache[stale]
+            _result_cache[(name, key)] = rows
+    return rows, False
+
+
+def run_insight_queries(bq_client, names=None):
+    # All queries are in flight at once and collected as they finish.
+    # Returns ({name: [entries]}, {name: {"rows", "seconds", "cached"}}); a failing query raises.
+    names = list(names or INSIGHTS)
+    started = time.perf_counter()
+    entries, stats = {}, {}
+    with ThreadPoolExecutor(max_workers=max(1, min(INSIGHT_QUERY_WORKERS, len(names)))) as pool:
+        futures = {pool.submit(bind(run_query), bq_client, name, INSIGHTS[name]): name for name in names}
+        for future in as_completed(futures):
+            name = futures[future]
+            rows, cached = future.result()
+            entries[name] = [INSIGHTS[name]["map_row"](row) for row in rows]
+            stats[name] = {"rows": len(rows), "seconds": round(time.perf_counter() - started, 3), "cached": cached}
+            print(f"{'♻️' if cached else '✅'} {name}: {len(rows)} rows")
+    return entries, stats
@@ -1,59 +1,275 @@
 import functions_framework
-from google.cloud import bigquery, firestore
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from clients import get_bigquery, get_firestore, track_cold_start
+from insight_registry import INSIGHTS, insight, run_insight_queries
+from tracing import span, trace_context
 
-bq_client = bigquery.Client()
-fs_client = firestore.Client()
+PROJECT_ID = "agenticai-467004"
+DATASET = "receipts"
+INSIGHTS_TABLE = f"{PROJECT_ID}.{DATASET}.raw_receipts"
 
-INSIGHTS_TABLE = "agenticai-467004.receipts.raw_receipts"
+# Running totals maintained from raw_receipts, so each event only aggregates newly ingested rows
+MONTHLY_AGG_TABLE = f"{PROJECT_ID}.{DATASET}.insights_monthly_category_agg"
+MERCHANT_AGG_TABLE = f"{PROJECT_ID}.{DATASET}.insights_merchant_agg"
+WATERMARK_TABLE = f"{PROJECT_ID}.{DATASET}.insights_watermarks"
+# Rows past the watermark (still inside the lag window), rewritten on every refresh and added on top of
+# the running totals by the insight queries, so the receipt that triggered a run is in its insights
+PENDING_TABLE = f"{PROJECT_ID}.{DATASET}.insights_pending_rows"
 
-@functions_framework.cloud_event
-def run_insights(cloud_event):
-    # 1. Monthly Spend per Category
-    query1 = f"""
-    SELECT
-      category,
-      FORMAT_DATE('%Y-%m', DATE(date)) AS month,
-      ROUND(SUM(total), 2) AS total_spend
+# incremental: fold in rows since the watermark; full: rebuild the aggregates on every event
+INSIGHTS_MODE = os.environ.get("INSIGHTS_MODE", "incremental")
+# Rebuild from scratch this often to correct drift (late or duplicate rows); 0 disables
+FULL_RECOMPUTE_HOURS = int(os.environ.get("INSIGHTS_FULL_RECOMPUTE_HOURS", "24"))
+# timestamp is set by the writer, and buffered rows become visible up to BIGQUERY_SINK_MAX_AGE_S later,
+# so only rows older than this are folded into the totals (newer ones go to PENDING_TABLE and are
+# recomputed on every run); keep it above that age plus client clock skew. Rows staged
+# by an instance that died land after BIGQUERY_SINK_ORPHAN_AGE_S; the full recompute picks those up.
+WATERMARK_LAG_S = int(os.environ.get("INSIGHTS_WATERMARK_LAG_S", "120"))
+TOP_MERCHANTS = 5
+REFRESH_ATTEMPTS = 3  # a refresh aborted by a concurrent one is retried
+REFRESH_BACKOFF_S = 1.0
+
+INSIGHTS_COLLECTION = "receipt_insights"
+FIRESTORE_BATCH_LIMIT = 500  # hard limit on writes per Firestore batch
+FIRESTORE_WRITE_WORKERS = int(os.environ.get("FIRESTORE_WRITE_WORKERS", "4"))
+
+
+def refresh_aggregates_sql(force_full):
+    # One transaction: read the watermark, aggregate rows between it and the cutoff, advance it to the
+    # cutoff. A full recompute empties the aggregates first and runs the same MERGEs over every row
+    # up to the cutoff. Rows newer than the cutoff may still be in flight, so they are not folded in:
+    # PENDING_TABLE is replaced with them instead, and the next run recomputes it.
+    periodic = "FALSE"
+    if FULL_RECOMPUTE_HOURS > 0:
+        periodic = f"last_full < TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {FULL_RECOMPUTE_HOURS} HOUR)"
+    return f"""
+    DECLARE watermark TIMESTAMP;
+    DECLARE last_full TIMESTAMP;
+    DECLARE full_recompute BOOL;
+    DECLARE cutoff TIMESTAMP;
+
+    CREATE TABLE IF NOT EXISTS `{MONTHLY_AGG_TABLE}`
+      (category STRING, month STRING, total_spend FLOAT64, txn_count INT64, updated_at TIMESTAMP);
+    CREATE TABLE IF NOT EXISTS `{MERCHANT_AGG_TABLE}`
+      (merchant STRING, total_spend FLOAT64, txn_count INT64, updated_at TIMESTAMP);
+    CREATE TABLE IF NOT EXISTS `{WATERMARK_TABLE}` (name STRING, watermark TIMESTAMP);
+    CREATE TABLE IF NOT EXISTS `{PENDING_TABLE}`
+      (category STRING, month STRING, merchant STRING, receipt_id STRING, total FLOAT64);
+
+    BEGIN TRANSACTION;
+    SET watermark = (SELECT MAX(watermark) FROM `{WATERMARK_TABLE}` WHERE name = 'raw_receipts');
+    SET last_full = (SELECT MAX(watermark) FROM `{WATERMARK_TABLE}` WHERE name = 'raw_receipts_full');
+    SET full_recompute = {str(force_full).upper()} OR watermark IS NULL OR last_full IS NULL OR {periodic};
+    SET cutoff = TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {WATERMARK_LAG_S} SECOND);
+
+    CREATE TEMP TABLE delta AS
+    SELECT category, FORMAT_DATE('%Y-%m', DATE(date)) AS month, merchant, receipt_id, total, timestamp
     FROM `{INSIGHTS_TABLE}`
-    WHERE date IS NOT NULL
+    WHERE timestamp <= cutoff AND (full_recompute OR timestamp > watermark);
+
+    CREATE TEMP TABLE pending AS
+    SELECT category, FORMAT_DATE('%Y-%m', DATE(date)) AS month, merchant, receipt_id, total
+    FROM `{INSIGHTS_TABLE}`
+    WHERE timestamp > cutoff AND (full_recompute OR timestamp > watermark);
+
+    IF full_recompute THEN
+      DELETE FROM `{MONTHLY_AGG_TABLE}` WHERE TRUE;
+      DELETE FROM `{MERCHANT_AGG_TABLE}` WHERE TRUE;
+    END IF;
+
+    MERGE `{MONTHLY_AGG_TABLE}` T
+    USING (
+      SELECT category, month, COALESCE(SUM(total), 0) AS total_spend, COUNT(*) AS txn_count
+      FROM delta WHERE month IS NOT NULL
+      GROUP BY category, month
+    ) S
+    ON T.category IS NOT DISTINCT FROM S.category AND T.month = S.month
+    WHEN MATCHED THEN UPDATE SET
+      total_spend = T.total_spend + S.total_spend,
+      txn_count = T.txn_count + S.txn_count,
+      updated_at = CURRENT_TIMESTAMP()
+    WHEN NOT MATCHED THEN INSERT (category, month, total_spend, txn_count, updated_at)
+      VALUES (S.category, S.month, S.total_spend, S.txn_count, CURRENT_TIMESTAMP());
+
+    MERGE `{MERCHANT_AGG_TABLE}` T
+    USING (
+      SELECT merchant, COALESCE(SUM(total), 0) AS total_spend, COUNT(receipt_id) AS txn_count
+      FROM delta
+      GROUP BY merchant
+    ) S
+    ON T.merchant IS NOT DISTINCT FROM S.merchant
+    WHEN MATCHED THEN UPDATE SET
+      total_spend = T.total_spend + S.total_spend,
+      txn_count = T.txn_count + S.txn_count,
+      updated_at = CURRENT_TIMESTAMP()
+    WHEN NOT MATCHED THEN INSERT (merchant, total_spend, txn_count, updated_at)
+      VALUES (S.merchant, S.total_spend, S.txn_count, CURRENT_TIMESTAMP());
+
+    MERGE `{WATERMARK_TABLE}` T
+    USING (
+      SELECT 'raw_receipts' AS name, cutoff AS watermark FROM UNNEST([1]) WHERE watermark IS NULL OR cutoff > watermark
+      UNION ALL
+      SELECT 'raw_receipts_full', CURRENT_TIMESTAMP() FROM UNNEST([1]) WHERE full_recompute
+    ) S
+    ON T.name = S.name
+    WHEN MATCHED THEN UPDATE SET watermark = S.watermark
+    WHEN NOT MATCHED THEN INSERT (name, watermark) VALUES (S.name, S.watermark);
+
+    -- Left alone when both are empty, so an idle run keeps the insight result cache valid
+    IF EXISTS(SELECT 1 FROM pending) OR EXISTS(SELECT 1 FROM `{PENDING_TABLE}`) THEN
+      DELETE FROM `{PENDING_TABLE}` WHERE TRUE;
+      INSERT INTO `{PENDING_TABLE}` (category, month, merchant, receipt_id, total)
+      SELECT category, month, merchant, receipt_id, total FROM pending;
+    END IF;
+    COMMIT TRANSACTION;
+
+    SELECT full_recompute, (SELECT COUNT(*) FROM delta) AS new_rows, (SELECT COUNT(*) FROM pending) AS pending_rows;
+    """
+
+
+def refresh_aggregates(bq_client, force_full=False):
+    # Returns {"full_recompute", "new_rows", "pending_rows", "bytes_billed"}
+    for attempt in range(REFRESH_ATTEMPTS):
+        try:
+            with span("bigquery.refresh_aggregates", force_full=force_full, attempt=attempt) as attrs:
+                job = bq_client.query(refresh_aggregates_sql(force_full))
+                row = next(iter(job.result()))
+                attrs.update(job_id=job.job_id, new_rows=row["new_rows"], bytes_billed=job.total_bytes_billed)
+            break
+        except Exception as e:
+            # Concurrent events race on the watermark and BigQuery aborts the later transaction. The
+            # winner may have started before this event's row was visible, so this one runs again.
+            if "concurrent update" not in str(e).lower() or attempt + 1 == REFRESH_ATTEMPTS:
+                raise
+            print(f"⚠️ Aggregates updated concurrently, retrying the refresh: {e}")
+            time.sleep(REFRESH_BACKOFF_S * 2 ** attempt)
+    stats = {"full_recompute": row["full_recompute"], "new_rows": row["new_rows"],
+             "pending_rows": row["pending_rows"], "bytes_billed": job.total_bytes_billed}
+    print(f"✅ Aggregates refreshed: {stats}")
+    return stats
+
+
+# ---------- Insights ----------
+# Each insight is a query plus a row mapper; registering one is all it takes to publish it.
+
+@insight("monthly_category_spend", f"""
+    SELECT category, month, ROUND(SUM(total_spend), 2) AS total_spend
+    FROM (
+      SELECT category, month, total_spend FROM `{MONTHLY_AGG_TABLE}`
+      UNION ALL
+      SELECT category, month, COALESCE(total, 0) FROM `{PENDING_TABLE}` WHERE month IS NOT NULL
+    )
     GROUP BY category, month
     ORDER BY month DESC, total_spend DESC
-    """
+    """, tables=[MONTHLY_AGG_TABLE, PENDING_TABLE])
+def monthly_category_spend(row):
+    return {
+        "category": row["category"],
+        "month": row["month"],
+        "total_spend": row["total_spend"],
+        "insight_type": "monthly_category_spend",
+        "generated_at": datetime.utcnow().isoformat()
+    }
 
-    monthly_spend = bq_client.query(query1).result()
-    insights = []
-    for row in monthly_spend:
-        insights.append({
-            "category": row["category"],
-            "month": row["month"],
-            "total_spend": row["total_spend"],
-            "insight_type": "monthly_category_spend",
-            "generated_at": datetime.utcnow().isoformat()
-        })
-
-    # 2. Top Merchants by Spend
-    query2 = f"""
-    SELECT merchant, COUNT(receipt_id) AS txn_count, ROUND(SUM(total), 2) AS total_spend
-    FROM `{INSIGHTS_TABLE}`
+
+@insight("top_merchants", f"""
+    SELECT merchant, SUM(txn_count) AS txn_count, ROUND(SUM(total_spend), 2) AS total_spend
+    FROM (
+      SELECT merchant, txn_count, total_spend FROM `{MERCHANT_AGG_TABLE}`
+      UNION ALL
+      SELECT merchant, IF(receipt_id IS NULL, 0, 1), COALESCE(total, 0) FROM `{PENDING_TABLE}`
+    )
     GROUP BY merchant
     ORDER BY total_spend DESC
-    LIMIT 5
-    """
-    merchant_result = bq_client.query(query2).result()
-    for row in merchant_result:
-        insights.append({
-            "merchant": row["merchant"],
-            "txn_count": row["txn_count"],
-            "total_spend": row["total_spend"],
-            "insight_type": "top_merchants",
-            "generated_at": datetime.utcnow().isoformat()
-        })
-
-    # 3. Upload insights to Firestore
+    LIMIT {TOP_MERCHANTS}
+    """, tables=[MERCHANT_AGG_TABLE, PENDING_TABLE])
+def top_merchants(row):
+    return {
+        "merchant": row["merchant"],
+        "txn_count": row["txn_count"],
+        "total_spend": row["total_spend"],
+        "insight_type": "top_merchants",
+        "generated_at": datetime.utcnow().isoformat()
+    }
+
+
+@functions_framework.cloud_event
+@track_cold_start
+def run_insights(cloud_event):
+    with trace_context(), span("run_insights"):
+        bq_client = get_bigquery()
+        fs_client = get_firestore()
+
+        refresh_aggregates(bq_client, force_full=(INSIGHTS_MODE == "full"))
+
+        # 1. Every registered insight query runs concurrently
+        with span("bigquery.insight_queries", insights=len(INSIGHTS)) as attrs:
+            results, query_stats = run_insight_queries(bq_client)
+            attrs["cached"] = sum(1 for stats in query_stats.values() if stats["cached"])
+        insights = [entry for name in INSIGHTS for entry in results[name]]
+
+        # 2. Publish to Firestore: only changed docs are written, stale ones removed
+        with span("firestore.publish_insights", insights=len(insights)) as attrs:
+            attrs.update(publish_insights(fs_client, insights))
+
+
+def insight_doc_id(entry):
+    return f"{entry.get('insight_type')}_{entry.get('month', '')}_{entry.get('merchant', entry.get('category', 'unknown'))}"
+
+
+def payload_hash(entry):
+    # generated_at changes on every run, so it is left out: equal hashes mean nothing to update
+    payload = {k: v for k, v in entry.items() if k != "generated_at"}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def publish_insights(fs_client, insights):
+    # Returns {"written", "unchanged", "deleted"}
+    collection = fs_client.collection(INSIGHTS_COLLECTION)
+
+    # One streamed read of the hashes already published instead of a get per doc
+    existing = {}
+    for snapshot in collection.select(["payload_hash", "insight_type"]).stream():
+        data = snapshot.to_dict() or {}
+        # Only docs of registered insight types are owned (and pruned) by this function
+        if data.get("insight_type") in INSIGHTS:
+            existing[snapshot.id] = data.get("payload_hash")
+
+    writes = []
+    current = set()
+    unchanged = 0
     for entry in insights:
-        doc_id = f"{entry.get('insight_type')}_{entry.get('month', '')}_{entry.get('merchant', entry.get('category', 'unknown'))}"
-        fs_client.collection("receipt_insights").document(doc_id).set(entry)
+        doc_id = insight_doc_id(entry)
+        current.add(doc_id)
+        digest = payload_hash(entry)
+        if existing.get(doc_id) == digest:
+            unchanged += 1
+            continue
+        writes.append(("set", doc_id, {**entry, "payload_hash": digest}))
+    # e.g. merchants that dropped out of the top list
+    stale = [doc_id for doc_id in existing if doc_id not in current]
+    writes.extend(("delete", doc_id, None) for doc_id in stale)
+
+    def commit(chunk):
+        batch = fs_client.batch()
+        for op, doc_id, data in chunk:
+            ref = collection.document(doc_id)
+            if op == "set":
+                batch.set(ref, data)
+            else:
+                batch.delete(ref)
+        batch.commit()
 
-    print(f"✅ Uploaded {len(insights)} insights to Firestore.")
+    chunks = [writes[start:start + FIRESTORE_BATCH_LIMIT] for start in range(0, len(writes), FIRESTORE_BATCH_LIMIT)]
+    if chunks:
+        with ThreadPoolExecutor(max_workers=min(FIRESTORE_WRITE_WORKERS, len(chunks))) as pool:
+            list(pool.map(commit, chunks))
 
+    stats = {"written": len(writes) - len(stale), "unchanged": unchanged, "deleted": len(stale)}
+    print(f"✅ Published insights to Firestore: {stats} in {len(chunks)} batch(es).")
+    return stats
@@ -0,0 +1,164 @@
+import functools
+import hashlib
+import os
+import threading
+import time
+
+PROJECT_ID = "agenticai-467004"
+VERTEX_LOCATION = "us-central1"
+# vertex: Gemini on Vertex AI; fake: deterministic offline model (fake_model.py) for tests and benchmarks
+GEMINI_BACKEND = os.environ.get("GEMINI_BACKEND", "vertex")
+
+# Process-wide client registry: each client is built once per instance and reused by warm invocations
+_clients = {}
+_locks = {}
+_registry_lock = threading.Lock()
+_init_seconds = {}
+_process_started = time.monotonic()
+_first_request = True
+
+
+def get_client(name, factory):
+    client = _clients.get(name)
+    if client is not None:
+        return client
+    with _registry_lock:
+        lock = _locks.setdefault(name, threading.Lock())
+    # Per-name lock: a slow client build does not block lookups of the others
+    with lock:
+        client = _clients.get(name)
+        if client is None:
+            started = time.perf_counter()
+            client = factory()
+            _init_seconds[name] = time.perf_counter() - started
+            print(f"Initialized {name} client in {_init_seconds[name] * 1000:.1f} ms")
+            _clients[name] = client
+    return client
+
+
+def cold_start_report():
+    return {
+        "process_age_seconds": round(time.monotonic() - _process_started, 3),
+        "client_init_ms": {name: round(s * 1000, 1) for name, s in _init_seconds.items()},
+    }
+
+
+def track_cold_start(fn):
+    # Wraps an entry point; logs request time and client build times once, for the instance's first request
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        global _first_request
+        cold, _first_request = _first_request, False
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if cold:
+                report = cold_start_report()
+                report["first_request_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                print("Cold start:", report)
+    return wrapper
+
+
+# SDK imports live inside the factories: each module is loaded on first use, not at cold start
+
+def _storage_client():
+    from google.cloud import storage
+    return storage.Client()
+
+
+def _firestore_client():
+    from google.cloud import firestore
+    return firestore.Client()
+
+
+def _bigquery_client():
+    from google.cloud import bigquery
+    return bigquery.Client()
+
+
+def _publisher_client():
+    from google.cloud import pubsub_v1
+    # Publishes go out within 10 ms instead of the default batching delay
+    return pubsub_v1.PublisherClient(batch_settings=pubsub_v1.types.BatchSettings(max_latency=0.01))
+
+
+def _subscriber_client():
+    from google.cloud import pubsub_v1
+    return pubsub_v1.SubscriberClient()
+
+
+def _init_vertexai():
+    from vertexai import init as vertexai_init
+    vertexai_init(project=PROJECT_ID, location=VERTEX_LOCATION)
+    return True
+
+
+class TimedModel:
+    # GenerativeModel.generate_content takes no timeout, but the GAPIC call under it does: without one a
+    # hung request holds its scheduler slot until the connection drops. Everything else is passed through.
+    def __init__(self, model):
+        self.model = model
+
+    def generate_content(self, contents, timeout=None, **kwargs):
+        if timeout is None:
+            return self.model.generate_content(contents, **kwargs)
+        request = self.model._prepare_request(contents=contents, **kwargs)
+        response = self.model._prediction_client.generate_content(request=request, timeout=timeout)
+        return self.model._parse_response(response)
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+
+def _model(model_name, system_instruction=None):
+    if GEMINI_BACKEND == "fake":
+        from fake_model import FakeModel
+        return FakeModel(model_name, system_instruction=system_instruction)
+    get_client("vertexai", _init_vertexai)
+    from vertexai.preview.generative_models import GenerativeModel
+    return TimedModel(GenerativeModel(model_name, system_instruction=system_instruction))
+
+
+def get_storage():
+    return get_client("storage", _storage_client)
+
+
+def get_firestore():
+    return get_client("firestore", _firestore_client)
+
+
+def get_bigquery():
+    return get_client("bigquery", _bigquery_client)
+
+
+def get_publisher():
+    return get_client("pubsub_publisher", _publisher_client)
+
+
+def get_subscriber():
+    return get_client("pubsub_subscriber", _subscriber_client)
+
+
+def get_model(model_name, system_instruction=None):
+    # The system instruction is fixed when the model is built, so each one gets its own instance
+    name = f"model:{model_name}"
+    if system_instruction:
+        name += ":" + hashlib.sha256(system_instruction.encode("utf-8")).hexdigest()[:12]
+    return get_client(name, lambda: _model(model_name, system_instruction))
+
+
+def model_part(data, mime_type):
+    if GEMINI_BACKEND == "fake":
+        from fake_model import FakePart
+        return FakePart.from_data(data=data, mime_type=mime_type)
+    from vertexai.preview.generative_models import Part
+    return Part.from_data(data=data, mime_type=mime_type)
+
+
+def json_generation_config(schema):
+    # JSON mode constrained to schema: the model can only emit objects of this shape
+    if GEMINI_BACKEND == "fake":
+        return {"response_mime_type": "application/json", "response_schema": schema}
+    from vertexai.preview.generative_models import GenerationConfig
+    return GenerationConfig(response_mime_type="application/json", response_schema=schema)
@@ -1,36 +1,45 @@
-from vertexai import init as vertexai_init
-from vertexai.preview.generative_models import GenerativeModel
-from google.cloud import bigquery
+from clients import get_model, json_generation_config
 from datetime import datetime
+from receipt_parser import InferredFields, ReceiptParseError, coerce_object, parse_date, parse_model_output, parse_number, response_schema
+from scheduler import gemini_scheduler
+from sinks import get_sink
+from tracing import span
 import json
-import re
+import os
 
 
-# Initialize Vertex AI
-vertexai_init(project="agenticai-467004", location="us-central1")
-model = GenerativeModel("gemini-2.0-flash")
+# Vertex AI is initialized by the client registry on the first model call
+MODEL_NAME = "gemini-2.0-flash"
+
+ENRICHED_TABLE = "agenticai-467004.receipts.enriched_receipts"
+
+# split: deterministic fields locally + a small model call for the rest
+# combined: the extraction call also returns the inferred fields, so enrichment makes no model call
+ENRICHMENT_MODE = os.environ.get("ENRICHMENT_MODE", "split")
+INFERRED_FIELDS = ("merchant_category", "payment_method", "merchant_profile")
+# Per currency: Low below the first, High from the second. Receipts without a currency are mostly INR;
+# an unlisted currency gets no spend level rather than a wrong one.
+SPEND_LEVEL_THRESHOLDS = {
+    "INR": (500.0, 2000.0),
+    "USD": (50.0, 200.0),
+    "EUR": (50.0, 200.0),
+    "GBP": (40.0, 160.0),
+}
+DEFAULT_CURRENCY = os.environ.get("DEFAULT_CURRENCY", "INR")
+CURRENCY_SYMBOLS = {"₹": "INR", "RS": "INR", "RS.": "INR", "$": "USD", "€": "EUR", "£": "GBP"}
 
 def sanitize_dict(input_dict, allowed_keys):
     return {k: v for k, v in input_dict.items() if k in allowed_keys}
 
 def normalize_row_for_bigquery(raw):
-    merchant = raw.get("merchant", {})
-    if isinstance(merchant, str):
-        try:
-            merchant = json.loads(merchant)
-        except json.JSONDecodeError:
-            merchant = {}
-
-    merchant_profile = merchant.get("profile", {})
-    if isinstance(merchant_profile, str):
-        try:
-            merchant_profile = json.loads(merchant_profile)
-        except json.JSONDecodeError:
-            merchant_profile = {}
+    # Nested fields may arrive as (possibly malformed) JSON strings
+    merchant = coerce_object(raw.get("merchant")) or {}
+    merchant_profile = coerce_object(merchant.get("profile")) or {}
 
     clean = {
         "receipt_id": raw.get("receipt_id"),
         "user_id": raw.get("user_id"),
+        "trace_id": raw.get("trace_id"),
         "merchant_name": merchant.get("name") or raw.get("merchant_name"),
         "merchant_category": merchant.get("category") or raw.get("merchant_category"),
         "merchant_profile": raw.get("merchant_profile", {
@@ -43,6 +52,7 @@ def normalize_row_for_bigquery(raw):
         "payment_method": raw.get("payment_method"),
         "phone": raw.get("phone"),
         "purchase_date": raw.get("purchase_date") or raw.get("date"),
+        "day_of_week": raw.get("day_of_week"),
         "timestamp": raw.get("timestamp"),
         "ingestion_timestamp": raw.get("ingestion_timestamp"),
         "enriched_timestamp": raw.get("enriched_timestamp"),
@@ -58,11 +68,9 @@ def normalize_row_for_bigquery(raw):
     clean["merchant_profile"] = sanitize_dict(merchant_profile, {"website", "country", "tags"})
 
     for item in raw.get("items", []):
-        if isinstance(item, str):
-            try:
-                item = json.loads(item)
-            except json.JSONDecodeError:
-                continue  # skip invalid entries
+        item = coerce_object(item)
+        if item is None:
+            continue  # skip invalid entries
         clean["items"].append({
             "item_name": item.get("item_name") or item.get("name"),
             "quantity": item.get("quantity") or item.get("qty"),
@@ -72,58 +80,136 @@ def normalize_row_for_bigquery(raw):
     return clean
 
 
-def enrich_receipt(raw_receipt: dict) -> dict:
-    prompt = """
+ENRICHMENT_PROMPT = """
     You are an intelligent agent that enriches receipt data to support smarter financial decision-making.
 
-    Given the raw receipt JSON, return an enriched version with these additional fields:
-    - day_of_week
+    Given the raw receipt JSON, return a JSON object with ONLY these fields:
     - merchant_category
     - payment_method (if you can infer it)
-    - user_spend_level (Low/Medium/High based on total)
-    - actions_suggested (JSON list with action type, reason, and confidence)
-    - location (mock or inferred from store_address if possible)
-    - merchant_profile (mocked with rating, verified, maps_url)
+    - merchant_profile (object with website, country and tags inferred from the merchant)
 
     ❗ Format: Return ONLY valid JSON. No markdown, no code blocks.
     ❗ Do NOT include comments or explanations.
     ❗ Return valid JSON that can be parsed using json.loads().
     """
 
-    raw_json_str = json.dumps(raw_receipt)
-    result = model.generate_content([prompt, raw_json_str])
-    output = result.text.strip()
+# Structured output: the instructions go in as the system instruction and the reply is constrained to
+# the InferredFields schema (GEMINI_STRUCTURED_OUTPUT=false sends ENRICHMENT_PROMPT instead)
+STRUCTURED_OUTPUT = os.environ.get("GEMINI_STRUCTURED_OUTPUT", "true").lower() == "true"
+ENRICHMENT_INSTRUCTIONS = """
+    You are an intelligent agent that enriches receipt data to support smarter financial decision-making.
+    Given a summary of a receipt, infer the merchant category, the payment method (if you can)
+    and a merchant profile with website, country and tags.
+    """
+ENRICHMENT_SCHEMA = response_schema(InferredFields)
+
+# Appended to the extraction prompt in combined mode so one model call returns both
+COMBINED_PROMPT_SUFFIX = """
+        Also include these enrichment fields in the same JSON object:
+        "merchant_category": "Business category of the merchant",
+        "payment_method": "Cash / Card / UPI / etc. (if found or inferable)",
+        "merchant_profile": {"website": "...", "country": "...", "tags": ["..."]}
+        """
+
+def to_float(value):
+    return parse_number(value)
+
+def spend_level(total, currency=None):
+    total = to_float(total)
+    code = str(currency or DEFAULT_CURRENCY).strip().upper()
+    thresholds = SPEND_LEVEL_THRESHOLDS.get(CURRENCY_SYMBOLS.get(code, code))
+    if total is None or thresholds is None:
+        return None
+    if total < thresholds[0]:
+        return "Low"
+    if total < thresholds[1]:
+        return "Medium"
+    return "High"
+
+def compute_deterministic_fields(raw_receipt: dict) -> dict:
+    # Everything that can be derived from the extracted receipt without a model call
+    purchase_date = parse_date(raw_receipt.get("date"))
+    merchant = raw_receipt.get("merchant")
+    return {
+        "receipt_id": raw_receipt.get("receipt_id"),
+        "user_id": raw_receipt.get("user_id"),
+        "trace_id": raw_receipt.get("trace_id"),
+        "merchant_name": merchant if isinstance(merchant, str) else raw_receipt.get("merchant_name"),
+        "amount": to_float(raw_receipt.get("total")),
+        "currency": raw_receipt.get("currency"),
+        "phone": raw_receipt.get("phone"),
+        "purchase_date": purchase_date.isoformat() if purchase_date else None,
+        "day_of_week": purchase_date.strftime("%A") if purchase_date else None,
+        "timestamp": raw_receipt.get("timestamp"),
+        "ingestion_timestamp": raw_receipt.get("timestamp"),
+        "subscription": raw_receipt.get("is_subscription"),
+        "user_spend_level": spend_level(raw_receipt.get("total"), raw_receipt.get("currency")),
+        "category": raw_receipt.get("category"),
+        "store_address": raw_receipt.get("store_address"),
+        "items": raw_receipt.get("items", []),
+    }
 
-    if output.startswith("```"):
-        output = re.sub(r"```json|```", "", output).strip()
+def infer_fields(raw_receipt: dict) -> dict:
+    # Only the genuinely inferential fields go to the model
+    context = {k: raw_receipt.get(k) for k in ("merchant", "store_address", "category", "currency", "total")}
+    context["items"] = [item.get("name") for item in raw_receipt.get("items", []) if isinstance(item, dict)]
+    with span("gemini.enrich"):
+        if STRUCTURED_OUTPUT:
+            model = get_model(MODEL_NAME, system_instruction=ENRICHMENT_INSTRUCTIONS)
+            result = gemini_scheduler.call(model.generate_content, [json.dumps(context)],
+                                           generation_config=json_generation_config(ENRICHMENT_SCHEMA))
+        else:
+            result = gemini_scheduler.call(get_model(MODEL_NAME).generate_content, [ENRICHMENT_PROMPT, json.dumps(context)])
 
     try:
-        enriched = json.loads(output)
-        enriched["receipt_id"] = raw_receipt.get("receipt_id")
-        enriched["enriched_timestamp"] = datetime.utcnow().isoformat()
-        if isinstance(enriched, str):
-            try:
-                enriched = json.loads(enriched)
-            except json.JSONDecodeError:
-                print("❌ Invalid JSON string passed to enrich_and_push")
-                return
-        return normalize_row_for_bigquery(enriched)
-    except json.JSONDecodeError as e:
+        inferred, field_errors, _ = parse_model_output(result.text, InferredFields)
+    except ReceiptParseError:
         print("Gemini failed to return valid JSON.")
-        print("Raw output:", output)
-        raise e
+        print("Raw output:", result.text)
+        raise
+    if field_errors:
+        print("Dropped invalid enrichment fields:", field_errors)
+    return {k: inferred.get(k) for k in INFERRED_FIELDS}
 
-def push_to_bigquery(enriched_receipt: dict):
-    client = bigquery.Client()
-    table_id = "agenticai-467004.receipts.enriched_receipts"
-    errors = client.insert_rows_json(table_id, [enriched_receipt])
+def enrich_receipt(raw_receipt: dict) -> dict:
+    enriched = compute_deterministic_fields(raw_receipt)
+
+    # Combined mode already returned the inferred fields with the extraction
+    if any(raw_receipt.get(k) is not None for k in INFERRED_FIELDS):
+        inferred = {k: raw_receipt.get(k) for k in INFERRED_FIELDS}
+    else:
+        inferred = infer_fields(raw_receipt)
+
+    profile = inferred.get("merchant_profile")
+    enriched["merchant"] = {
+        "name": enriched["merchant_name"],
+        "category": inferred.get("merchant_category"),
+        "profile": profile if isinstance(profile, (dict, str)) else {},
+    }
+    enriched["payment_method"] = inferred.get("payment_method")
+    enriched["enriched_timestamp"] = datetime.utcnow().isoformat()
+    return normalize_row_for_bigquery(enriched)
+
+def push_to_bigquery(enriched_receipt: dict, row_id=None):
+    errors = get_sink(ENRICHED_TABLE).write([enriched_receipt], keys=[row_id] if row_id else None)
     if errors:
         print("BigQuery insertion failed:", errors)
         raise Exception("Failed to insert enriched receipt")
     else:
         print("Enriched receipt inserted to BigQuery successfully.")
 
-def enrich_and_push(raw_receipt):
+def push_rows_to_bigquery(enriched_rows: list, row_ids=None) -> dict:
+    # One multi-row write through the sink; returns {row_index: errors} for failed rows
+    if not enriched_rows:
+        return {}
+    errors = get_sink(ENRICHED_TABLE).write(enriched_rows, keys=row_ids)
+    if errors:
+        print("BigQuery insertion failed:", errors)
+    else:
+        print(f"Wrote {len(enriched_rows)} enriched receipts to BigQuery.")
+    return errors
+
+def enrich_and_push(raw_receipt, row_id=None):
     if isinstance(raw_receipt, str):
         try:
             raw_receipt = json.loads(raw_receipt)
@@ -132,4 +218,4 @@ def enrich_and_push(raw_receipt):
             return
 
     enriched = enrich_receipt(raw_receipt)
-    push_to_bigquery(enriched)
+    push_to_bigquery(enriched, row_id=row_id)
@@ -0,0 +1,170 @@
+import json
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from clients import PROJECT_ID, get_publisher, get_subscriber
+from enrich_receipt import enrich_receipt, push_rows_to_bigquery
+from tracing import bind, span, trace_context
+
+# inline: process_receipt enriches before returning (one failure domain, as before)
+# pubsub: receipts are published to ENRICHMENT_TOPIC and enriched by enrich_receipt_message / enrich_receipt_worker
+# local: an in-process queue and worker thread (tests, benchmarks, single-instance runs); lost if the instance stops
+ENRICHMENT_DISPATCH = os.environ.get("ENRICHMENT_DISPATCH", "inline")
+ENRICHMENT_TOPIC = os.environ.get("ENRICHMENT_TOPIC", "receipt-enrichment")
+# Redelivery backoff and the dead-letter topic are set on the subscription, not here; its ack deadline
+# must cover a whole pulled batch (ENRICH_BATCH_SIZE receipts at ENRICH_WORKERS concurrency)
+ENRICHMENT_SUBSCRIPTION = os.environ.get("ENRICHMENT_SUBSCRIPTION", "receipt-enrichment-worker")
+ENRICH_BATCH_SIZE = int(os.environ.get("ENRICH_BATCH_SIZE", "50"))
+ENRICH_BATCH_WAIT_MS = int(os.environ.get("ENRICH_BATCH_WAIT_MS", "500"))
+ENRICH_WORKERS = int(os.environ.get("ENRICH_WORKERS", "8"))
+ENRICH_MAX_ATTEMPTS = int(os.environ.get("ENRICH_MAX_ATTEMPTS", "3"))
+ENRICH_BACKOFF_BASE_S = float(os.environ.get("ENRICH_BACKOFF_BASE_S", "0.5"))
+
+
+def enrichment_task(receipt_json, row_id=None):
+    # What travels on the queue: the stored raw receipt and its row key, so retries stay idempotent
+    return {"receipt": receipt_json, "row_id": row_id, "trace_id": receipt_json.get("trace_id")}
+
+
+def _enrich_with_retry(task):
+    # Gemini quota errors are already retried by the scheduler; this covers the rest (bad output etc.)
+    for attempt in range(ENRICH_MAX_ATTEMPTS):
+        try:
+            with trace_context(task.get("trace_id")):
+                return enrich_receipt(task["receipt"])
+        except Exception as e:
+            if attempt + 1 == ENRICH_MAX_ATTEMPTS:
+                raise
+            delay = random.uniform(0, ENRICH_BACKOFF_BASE_S * 2 ** attempt)
+            print(f"⚠️ Enrichment of {task.get('row_id')} failed ({e}), retry {attempt + 1} in {delay:.2f}s")
+            time.sleep(delay)
+
+
+def enrich_batch(tasks, max_workers=ENRICH_WORKERS):
+    # Enriches concurrently, then writes all rows at once. Returns one error per task (None when it succeeded).
+    errors = [None] * len(tasks)
+    if not tasks:
+        return errors
+
+    def run(i):
+        try:
+            return _enrich_with_retry(tasks[i])
+        except Exception as e:
+            errors[i] = f"enrich: {e}"
+        return None
+
+    with span("enrich_batch", tasks=len(tasks)) as attrs:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tasks)))) as pool:
+            rows = list(pool.map(bind(run), range(len(tasks))))
+        ok = [i for i, row in enumerate(rows) if row is not None]
+        try:
+            row_errors = push_rows_to_bigquery([rows[i] for i in ok], row_ids=[tasks[i].get("row_id") for i in ok])
+        except Exception as e:
+            row_errors = {n: e for n in range(len(ok))}
+        for n, i in enumerate(ok):
+            if n in row_errors:
+                errors[i] = f"bigquery: {row_errors[n]}"
+        attrs["failed"] = sum(1 for error in errors if error)
+    return errors
+
+
+class LocalQueue:
+    def __init__(self, batch_size=ENRICH_BATCH_SIZE, batch_wait_ms=ENRICH_BATCH_WAIT_MS):
+        self.batch_size = batch_size
+        self.batch_wait_ms = batch_wait_ms
+        self.queue = queue.Queue()
+        self.failed = []  # (task, error) after all attempts: the local dead-letter list
+        self.worker = None
+        self.lock = threading.Lock()
+
+    def publish(self, tasks):
+        for task in tasks:
+            self.queue.put(task)
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._work, name="enrichment-worker", daemon=True)
+                self.worker.start()
+
+    def _next_batch(self):
+        # Blocks for the first task, then waits at most batch_wait_ms to fill the batch
+        tasks = [self.queue.get()]
+        deadline = time.monotonic() + self.batch_wait_ms / 1000
+        while len(tasks) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                tasks.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return tasks
+
+    def _work(self):
+        while True:
+            tasks = self._next_batch()
+            try:
+                errors = enrich_batch(tasks)
+            except Exception as e:
+                errors = [str(e)] * len(tasks)
+            for task, error in zip(tasks, errors):
+                if error:
+                    print(f"❌ Enrichment of {task.get('row_id')} failed: {error}")
+                    self.failed.append((task, error))
+                self.queue.task_done()
+
+    def join(self):
+        # Waits until everything published so far has been enriched (or has failed)
+        self.queue.join()
+
+    def stats(self):
+        return {"pending": self.queue.unfinished_tasks, "failed": len(self.failed)}
+
+
+class PubSubQueue:
+    def __init__(self, topic=ENRICHMENT_TOPIC, subscription=ENRICHMENT_SUBSCRIPTION):
+        self.topic_path = f"projects/{PROJECT_ID}/topics/{topic}"
+        self.subscription_path = f"projects/{PROJECT_ID}/subscriptions/{subscription}"
+
+    def publish(self, tasks):
+        publisher = get_publisher()
+        futures = [publisher.publish(self.topic_path, json.dumps(task, default=str).encode("utf-8"),
+                                     trace_id=task.get("trace_id") or "")
+                   for task in tasks]
+        # Wait for the acks: the instance may be frozen right after responding, losing unsent messages
+        for future in futures:
+            future.result(timeout=60)
+
+    def pull(self, max_messages=ENRICH_BATCH_SIZE):
+        # Returns [(ack_id, task)]; an empty list when nothing is waiting
+        response = get_subscriber().pull(
+            request={"subscription": self.subscription_path, "max_messages": max_messages}, timeout=30)
+        return [(m.ack_id, json.loads(m.message.data)) for m in response.received_messages]
+
+    def ack(self, ack_ids):
+        if ack_ids:
+            get_subscriber().acknowledge(request={"subscription": self.subscription_path, "ack_ids": ack_ids})
+
+    def nack(self, ack_ids):
+        # Deadline 0 hands the messages back for redelivery (with the subscription's backoff)
+        if ack_ids:
+            get_subscriber().modify_ack_deadline(
+                request={"subscription": self.subscription_path, "ack_ids": ack_ids, "ack_deadline_seconds": 0})
+
+    def stats(self):
+        return {"topic": self.topic_path}
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_enrichment_queue():
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = LocalQueue() if ENRICHMENT_DISPATCH == "local" else PubSubQueue()
+    return _queue
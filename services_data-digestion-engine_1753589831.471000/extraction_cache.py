@@ -0,0 +1,200 @@
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from clients import get_firestore
+
+# Cache settings
+CACHE_BACKEND = os.environ.get("EXTRACTION_CACHE_BACKEND", "memory")  # memory / sqlite / firestore / none
+CACHE_TTL_SECONDS = int(os.environ.get("EXTRACTION_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+CACHE_MAX_ENTRIES = int(os.environ.get("EXTRACTION_CACHE_MAX_ENTRIES", "2048"))
+CACHE_SQLITE_PATH = os.environ.get("EXTRACTION_CACHE_SQLITE_PATH", "/tmp/extraction_cache.sqlite3")
+CACHE_COLLECTION = os.environ.get("EXTRACTION_CACHE_COLLECTION", "extraction_cache")
+
+
+def cache_key(file_bytes, model_name, prompt):
+    # Same bytes under the same model + prompt always produce the same key
+    version = hashlib.sha256(f"{model_name}\n{prompt}".encode("utf-8")).hexdigest()
+    digest = hashlib.sha256(file_bytes)
+    digest.update(version.encode("ascii"))
+    return digest.hexdigest()
+
+
+class LRUBackend:
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.time() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class SQLiteBackend:
+    def __init__(self, path=CACHE_SQLITE_PATH, max_entries=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS extraction_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, stored_at FROM extraction_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl_seconds:
+                self._conn.execute("DELETE FROM extraction_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE extraction_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO extraction_cache (key, value, stored_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            # Evict expired entries first, then least recently used ones over the size cap
+            self._conn.execute("DELETE FROM extraction_cache WHERE stored_at < ?", (now - self.ttl_seconds,))
+            self._conn.execute(
+                "DELETE FROM extraction_cache WHERE key IN ("
+                "SELECT key FROM extraction_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+
+class FirestoreBackend:
+    # Size is bounded by a Firestore TTL policy on `expires_at`; reads also honour the TTL
+    def __init__(self, collection=CACHE_COLLECTION, ttl_seconds=CACHE_TTL_SECONDS, client=None):
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+        self._client = client
+
+    def _collection(self):
+        client = self._client or get_firestore()
+        return client.collection(self.collection)
+
+    def get(self, key):
+        snapshot = self._collection().document(key).get()
+        if not snapshot.exists:
+            return None
+        data = snapshot.to_dict()
+        expires_at = data.get("expires_at")
+        if expires_at is not None and expires_at < datetime.now(timezone.utc):
+            return None
+        return json.loads(data["value"])
+
+    def put(self, key, value):
+        now = datetime.now(timezone.utc)
+        self._collection().document(key).set({
+            "value": json.dumps(value),
+            "stored_at": now,
+            "expires_at": now + timedelta(seconds=self.ttl_seconds),
+        })
+
+
+class ExtractionCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.model_calls = 0
+        self.model_seconds = 0.0  # time spent in the model on misses
+
+    def get(self, key):
+        if self.backend is None:
+            return None
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            print("⚠️ Extraction cache read failed:", e)
+            with self._lock:
+                self.errors += 1
+            return None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        # Callers mutate the receipt before writing it out, so never hand out the cached object
+        return copy.deepcopy(value)
+
+    def put(self, key, value, model_seconds=0.0):
+        with self._lock:
+            self.model_calls += 1
+            self.model_seconds += model_seconds
+        if self.backend is None:
+            return
+        try:
+            self.backend.put(key, copy.deepcopy(value))
+        except Exception as e:
+            print("⚠️ Extraction cache write failed:", e)
+            with self._lock:
+                self.errors += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            avg_model_seconds = self.model_seconds / self.model_calls if self.model_calls else 0.0
+            return {
+                "backend": type(self.backend).__name__ if self.backend else "none",
+                "hits": self.hits,
+                "misses": self.misses,
+                "errors": self.errors,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "model_calls_saved": self.hits,
+                "model_seconds_saved": round(self.hits * avg_model_seconds, 3),
+            }
+
+
+def make_backend(name=CACHE_BACKEND):
+    if name == "memory":
+        return LRUBackend()
+    if name == "sqlite":
+        return SQLiteBackend()
+    if name == "firestore":
+        return FirestoreBackend()
+    if name == "none":
+        return None
+    raise ValueError(f"Unknown extraction cache backend: {name}")
+
+
+# One cache per process so warm instances keep their entries between invocations
+extraction_cache = ExtractionCache(make_backend())
@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+import random
+import time
+from types import SimpleNamespace
+
+from receipt_parser import Receipt, response_schema
+
+# Offline stand-in for the Gemini model (GEMINI_BACKEND=fake): answers with deterministic,
+# schema-shaped JSON derived from the request, so the pipeline runs without Vertex AI
+FAKE_MODEL_LATENCY_MS = float(os.environ.get("FAKE_MODEL_LATENCY_MS", "0"))
+
+MERCHANTS = ["Corner Cafe", "FreshMart", "City Pharmacy", "Metro Fuel", "Book Nook"]
+ITEM_NAMES = ["Tea", "Coffee", "Bread", "Milk", "Paracetamol", "Diesel", "Notebook", "Rice 5kg"]
+STRING_VALUES = {
+    "merchant": MERCHANTS,
+    "name": ITEM_NAMES,
+    "category": ["Grocery", "Dining", "Travel", "Medicine", "Utility"],
+    "merchant_category": ["Restaurant", "Supermarket", "Pharmacy", "Fuel Station"],
+    "payment_method": ["Cash", "Card", "UPI"],
+    "currency": ["INR"],
+    "country": ["India"],
+    "time": ["09:41 AM", "01:15 PM", "07:30 PM"],
+}
+
+
+class FakePart:
+    def __init__(self, data, mime_type):
+        self.data = data
+        self.mime_type = mime_type
+
+    @staticmethod
+    def from_data(data, mime_type):
+        return FakePart(data, mime_type)
+
+
+def fake_value(name, schema, rng):
+    kind = schema.get("type")
+    if kind == "object":
+        return {key: fake_value(key, sub, rng) for key, sub in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [fake_value(name, schema.get("items", {}), rng) for _ in range(rng.randint(1, 5))]
+    if kind == "number":
+        return 1.0 if name == "qty" else round(rng.uniform(1, 60), 2)
+    if kind == "integer":
+        return rng.randint(1, 5)
+    if kind == "boolean":
+        return rng.random() < 0.1
+    if name == "date":
+        return f"{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}-2025"
+    if name == "receipt_id":
+        return f"INV-{rng.randint(1000, 9999)}"
+    return rng.choice(STRING_VALUES.get(name, [f"{name}-{rng.randint(1, 99)}"]))
+
+
+def _content_digest(contents):
+    digest = hashlib.sha256()
+    for part in contents if isinstance(contents, list) else [contents]:
+        data = part.data if isinstance(part, FakePart) else part
+        digest.update(data if isinstance(data, bytes) else str(data).encode("utf-8"))
+    return digest.digest()
+
+
+class FakeModel:
+    def __init__(self, model_name, system_instruction=None):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.calls = 0
+
+    def generate_content(self, contents, generation_config=None, **kwargs):
+        self.calls += 1
+        if FAKE_MODEL_LATENCY_MS:
+            time.sleep(FAKE_MODEL_LATENCY_MS / 1000)
+        # Same request, same answer: keeps cache and dedupe behaviour realistic
+        rng = random.Random(_content_digest(contents))
+        schema = (generation_config or {}).get("response_schema") or response_schema(Receipt)
+        data = fake_value("", schema, rng)
+        if isinstance(data.get("items"), list) and "total" in data:
+            data["total"] = round(sum(item.get("price", 0) for item in data["items"]), 2)
+        text = json.dumps(data)
+        prompt_chars = len(self.system_instruction or "") + sum(
+            len(p.data) if isinstance(p, FakePart) else len(str(p)) for p in contents)
+        return SimpleNamespace(text=text, usage_metadata=SimpleNamespace(
+            prompt_token_count=prompt_chars // 4,
+            candidates_token_count=len(text) // 4,
+        ))
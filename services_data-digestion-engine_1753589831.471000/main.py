@@ -1,86 +1,44 @@
+import base64
 import functions_framework
 import os
 import tempfile
+import time
 import json
-import re
-import cv2
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from google.cloud import storage, firestore, bigquery
-from vertexai import init as vertexai_init
-from vertexai.preview.generative_models import GenerativeModel, Part
-from enrich_receipt import enrich_and_push
+from clients import get_firestore, get_model, get_storage, json_generation_config, model_part, track_cold_start
+from enrich_receipt import enrich_and_push, enrich_receipt, push_rows_to_bigquery as push_enriched_rows
+from enrich_receipt import COMBINED_PROMPT_SUFFIX, ENRICHMENT_MODE, INFERRED_FIELDS
+from enrichment_queue import ENRICHMENT_DISPATCH, ENRICH_BATCH_SIZE, enrich_batch, enrichment_task, get_enrichment_queue
+from extraction_cache import cache_key, extraction_cache
+from preprocess import PREPROCESS_ENABLED, PREPROCESS_VERSION, prepare_html, prepare_image, prepare_pdf
+from receipt_parser import Receipt, ReceiptParseError, parse_date, parse_model_output, parse_number, response_schema
+from scheduler import gemini_scheduler
+from sinks import get_sink, sink_stats
+from templates import learn_templates, match_template, template_stats
+from tracing import bind, new_trace_id, span, trace_context
 
-# Initialize Vertex AI (at runtime only)
-vertexai_init(project="agenticai-467004", location="us-central1")
+RAW_RECEIPTS_TABLE = "agenticai-467004.receipts.raw_receipts"
+MODEL_NAME = "gemini-2.0-flash"
+# Service state (e.g. the Gmail sync historyId) is not a receipt, even when it shares the upload bucket
+SKIP_PREFIXES = ("state/",)
 
-def is_video_file(file_name):
-    return file_name.lower().endswith((".mp4", ".mov", ".avi", ".mkv"))
-
-def extract_frames_from_video(video_path, timestamps=[1.0, 2.5, 4.0]):
-    cap = cv2.VideoCapture(video_path)
-    frames = []
-    for ts in timestamps:
-        cap.set(cv2.CAP_PROP_POS_MSEC, ts * 1000)
-        success, frame = cap.read()
-        if success:
-            _, buffer = cv2.imencode('.jpg', frame)
-            frames.append(buffer.tobytes())
-        else:
-            print(f"Failed to extract frame at {ts}s")
-    cap.release()
-    return frames
-
-def push_to_bigquery(receipt_json):
-    bq = bigquery.Client()
-    table_id = "agenticai-467004.receipts.raw_receipts"
-
-    # Add ingestion timestamp
-    receipt_json["timestamp"] = datetime.utcnow().isoformat()
-
-    # Normalize item fields
-    if "items" in receipt_json:
-        for item in receipt_json["items"]:
-            item["qty"] = float(item.get("qty", 1))
-            item["price"] = float(item.get("price", 0))
-
-    # Normalize date
-    if "date" in receipt_json:
-        try:
-            receipt_json["date"] = datetime.strptime(receipt_json["date"], "%m-%d-%Y").date().isoformat()
-        except Exception:
-            receipt_json["date"] = None
-
-    # Push
-    errors = bq.insert_rows_json(table_id, [receipt_json])
-    if errors:
-        print("BigQuery errors:", errors)
-    else:
-        print("Inserted into BigQuery:", receipt_json.get("receipt_id", "no_id"))
+# Batch ingestion settings
+MAX_BATCH_WORKERS = int(os.environ.get("MAX_BATCH_WORKERS", "8"))
+MAX_BATCH_ITEMS = int(os.environ.get("MAX_BATCH_ITEMS", "200"))
+FIRESTORE_BATCH_LIMIT = 500  # hard limit on writes per Firestore batch
 
-@functions_framework.cloud_event
-def process_receipt(cloud_event):
-    try:
-        bucket_name = cloud_event.data["bucket"]
-        file_name = cloud_event.data["name"]
-        print(f"Received file: {file_name} from bucket: {bucket_name}")
-
-        # Download
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(file_name)
-        with tempfile.NamedTemporaryFile(delete=False) as tmp:
-            blob.download_to_filename(tmp.name)
-            temp_path = tmp.name
+# Download limits
+MAX_FILE_BYTES = int(os.environ.get("MAX_FILE_BYTES", str(20 * 1024 * 1024)))  # inline request limit for Gemini
+MAX_VIDEO_BYTES = int(os.environ.get("MAX_VIDEO_BYTES", str(200 * 1024 * 1024)))
+VIDEO_PREFIX_BYTES = int(os.environ.get("VIDEO_PREFIX_BYTES", str(8 * 1024 * 1024)))
 
-        # Read bytes
-        with open(temp_path, "rb") as f:
-            file_bytes = f.read()
-
-        # Gemini model
-        gemini = GenerativeModel("gemini-2.0-flash")
-        db = firestore.Client()
+# The declared type is a fallback: preprocessing sniffs the real one from the bytes
+IMAGE_TYPES_BY_EXTENSION = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png",
+                            ".webp": "image/webp", ".heic": "image/heic"}
+IMAGE_TYPES = tuple(IMAGE_TYPES_BY_EXTENSION)
 
-        prompt = """
+EXTRACTION_PROMPT = """
         You are an AI system extracting structured financial data from receipts.
 
         Extract all details from the receipt and return only a **valid JSON** object in the following format:
@@ -116,56 +74,514 @@ def process_receipt(cloud_event):
         - if total field is not available in the receipt, populate total by adding the price of all items
         """
 
-        # File Type Handling
-        if file_name.lower().endswith(".pdf"):
-            part = Part.from_data(data=file_bytes, mime_type="application/pdf")
-            result = gemini.generate_content([prompt, part])
+# Single-pass mode: extraction also returns the enrichment fields, so enrich_receipt skips its model call
+if ENRICHMENT_MODE == "combined":
+    EXTRACTION_PROMPT += COMBINED_PROMPT_SUFFIX
 
-        elif file_name.lower().endswith((".jpg", ".jpeg", ".png")):
-            part = Part.from_data(data=file_bytes, mime_type="image/png")
-            result = gemini.generate_content([prompt, part])
+# Structured output: the field list lives in a response schema derived from receipt_parser.Receipt and
+# the model is constrained to it, so the static instructions shrink to a short system instruction.
+# GEMINI_STRUCTURED_OUTPUT=false falls back to the free-text EXTRACTION_PROMPT.
+STRUCTURED_OUTPUT = os.environ.get("GEMINI_STRUCTURED_OUTPUT", "true").lower() == "true"
+EXTRACTION_INSTRUCTIONS = """
+        You are an AI system extracting structured financial data from receipts.
+        Extract all details from the receipt into the response schema.
+        - If the input is in a language other than English, give the output in English.
+        - If a field is not on the receipt, leave it out; never use placeholder text.
+        """
+if ENRICHMENT_MODE == "combined":
+    EXTRACTION_INSTRUCTIONS += "        - Also infer the merchant category, payment method and merchant profile.\n"
+EXTRACTION_SCHEMA = response_schema(Receipt, exclude=() if ENRICHMENT_MODE == "combined" else INFERRED_FIELDS)
 
-        elif file_name.lower().endswith(".html"):
-            html_text = file_bytes.decode("utf-8")
-            result = gemini.generate_content([prompt, html_text])
+# Part of the extraction cache key: changing the prompt or schema invalidates cached extractions
+if STRUCTURED_OUTPUT:
+    EXTRACTION_VERSION = EXTRACTION_INSTRUCTIONS + json.dumps(EXTRACTION_SCHEMA, sort_keys=True)
+else:
+    EXTRACTION_VERSION = EXTRACTION_PROMPT
+if PREPROCESS_ENABLED:
+    EXTRACTION_VERSION += f"preprocess:{PREPROCESS_VERSION}"
+
+
+class UnsupportedFileType(ValueError):
+    pass
+
+
+class FileTooLarge(ValueError):
+    pass
+
+
+def download_bytes(blob, max_bytes):
+    # `end` is inclusive, so one byte past the cap tells us the object is too large
+    data = blob.download_as_bytes(start=0, end=max_bytes)
+    if len(data) > max_bytes:
+        raise FileTooLarge(f"{blob.name} exceeds {max_bytes} bytes")
+    return data
+
+def is_video_file(file_name):
+    return file_name.lower().endswith((".mp4", ".mov", ".avi", ".mkv"))
+
+def is_supported_file(file_name):
+    return file_name.lower().endswith(IMAGE_TYPES + (".pdf", ".html")) or is_video_file(file_name)
+
+def extract_frames_from_video(video_path):
+    # Single sequential pass that keeps the sharpest distinct frames, downscaled for the model.
+    # Returns (frames, complete): complete is False when the file stopped decoding before its stated end.
+    # cv2 is only needed for video receipts, so it is imported on first use.
+    from video_frames import sample_frames
+    scan = {}
+    frames = sample_frames(video_path, scan=scan)
+    print(f"Sampled {len(frames)} frame(s), {sum(len(f) for f in frames)} bytes")
+    return frames, not scan.get("incomplete")
+
+def extract_frames_from_blob(blob, file_name):
+    # cv2 needs a file path; the temp file is removed when the block exits, on success or failure
+    suffix = os.path.splitext(file_name)[1]
+    with tempfile.NamedTemporaryFile(suffix=suffix) as tmp:
+        # Clips encoded with the index up front decode from just the first few MB
+        prefix_end = VIDEO_PREFIX_BYTES - 1
+        if blob.size is not None:
+            prefix_end = min(prefix_end, blob.size - 1)
+        blob.download_to_file(tmp, start=0, end=prefix_end)
+        tmp.flush()
+        frames, complete = extract_frames_from_video(tmp.name)
+
+        # Otherwise append the rest of the object and retry: with the moov atom at the end nothing decodes,
+        # and a faststart clip longer than the prefix decodes only up to the cut (the frame there may be damaged)
+        if (not frames or not complete) and (blob.size is None or prefix_end < blob.size - 1):
+            print(f"Prefix of {file_name} was not enough ({len(frames)} frame(s), complete={complete}), "
+                  f"downloading the rest")
+            blob.download_to_file(tmp, start=prefix_end + 1)
+            tmp.flush()
+            frames, _ = extract_frames_from_video(tmp.name)
+    return frames
+
+def prepare_bigquery_row(receipt_json):
+    # Add ingestion timestamp
+    receipt_json["timestamp"] = datetime.utcnow().isoformat()
+
+    # Fresh extractions are already coerced by receipt_parser; this covers older cached receipts
+    if "items" in receipt_json:
+        for item in receipt_json["items"]:
+            item["qty"] = parse_number(item.get("qty"), 1.0)
+            item["price"] = parse_number(item.get("price"), 0.0)
+
+    # Normalize date
+    if "date" in receipt_json:
+        parsed_date = parse_date(receipt_json["date"])
+        receipt_json["date"] = parsed_date.isoformat() if parsed_date else None
+
+    # Enrichment fields from combined mode belong to enriched_receipts, not raw_receipts
+    return {k: v for k, v in receipt_json.items() if k not in INFERRED_FIELDS}
+
+def push_to_bigquery(receipt_json, row_id=None):
+    row = prepare_bigquery_row(receipt_json)
+
+    # Push (row_id lets BigQuery drop redelivered duplicates)
+    errors = get_sink(RAW_RECEIPTS_TABLE).write([row], keys=[row_id] if row_id else None)
+    if errors:
+        print("BigQuery errors:", errors)
+    else:
+        print("Inserted into BigQuery:", receipt_json.get("receipt_id", "no_id"))
+
+def push_rows_to_bigquery(rows, row_ids=None):
+    # One multi-row write through the sink; returns {row_index: errors} for failed rows
+    errors = get_sink(RAW_RECEIPTS_TABLE).write(rows, keys=row_ids)
+    if errors:
+        print("BigQuery errors:", errors)
+    return errors
+
+def extraction_model():
+    if STRUCTURED_OUTPUT:
+        return get_model(MODEL_NAME, system_instruction=EXTRACTION_INSTRUCTIONS)
+    return get_model(MODEL_NAME)
 
-        elif is_video_file(file_name):
-            print("Extracting from video...")
-            frames = extract_frames_from_video(temp_path)
-            parts = [Part.from_data(data=frame, mime_type="image/jpeg") for frame in frames]
-            result = gemini.generate_content([prompt] + parts)
+def generate_extraction(gemini, contents):
+    with span("gemini.extract", parts=len(contents)) as attrs:
+        result = _generate_extraction(gemini, contents)
+        usage = getattr(result, "usage_metadata", None)
+        if usage is not None:
+            attrs["prompt_tokens"] = getattr(usage, "prompt_token_count", None)
+            attrs["output_tokens"] = getattr(usage, "candidates_token_count", None)
+        return result
 
+def _generate_extraction(gemini, contents):
+    # Through the shared scheduler: rate limited, retried on 429/5xx, bounded by a deadline
+    if STRUCTURED_OUTPUT:
+        return gemini_scheduler.call(gemini.generate_content, contents,
+                                     generation_config=json_generation_config(EXTRACTION_SCHEMA))
+    return gemini_scheduler.call(gemini.generate_content, [EXTRACTION_PROMPT] + contents)
+
+def extract_receipt(gemini, storage_client, bucket_name, file_name, sender=None):
+    # Returns (receipt_json, content_hash, extracted_by); content_hash identifies the file bytes + prompt/model
+    # version, extracted_by is "model" or "template:<id>"
+    if not is_supported_file(file_name):
+        raise UnsupportedFileType(file_name)
+
+    bucket = storage_client.bucket(bucket_name)
+    blob = bucket.blob(file_name)
+
+    if is_video_file(file_name):
+        # Keyed on the GCS checksum so a cache hit needs no download at all
+        with span("gcs.reload", file=file_name):
+            blob.reload()
+        if blob.size is not None and blob.size > MAX_VIDEO_BYTES:
+            raise FileTooLarge(f"{file_name} is {blob.size} bytes (limit {MAX_VIDEO_BYTES})")
+        file_bytes = None
+        content_hash = cache_key(f"{blob.md5_hash or blob.crc32c}:{blob.size}".encode("utf-8"), MODEL_NAME, EXTRACTION_VERSION)
+    else:
+        # Download straight into memory
+        with span("gcs.download", file=file_name) as attrs:
+            file_bytes = download_bytes(blob, MAX_FILE_BYTES)
+            attrs["bytes"] = len(file_bytes)
+        content_hash = cache_key(file_bytes, MODEL_NAME, EXTRACTION_VERSION)
+
+    # Known merchant layout: parsed locally, no model call (and nothing cached, it is cheap to redo)
+    if sender and file_name.lower().endswith(".html"):
+        matched = match_template(file_bytes.decode("utf-8", errors="replace"), sender)
+        if matched is not None:
+            receipt_json, template_id = matched
+            print(f"Extracted with template {template_id}:", receipt_json)
+            return receipt_json, content_hash, f"template:{template_id}"
+
+    # Same bytes were already extracted: skip the model call
+    with span("extraction_cache.get") as attrs:
+        cached = extraction_cache.get(content_hash)
+        attrs["hit"] = cached is not None
+    if cached is not None:
+        print("Extraction cache hit:", content_hash)
+        return cached, content_hash, "model"
+
+    # File Type Handling (model_part pulls in the Vertex SDK only once a model call is needed)
+    started = time.monotonic()
+    if file_name.lower().endswith(".pdf"):
+        if PREPROCESS_ENABLED:
+            with span("preprocess", kind="pdf") as attrs:
+                file_bytes, stats = prepare_pdf(file_bytes)
+                attrs.update(stats)
+        part = model_part(file_bytes, "application/pdf")
+        result = generate_extraction(gemini, [part])
+
+    elif file_name.lower().endswith(IMAGE_TYPES):
+        mime_type = IMAGE_TYPES_BY_EXTENSION[os.path.splitext(file_name.lower())[1]]
+        if PREPROCESS_ENABLED:
+            with span("preprocess", kind="image") as attrs:
+                file_bytes, mime_type, stats = prepare_image(file_bytes, mime_type)
+                attrs.update(stats)
+        part = model_part(file_bytes, mime_type)
+        result = generate_extraction(gemini, [part])
+
+    elif file_name.lower().endswith(".html"):
+        if PREPROCESS_ENABLED:
+            with span("preprocess", kind="html") as attrs:
+                html_text, stats = prepare_html(file_bytes)
+                attrs.update(stats)
         else:
-            print("Unsupported file type:", file_name)
-            return "Unsupported file type", 400
+            html_text = file_bytes.decode("utf-8")
+        result = generate_extraction(gemini, [html_text])
+
+    else:
+        print("Extracting from video...")
+        with span("video.sample_frames", file=file_name) as attrs:
+            frames = extract_frames_from_blob(blob, file_name)
+            attrs["frames"] = len(frames)
+        if not frames:
+            raise ValueError(f"No frames could be extracted from {file_name}")
+        parts = [model_part(frame, "image/jpeg") for frame in frames]
+        result = generate_extraction(gemini, parts)
+    model_seconds = time.monotonic() - started
+
+    # Parse JSON: tolerant of fences, trailing text and common defects; bad fields are dropped, not fatal
+    try:
+        receipt_json, field_errors, repaired = parse_model_output(result.text)
+    except ReceiptParseError as e:
+        print("JSON error:", e)
+        print("Gemini output:", repr(result.text))
+        raise
+    if repaired:
+        print("Repaired malformed model output")
+    if field_errors:
+        print("Dropped invalid fields:", field_errors)
+
+    print("Extracted JSON:", receipt_json)
+    extraction_cache.put(content_hash, receipt_json, model_seconds)
+    return receipt_json, content_hash, "model"
 
-        # Parse JSON
-        cleaned_text = result.text.strip()
-        if cleaned_text.startswith("```"):
-            cleaned_text = re.sub(r"```json|```", "", cleaned_text).strip()
+@functions_framework.cloud_event
+@track_cold_start
+def process_receipt(cloud_event):
+    if cloud_event.data.get("name", "").startswith(SKIP_PREFIXES):
+        print(f"Skipping non-receipt object: {cloud_event.data['name']}")
+        return "Skipped", 200
+    # GCS events carry the object's custom metadata; mail uploads set trace_id to the Gmail message id
+    metadata = cloud_event.data.get("metadata") or {}
+    with trace_context(metadata.get("trace_id")) as trace_id, span("process_receipt", file=cloud_event.data.get("name")) as attrs:
+        body, status = handle_receipt(cloud_event, trace_id)
+        attrs["http_status"] = status
+        return body, status
+
+def source_fields(bucket_name, file_name, sender, extracted_by):
+    # Kept on the Firestore document only: where the receipt came from and what extracted it
+    return {"source_file": f"gs://{bucket_name}/{file_name}", "sender": sender, "extracted_by": extracted_by}
+
+def handle_receipt(cloud_event, trace_id):
+    try:
+        bucket_name = cloud_event.data["bucket"]
+        file_name = cloud_event.data["name"]
+        sender = (cloud_event.data.get("metadata") or {}).get("sender")
+        print(f"Received file: {file_name} from bucket: {bucket_name}")
+
+        storage_client = get_storage()
+
+        # Gemini model
+        gemini = extraction_model()
+        db = get_firestore()
 
         try:
-            receipt_json = json.loads(cleaned_text)
-            print("Extracted JSON:", receipt_json)
-        except json.JSONDecodeError as e:
-            print("JSON error:", e)
-            print("Gemini output:", repr(result.text))
+            receipt_json, content_hash, extracted_by = extract_receipt(gemini, storage_client, bucket_name, file_name,
+                                                                       sender=sender)
+        except UnsupportedFileType:
+            print("Unsupported file type:", file_name)
+            return "Unsupported file type", 400
+        except FileTooLarge as e:
+            print("File too large:", e)
+            return "File too large", 413
+        except ReceiptParseError:
             return "JSON parse error", 500
+        # A copy: the cached extraction is shared by every upload of the same bytes
+        receipt_json = {**receipt_json, "trace_id": trace_id}
 
-        # Store to Firestore
-        doc_ref = db.collection("receipts").document()
-        doc_ref.set(receipt_json)
+        # Store to Firestore (keyed by content hash so duplicates overwrite instead of piling up)
+        doc_ref = db.collection("receipts").document(content_hash)
+        with span("firestore.set", collection="receipts"):
+            doc_ref.set({**receipt_json, **source_fields(bucket_name, file_name, sender, extracted_by)})
         print("Stored in Firestore with ID:", doc_ref.id)
 
         # Store to BigQuery
-        push_to_bigquery(receipt_json)
+        push_to_bigquery(receipt_json, row_id=content_hash)
 
-        print("enrich and push")
-        enrich_and_push(receipt_json)
+        if ENRICHMENT_DISPATCH == "inline":
+            print("enrich and push")
+            with span("enrich"):
+                enrich_and_push(receipt_json, row_id=content_hash)
+        else:
+            # Enrichment is its own stage: once the raw receipt is stored, ingestion is done
+            with span("enrichment.publish", dispatch=ENRICHMENT_DISPATCH):
+                get_enrichment_queue().publish([enrichment_task(receipt_json, content_hash)])
 
-        os.remove(temp_path)
+        print("Extraction cache:", extraction_cache.stats())
+        print("Receipt templates:", template_stats())
+        print("Gemini scheduler:", gemini_scheduler.stats())
         return "Success", 200
 
     except Exception as e:
         print("Error:", str(e))
         return f"Internal error: {str(e)}", 500
+
+# ---------- Batch ingestion ----------
+
+def _item_result(obj):
+    # Objects listed from GCS carry their metadata, so mail uploads keep the Gmail message id as trace id
+    metadata = obj.get("metadata") or {}
+    return {"bucket": obj.get("bucket"), "name": obj.get("name"), "status": "pending",
+            "trace_id": metadata.get("trace_id") or new_trace_id(), "sender": metadata.get("sender")}
+
+def _fail(result, stage, error):
+    result["status"] = "error"
+    result["stage"] = stage
+    result["error"] = str(error)
+    print(f"❌ {result['name']} failed at {stage}: {error}")
+
+def process_receipts(objects, max_workers=MAX_BATCH_WORKERS):
+    # Extract a batch of GCS objects concurrently, then flush each sink once per batch
+    results = [_item_result(obj) for obj in objects]
+    if not objects:
+        return results
+
+    storage_client = get_storage()
+    gemini = extraction_model()
+    db = get_firestore()
+    hashes = [None] * len(objects)
+    extracted_by = [None] * len(objects)
+
+    def extract(i):
+        obj = objects[i]
+        try:
+            with trace_context(results[i]["trace_id"]):
+                receipt_json, hashes[i], extracted_by[i] = extract_receipt(
+                    gemini, storage_client, obj["bucket"], obj["name"], sender=results[i]["sender"])
+            return {**receipt_json, "trace_id": results[i]["trace_id"]}
+        except UnsupportedFileType:
+            results[i]["status"] = "unsupported"
+        except FileTooLarge:
+            results[i]["status"] = "too_large"
+        except Exception as e:
+            _fail(results[i], "extract", e)
+        return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        extracted = list(pool.map(bind(extract), range(len(objects))))
+    ok = [i for i, receipt in enumerate(extracted) if receipt is not None]
+
+    # The same file twice in one batch only needs to be written once
+    seen = {}
+    for i in ok:
+        if hashes[i] in seen:
+            results[i]["status"] = "duplicate"
+            results[i]["duplicate_of"] = objects[seen[hashes[i]]]["name"]
+        else:
+            seen[hashes[i]] = i
+    ok = [i for i in ok if results[i]["status"] == "pending"]
+
+    # Store to Firestore in batched writes
+    for start in range(0, len(ok), FIRESTORE_BATCH_LIMIT):
+        chunk = ok[start:start + FIRESTORE_BATCH_LIMIT]
+        batch = db.batch()
+        refs = {}
+        for i in chunk:
+            refs[i] = db.collection("receipts").document(hashes[i])
+            batch.set(refs[i], {**extracted[i], **source_fields(objects[i]["bucket"], objects[i]["name"],
+                                                                 results[i]["sender"], extracted_by[i])})
+        try:
+            with span("firestore.batch_commit", collection="receipts", writes=len(chunk)):
+                batch.commit()
+            for i in chunk:
+                results[i]["firestore_id"] = refs[i].id
+        except Exception as e:
+            for i in chunk:
+                _fail(results[i], "firestore", e)
+    ok = [i for i in ok if results[i]["status"] == "pending"]
+
+    # Store to BigQuery with one multi-row insert
+    rows = [prepare_bigquery_row(extracted[i]) for i in ok]
+    try:
+        row_errors = push_rows_to_bigquery(rows, row_ids=[hashes[i] for i in ok])
+    except Exception as e:
+        row_errors = {n: e for n in range(len(rows))}
+    for n, i in enumerate(ok):
+        if n in row_errors:
+            _fail(results[i], "bigquery", row_errors[n])
+    ok = [i for i in ok if results[i]["status"] == "pending"]
+
+    if ENRICHMENT_DISPATCH != "inline":
+        try:
+            with span("enrichment.publish", dispatch=ENRICHMENT_DISPATCH, tasks=len(ok)):
+                get_enrichment_queue().publish([enrichment_task(extracted[i], hashes[i]) for i in ok])
+        except Exception as e:
+            for i in ok:
+                _fail(results[i], "enrichment_publish", e)
+        for i in ok:
+            if results[i]["status"] == "pending":
+                results[i].update(status="ok", enrichment="queued", receipt_id=extracted[i].get("receipt_id"))
+        return results
+
+    # Enrich concurrently, then insert all enriched rows at once
+    def enrich(i):
+        try:
+            with trace_context(results[i]["trace_id"]):
+                row = enrich_receipt(extracted[i])
+            if row is None:
+                _fail(results[i], "enrich", "no enriched row returned")
+            return row
+        except Exception as e:
+            _fail(results[i], "enrich", e)
+        return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        enriched = list(pool.map(bind(enrich), ok))
+    ok = [i for i in ok if results[i]["status"] == "pending"]
+    enriched = [row for row in enriched if row is not None]
+
+    try:
+        row_errors = push_enriched_rows(enriched, row_ids=[hashes[i] for i in ok])
+    except Exception as e:
+        row_errors = {n: e for n in range(len(enriched))}
+    for n, i in enumerate(ok):
+        if n in row_errors:
+            _fail(results[i], "enriched_bigquery", row_errors[n])
+        else:
+            results[i]["status"] = "ok"
+            results[i]["receipt_id"] = extracted[i].get("receipt_id")
+
+    return results
+
+@functions_framework.http
+@track_cold_start
+def process_receipt_batch(request):
+    # Body: {"objects": [{"bucket": ..., "name": ...}, ...]} or {"bucket": ..., "names": [...]}
+    if request.method != "POST":
+        return ("Method Not Allowed", 405)
+
+    payload = request.get_json(force=True, silent=True) or {}
+    objects = payload.get("objects")
+    if objects is None:
+        objects = [{"bucket": payload.get("bucket"), "name": name} for name in payload.get("names", [])]
+    if not objects or any(not obj.get("bucket") or not obj.get("name") for obj in objects):
+        return ("Expected a non-empty list of {bucket, name} objects", 400)
+    if len(objects) > MAX_BATCH_ITEMS:
+        return (f"Batch too large: {len(objects)} > {MAX_BATCH_ITEMS}", 400)
+
+    print(f"Received batch of {len(objects)} files")
+    with span("process_receipts", files=len(objects)):
+        results = process_receipts(objects)
+
+    summary = {}
+    for result in results:
+        summary[result["status"]] = summary.get(result["status"], 0) + 1
+    print("Batch summary:", summary)
+    cache_stats = extraction_cache.stats()
+    print("Extraction cache:", cache_stats)
+    return ({"summary": summary, "cache": cache_stats, "templates": template_stats(),
+             "scheduler": gemini_scheduler.stats(), "sinks": sink_stats(), "results": results}, 200)
+
+# ---------- Enrichment stage (ENRICHMENT_DISPATCH=pubsub) ----------
+
+@functions_framework.cloud_event
+@track_cold_start
+def enrich_receipt_message(cloud_event):
+    # Push trigger on ENRICHMENT_TOPIC: one receipt per message. Raising hands the message back to
+    # Pub/Sub, which redelivers with the subscription's backoff and dead-letters after its max attempts.
+    task = json.loads(base64.b64decode(cloud_event.data["message"]["data"]))
+    error = enrich_batch([task])[0]
+    if error:
+        raise RuntimeError(f"Enrichment of {task.get('row_id')} failed: {error}")
+
+@functions_framework.http
+@track_cold_start
+def enrich_receipt_worker(request):
+    # Pull worker (e.g. every minute from Cloud Scheduler): enriches ENRICHMENT_SUBSCRIPTION in batches
+    # until it is empty or max_seconds is up; successes are acked, failures are handed back for redelivery
+    max_seconds = float(request.args.get("max_seconds", "240"))
+    enrichment_queue = get_enrichment_queue()
+    if not hasattr(enrichment_queue, "pull"):
+        return ("Pull worker needs ENRICHMENT_DISPATCH=pubsub", 400)
+
+    started = time.monotonic()
+    summary = {"batches": 0, "enriched": 0, "failed": 0}
+    while time.monotonic() - started < max_seconds:
+        messages = enrichment_queue.pull(ENRICH_BATCH_SIZE)
+        if not messages:
+            break
+        errors = enrich_batch([task for _, task in messages])
+        enrichment_queue.ack([ack_id for (ack_id, _), error in zip(messages, errors) if not error])
+        enrichment_queue.nack([ack_id for (ack_id, _), error in zip(messages, errors) if error])
+        summary["batches"] += 1
+        summary["failed"] += sum(1 for error in errors if error)
+        summary["enriched"] += sum(1 for error in errors if not error)
+    summary["seconds"] = round(time.monotonic() - started, 3)
+    print("Enrichment worker:", summary)
+    return (summary, 200)
+
+# ---------- Receipt templates ----------
+
+@functions_framework.http
+@track_cold_start
+def learn_receipt_templates(request):
+    # Run occasionally (e.g. nightly from Cloud Scheduler): turns layouts the model has already parsed
+    # several times into templates, so the next emails from those merchants skip the model
+    payload = request.get_json(force=True, silent=True) or {}
+    limit = int(payload.get("limit", request.args.get("limit", "500")))
+    kwargs = {"min_samples": int(payload["min_samples"])} if "min_samples" in payload else {}
+    with span("learn_templates", limit=limit) as attrs:
+        summary = learn_templates(limit=limit, **kwargs)
+        attrs["learned"] = len(summary["learned"])
+    print("Template learning:", summary)
+    return ({**summary, "templates": template_stats()}, 200)
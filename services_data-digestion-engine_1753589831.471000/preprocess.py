@@ -0,0 +1,281 @@
+import io
+import math
+import os
+import re
+import struct
+import time
+from html.parser import HTMLParser
+
+# Shrinks what goes to Gemini: emails become compact text, images are downscaled and re-encoded,
+# PDFs lose pages with nothing receipt-like on them. Bump PREPROCESS_VERSION when the output changes,
+# since it is part of the extraction cache key.
+PREPROCESS_ENABLED = os.environ.get("PREPROCESS_INPUTS", "true").lower() == "true"
+PREPROCESS_VERSION = "2"
+IMAGE_MAX_DIM = int(os.environ.get("IMAGE_MAX_DIM", "1600"))
+IMAGE_JPEG_QUALITY = int(os.environ.get("IMAGE_JPEG_QUALITY", "85"))
+PDF_MAX_PAGES = int(os.environ.get("PDF_MAX_PAGES", "5"))
+
+TEXT_CHARS_PER_TOKEN = 4
+MEDIA_TOKENS = 258  # Gemini bills an image tile (up to 768x768) or a PDF page as 258 tokens
+IMAGE_TILE = 768
+
+RECEIPT_KEYWORDS = re.compile(
+    r"\b(total|subtotal|amount|invoice|receipt|bill|tax|gst|vat|paid|payment|qty|price|order)\b|[₹$€£]",
+    re.IGNORECASE)
+
+HIDDEN_TAGS = {"script", "style", "head", "title", "noscript", "template", "svg", "iframe", "object"}
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source",
+             "track", "wbr"}
+BLOCK_TAGS = {"p", "div", "br", "tr", "li", "ul", "ol", "table", "tbody", "thead", "tfoot", "section",
+              "article", "header", "footer", "h1", "h2", "h3", "h4", "h5", "h6", "hr", "center", "blockquote"}
+CELL_TAGS = {"td", "th"}
+# Preheaders and tracking blocks hide themselves with inline CSS
+HIDDEN_STYLE = re.compile(r"display\s*:\s*none|visibility\s*:\s*hidden|max-height\s*:\s*0|opacity\s*:\s*0(?![.\d])|"
+                          r"font-size\s*:\s*0(?![.\d])")
+
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+
+def _stats(kind, data, started, output, mime_type=None, **extra):
+    tokens_in = extra.pop("tokens_in")
+    tokens_out = extra.pop("tokens_out")
+    return {"kind": kind, "mime_type": mime_type, "bytes_in": len(data), "bytes_out": len(output),
+            "tokens_in": tokens_in, "tokens_out": tokens_out,
+            "ms": round((time.perf_counter() - started) * 1000, 2), **extra}
+
+
+def text_tokens(text):
+    return math.ceil(len(text) / TEXT_CHARS_PER_TOKEN)
+
+
+def image_tokens(width, height):
+    if width is None or height is None:
+        return MEDIA_TOKENS
+    if width <= IMAGE_TILE // 2 and height <= IMAGE_TILE // 2:
+        return MEDIA_TOKENS
+    return math.ceil(width / IMAGE_TILE) * math.ceil(height / IMAGE_TILE) * MEDIA_TOKENS
+
+
+# ---------- HTML ----------
+
+class _ReceiptText(HTMLParser):
+    # Keeps visible text only; table rows become "cell | cell" lines
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.lines = []
+        self.line = []
+        self.stack = []  # (tag, hidden)
+        self.hidden = 0
+
+    def _break(self):
+        text = " ".join(" ".join(self.line).split())
+        if text.strip(" |"):
+            self.lines.append(text.strip(" |"))
+        self.line = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag in VOID_TAGS:
+            if tag == "br" or tag == "hr":
+                self._break()
+            elif tag == "img" and not self.hidden:
+                # Logos can carry the merchant name; 1x1 tracking pixels carry nothing
+                alt = (attrs.get("alt") or "").strip()
+                if alt and attrs.get("width") not in ("0", "1") and attrs.get("height") not in ("0", "1"):
+                    self.line.append(alt)
+            return
+        hidden = (tag in HIDDEN_TAGS or "hidden" in attrs or attrs.get("aria-hidden") == "true"
+                  or bool(HIDDEN_STYLE.search(attrs.get("style") or "")))
+        self.stack.append((tag, hidden))
+        self.hidden += hidden
+        if tag in BLOCK_TAGS:
+            self._break()
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        # Unclosed children are closed with their parent, as browsers do
+        if not any(open_tag == tag for open_tag, _ in self.stack):
+            return
+        while self.stack:
+            open_tag, hidden = self.stack.pop()
+            self.hidden -= hidden
+            if open_tag == tag:
+                break
+        if tag in CELL_TAGS and not self.hidden:
+            self.line.append("|")
+        elif tag in BLOCK_TAGS:
+            self._break()
+
+    def handle_data(self, data):
+        if not self.hidden and data.strip():
+            self.line.append(data.strip())
+
+    def text(self):
+        self._break()
+        lines = []
+        for line in self.lines:
+            if not lines or lines[-1] != line:  # repeated banners and spacer rows
+                lines.append(line)
+        return "\n".join(lines)
+
+
+def html_to_text(html):
+    parser = _ReceiptText()
+    parser.feed(html)
+    parser.close()
+    return parser.text()
+
+
+def prepare_html(data):
+    # Returns (text, stats)
+    started = time.perf_counter()
+    html = data.decode("utf-8", errors="replace")
+    text = html_to_text(html)
+    if not text:
+        text = html  # nothing visible survived: let the model see what there is
+    return text, _stats("html", data, started, text.encode("utf-8"), "text/plain",
+                        tokens_in=text_tokens(html), tokens_out=text_tokens(text))
+
+
+# ---------- Images ----------
+
+def sniff_image_type(data):
+    for signature, mime_type in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return mime_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[4:8] == b"ftyp" and data[8:12] in (b"heic", b"heix", b"mif1", b"msf1", b"heif"):
+        return "image/heic"
+    return None
+
+
+def image_size(data, mime_type):
+    # (width, height) from the header alone, or (None, None)
+    try:
+        if mime_type == "image/png":
+            return struct.unpack(">II", data[16:24])
+        if mime_type == "image/gif":
+            return struct.unpack("<HH", data[6:10])
+        if mime_type == "image/jpeg":
+            pos = 2
+            while pos + 9 < len(data):
+                if data[pos] != 0xFF:
+                    pos += 1
+                    continue
+                marker = data[pos + 1]
+                if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                    height, width = struct.unpack(">HH", data[pos + 5:pos + 9])
+                    return width, height
+                pos += 2 + struct.unpack(">H", data[pos + 2:pos + 4])[0]
+    except struct.error:
+        pass
+    return None, None
+
+
+def prepare_image(data, fallback_mime="image/png"):
+    # Returns (bytes, mime_type, stats). The smaller of original and re-encoded JPEG is sent.
+    started = time.perf_counter()
+    mime_type = sniff_image_type(data) or fallback_mime
+    width, height = image_size(data, mime_type)
+    tokens_in = image_tokens(width, height)
+
+    def unchanged(reason):
+        return data, mime_type, _stats("image", data, started, data, mime_type, tokens_in=tokens_in,
+                                       tokens_out=tokens_in, size_in=(width, height), size_out=(width, height),
+                                       reason=reason)
+
+    if mime_type not in ("image/png", "image/jpeg", "image/webp"):
+        return unchanged("format not re-encoded")
+    if width and max(width, height) <= IMAGE_MAX_DIM and mime_type != "image/png":
+        return unchanged("already small")
+
+    # cv2 is only needed once an image must be re-encoded, so it is imported on first use
+    import cv2
+    import numpy as np
+    from video_frames import downscale, encode_jpeg
+
+    # Large JPEGs are decoded straight at 1/2, 1/4 or 1/8 scale, which is much faster than a full decode
+    flags = cv2.IMREAD_COLOR
+    if mime_type == "image/jpeg" and width:
+        for factor, reduced in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                (2, cv2.IMREAD_REDUCED_COLOR_2)):
+            if max(width, height) / factor >= IMAGE_MAX_DIM:
+                flags = reduced
+                break
+    if mime_type == "image/png":
+        flags = cv2.IMREAD_UNCHANGED  # keep alpha, or transparent areas decode as black
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+    if image is None:
+        return unchanged("could not decode")
+    if image.dtype != np.uint8:
+        image = (image // 257).astype(np.uint8)  # 16-bit PNG
+    if image.ndim == 3 and image.shape[2] == 4:
+        # JPEG has no alpha: flatten onto white paper
+        alpha = image[:, :, 3:].astype(np.float32) / 255
+        image = (image[:, :, :3] * alpha + 255 * (1 - alpha)).astype(np.uint8)
+    height_in, width_in = image.shape[:2]
+    if width is None:
+        width, height = width_in, height_in
+        tokens_in = image_tokens(width, height)
+    image = downscale(image, IMAGE_MAX_DIM)
+    encoded = encode_jpeg(image, IMAGE_JPEG_QUALITY)
+    if len(encoded) >= len(data) and max(width, height) <= IMAGE_MAX_DIM:
+        return unchanged("re-encoding did not help")  # e.g. a crisp PNG screenshot
+    out_h, out_w = image.shape[:2]
+    return encoded, "image/jpeg", _stats("image", data, started, encoded, "image/jpeg", tokens_in=tokens_in,
+                                         tokens_out=image_tokens(out_w, out_h), size_in=(width, height),
+                                         size_out=(out_w, out_h))
+
+
+# ---------- PDFs ----------
+
+def prepare_pdf(data):
+    # Returns (bytes, stats). Drops only pages with nothing receipt-like on them (the first page is always
+    # kept). If more than PDF_MAX_PAGES pages look like receipt content, the totals could be on any of them,
+    # so the PDF goes through untouched, as do scanned PDFs (no text layer) and unreadable ones.
+    started = time.perf_counter()
+
+    def result(output, pages_in, pages_out, reason=None):
+        return output, _stats("pdf", data, started, output, "application/pdf",
+                              tokens_in=pages_in * MEDIA_TOKENS if pages_in else None,
+                              tokens_out=pages_out * MEDIA_TOKENS if pages_out else None,
+                              pages_in=pages_in, pages_out=pages_out, reason=reason)
+
+    try:
+        from pypdf import PdfReader, PdfWriter
+    except ImportError:
+        return result(data, None, None, "pypdf not installed")
+    try:
+        reader = PdfReader(io.BytesIO(data))
+        pages = len(reader.pages)
+        if pages <= 1:
+            return result(data, pages, pages)
+        keep = []
+        for number, page in enumerate(reader.pages):
+            text = page.extract_text() or ""
+            if not text.strip():
+                return result(data, pages, pages, "no text layer")
+            if number == 0 or RECEIPT_KEYWORDS.search(text):
+                keep.append(number)
+        if len(keep) == pages:
+            return result(data, pages, pages)
+        if len(keep) > PDF_MAX_PAGES:
+            return result(data, pages, pages, f"{len(keep)} receipt pages")
+        writer = PdfWriter()
+        for number in keep:
+            writer.add_page(reader.pages[number])
+        output = io.BytesIO()
+        writer.write(output)
+        return result(output.getvalue(), pages, len(keep))
+    except Exception as e:
+        return result(data, None, None, f"unreadable: {type(e).__name__}")
@@ -0,0 +1,457 @@
+import copy
+import json
+import re
+from datetime import datetime
+from typing import List, NamedTuple, Optional
+
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator, model_validator
+
+DATE_FORMATS = ("%Y-%m-%d", "%m-%d-%Y", "%m/%d/%Y", "%d/%m/%Y", "%d-%m-%Y")
+TRUE_WORDS = {"true", "yes", "y", "1"}
+FALSE_WORDS = {"false", "no", "n", "0"}
+MAX_VALIDATION_PASSES = 3
+
+_decoder = json.JSONDecoder()
+_NUMBER = re.compile(r"-?\d(?:[\d.,]*\d)?|-?[.,]\d+")
+_BARE_TOKEN = re.compile(r"[A-Za-z_$][\w$\-]*|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+_LITERALS = {"true": "true", "True": "true", "false": "false", "False": "false",
+             "null": "null", "None": "null", "NULL": "null", "undefined": "null", "NaN": "null"}
+_DROPPED = object()
+
+
+class ReceiptParseError(ValueError):
+    pass
+
+
+class ParsedOutput(NamedTuple):
+    data: dict
+    errors: list  # "field.path: message" for every field that was dropped
+    repaired: bool  # the raw text needed repairing before it parsed
+
+
+# ---------- JSON extraction and repair ----------
+
+def extract_json_object(text, start=0):
+    # The first balanced {...} from start; text after it (or a truncated tail) is not included/closed here
+    depth = 0
+    quote = None
+    escaped = False
+    for i in range(start, len(text)):
+        c = text[i]
+        if quote:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == quote:
+                quote = None
+        elif c in "\"'":
+            quote = c
+        elif c in "{[":
+            depth += 1
+        elif c in "}]":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return text[start:]
+
+
+def repair_json(fragment):
+    # Rewrites common model-output defects into valid JSON in one pass:
+    # single-quoted strings, Python literals, bare keys/words, comments, trailing commas,
+    # raw newlines in strings and truncated output (cut back to the last complete member)
+    out = []
+    stack = []
+    safe = (0, [])  # (len(out), open closers) at the last point where the output was complete
+    quote = None
+    pending_comma = False
+    i, n = 0, len(fragment)
+    while i < n:
+        c = fragment[i]
+        if quote:
+            if c == "\\" and i + 1 < n:
+                nxt = fragment[i + 1]
+                out.append("'" if nxt == "'" else c + nxt)  # \' is not a JSON escape
+                i += 2
+                continue
+            if c == quote:
+                out.append('"')
+                quote = None
+            elif c == '"':
+                out.append('\\"')
+            elif c < " ":
+                out.append(json.dumps(c)[1:-1])
+            else:
+                out.append(c)
+            i += 1
+            continue
+
+        if c.isspace():
+            i += 1
+            continue
+        if fragment.startswith("//", i) or c == "#":
+            end = fragment.find("\n", i)
+            i = n if end < 0 else end
+            continue
+        if fragment.startswith("/*", i):
+            end = fragment.find("*/", i + 2)
+            i = n if end < 0 else end + 2
+            continue
+        if c == ",":
+            pending_comma = True
+            i += 1
+            continue
+        if c in "}]":
+            # A comma right before a closer is dropped; mismatched closers close what is actually open
+            pending_comma = False
+            if stack:
+                out.append(stack.pop()[0])
+                if all(keyed for _, keyed in stack):
+                    safe = (len(out), [closer for closer, _ in stack])
+            i += 1
+            if not stack:
+                break
+            continue
+        if pending_comma:
+            if all(keyed for _, keyed in stack):
+                safe = (len(out), [closer for closer, _ in stack])
+            out.append(",")
+            pending_comma = False
+        if c in "{[":
+            # Containers held by a key (or the root) may be cut short; a half-written list element is dropped whole
+            keyed = not stack or out[-1] == ":"
+            stack.append(("}" if c == "{" else "]", keyed))
+            out.append(c)
+            if all(k for _, k in stack):
+                safe = (len(out), [closer for closer, _ in stack])
+            i += 1
+        elif c in "\"'":
+            quote = c
+            out.append('"')
+            i += 1
+        elif c == ":":
+            out.append(":")
+            i += 1
+        else:
+            match = _BARE_TOKEN.match(fragment, i)
+            if not match:
+                i += 1  # stray character (e.g. a backtick from a code fence)
+                continue
+            token = match.group()
+            i = match.end()
+            if token in _LITERALS:
+                out.append(_LITERALS[token])
+            elif token[0].isdigit() or token[0] in "-+.":
+                out.append(token.lstrip("+"))
+            else:
+                out.append(json.dumps(token))  # bare key or unquoted string value
+
+    if stack or quote:
+        # Truncated: keep everything up to the last complete member and close what was open there
+        length, open_brackets = safe
+        return "".join(out[:length]) + "".join(reversed(open_brackets))
+    return "".join(out)
+
+
+def load_json(text):
+    # Returns (first JSON object in text, repaired); raises ReceiptParseError if there is none
+    start = text.find("{")
+    if start < 0:
+        raise ReceiptParseError("No JSON object in model output")
+    # Fast path: valid JSON, whatever comes before (code fence) or after (trailing prose)
+    try:
+        return _decoder.raw_decode(text, start)[0], False
+    except json.JSONDecodeError:
+        pass
+    repaired = repair_json(extract_json_object(text, start))
+    try:
+        data = json.loads(repaired)
+    except json.JSONDecodeError as e:
+        raise ReceiptParseError(f"Unrepairable model output: {e}") from e
+    if not data:
+        raise ReceiptParseError("Nothing recoverable in model output")
+    return data, True
+
+
+def coerce_object(value):
+    # Nested fields sometimes arrive as JSON strings; returns a dict, or None if there isn't one
+    if isinstance(value, dict):
+        return value
+    if isinstance(value, str):
+        try:
+            obj, _ = load_json(value)
+        except ReceiptParseError:
+            return None
+        return obj if isinstance(obj, dict) else None
+    return None
+
+
+# ---------- Scalar coercion ----------
+
+def parse_number(value, default=None):
+    # 12, "12.5", "₹1,234.50", "€ 1.234,50", "$ 7", "12,5" -> float; ambiguous or anything else -> default
+    if value is None or isinstance(value, bool):
+        return default
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = _NUMBER.search(str(value))
+    if not match:
+        return default
+    number = _normalize_number(match.group())
+    return default if number is None else float(number)
+
+
+def _normalize_number(number):
+    # When both separators appear the last one is the decimal point; a lone comma is decimal with a
+    # 1-2 digit tail and thousands with a 3 digit one; repeated separators must be 3-digit groups,
+    # or Indian lakh/crore grouping with commas ("12,34,567")
+    sign = "-" if number.startswith("-") else ""
+    number = number.lstrip("-")
+    commas, dots = number.count(","), number.count(".")
+    if not commas and not dots:
+        return sign + number
+    if commas and dots:
+        decimal = "," if number.rfind(",") > number.rfind(".") else "."
+        if number.count(decimal) > 1:
+            return None
+        whole, _, fraction = number.rpartition(decimal)
+        thousands = "." if decimal == "," else ","
+    else:
+        separator = "," if commas else "."
+        whole, _, fraction = number.rpartition(separator)
+        if number.count(separator) == 1 and (separator == "." or len(fraction) in (1, 2)):
+            return f"{sign}{whole or 0}.{fraction}"
+        if separator == "," and number.count(",") == 1 and len(fraction) != 3:
+            return None  # "12,3456"
+        whole, fraction, thousands = number, "", separator
+    groups = whole.split(thousands)
+    western = all(len(group) == 3 for group in groups[1:])
+    lakh = thousands == "," and len(groups[-1]) == 3 and all(len(group) == 2 for group in groups[1:-1])
+    if not 1 <= len(groups[0]) <= 3 or not (western or lakh):
+        return None  # "1,2,3", "04.12.2025", "1.234,5.6"
+    return sign + "".join(groups) + (f".{fraction}" if fraction else "")
+
+
+def parse_date(value):
+    if not value:
+        return None
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(str(value).strip(), fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def parse_bool(value):
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return bool(value)
+    word = str(value).strip().lower()
+    if word in TRUE_WORDS:
+        return True
+    if word in FALSE_WORDS:
+        return False
+    raise ValueError(f"not a boolean: {value!r}")
+
+
+# ---------- Models ----------
+
+class MerchantProfile(BaseModel):
+    model_config = ConfigDict(extra="ignore", coerce_numbers_to_str=True, str_strip_whitespace=True)
+
+    website: Optional[str] = None
+    country: Optional[str] = None
+    tags: Optional[List[str]] = Field(None, description="Short descriptive tags for the merchant")
+
+    @field_validator("tags", mode="before")
+    @classmethod
+    def _split_tags(cls, value):
+        if isinstance(value, str):
+            return [tag.strip() for tag in value.split(",") if tag.strip()]
+        return value
+
+
+class ReceiptItem(BaseModel):
+    model_config = ConfigDict(extra="allow", coerce_numbers_to_str=True, str_strip_whitespace=True)
+
+    name: Optional[str] = Field(None, description="Item name")
+    qty: float = 1.0
+    price: float = 0.0
+    category: Optional[str] = Field(None, description="Food / Grocery / Transport / Utility / Medicine / etc.")
+
+    @field_validator("qty", "price", mode="before")
+    @classmethod
+    def _number(cls, value, info):
+        if value is None or value == "":
+            return cls.model_fields[info.field_name].default
+        number = parse_number(value)
+        if number is None:
+            raise ValueError(f"not a number: {value!r}")
+        return number
+
+
+class InferredFields(BaseModel):
+    # What the enrichment call (or combined-mode extraction) infers about the merchant
+    model_config = ConfigDict(extra="ignore", coerce_numbers_to_str=True, str_strip_whitespace=True)
+
+    merchant_category: Optional[str] = Field(None, description="Business category of the merchant")
+    payment_method: Optional[str] = Field(None, description="Cash / Card / UPI / etc. (if found or inferable)")
+    merchant_profile: Optional[MerchantProfile] = Field(None, description="Inferred from the merchant")
+
+    @field_validator("merchant_profile", mode="before")
+    @classmethod
+    def _profile_object(cls, value):
+        return coerce_object(value) if isinstance(value, str) else value
+
+
+class Receipt(InferredFields):
+    # Extra keys the model adds are kept; everything declared here is coerced to its type
+    model_config = ConfigDict(extra="allow", coerce_numbers_to_str=True, str_strip_whitespace=True)
+
+    # Descriptions end up in the response schema, so they double as extraction instructions
+    merchant: Optional[str] = Field(None, description="Name of the merchant or business")
+    phone: Optional[str] = None
+    date: Optional[str] = Field(None, description="MM-DD-YYYY")  # stored as ISO YYYY-MM-DD
+    time: Optional[str] = Field(None, description="HH:MM AM/PM")
+    items: Optional[List[ReceiptItem]] = None
+    subtotal: Optional[float] = None
+    tax: Optional[float] = None
+    total: Optional[float] = Field(None, description="If not printed, the sum of the item prices")
+    currency: Optional[str] = Field(None, description="INR / USD / EUR / etc.")
+    receipt_id: Optional[str] = Field(None, description="Transaction or invoice number")
+    store_address: Optional[str] = None
+    category: Optional[str] = Field(None, description="Top-level category for the whole receipt, e.g. Grocery, Dining, Travel")
+    is_subscription: Optional[bool] = Field(None, description="Whether the receipt suggests a recurring service")
+
+    @field_validator("merchant", mode="before")
+    @classmethod
+    def _merchant_name(cls, value):
+        return value.get("name") if isinstance(value, dict) else value
+
+    @field_validator("date", mode="before")
+    @classmethod
+    def _iso_date(cls, value):
+        if value is None or value == "":
+            return None
+        parsed = parse_date(value)
+        if parsed is None:
+            raise ValueError(f"unrecognized date: {value!r}")
+        return parsed.isoformat()
+
+    @field_validator("items", mode="before")
+    @classmethod
+    def _item_objects(cls, value):
+        if isinstance(value, list):
+            return [(coerce_object(item) or item) if isinstance(item, str) else item for item in value]
+        return value
+
+    @field_validator("subtotal", "tax", "total", mode="before")
+    @classmethod
+    def _amount(cls, value):
+        if value is None or value == "":
+            return None
+        number = parse_number(value)
+        if number is None:
+            raise ValueError(f"not a number: {value!r}")
+        return number
+
+    @field_validator("is_subscription", mode="before")
+    @classmethod
+    def _bool(cls, value):
+        return parse_bool(value)
+
+    @model_validator(mode="after")
+    def _fill_total(self, info):
+        # Same rule the prompt gives the model: no total on the receipt means the sum of item prices,
+        # unless validate() dropped one of them (the sum would be silently short)
+        if self.total is None and self.items and not (info.context or {}).get("dropped_item_price"):
+            self.total = round(sum(item.price for item in self.items), 2)
+        return self
+
+
+# ---------- Response schema ----------
+
+def _schema_node(node, defs):
+    # Gemini's schema is an OpenAPI subset: no $ref and no unions, so refs are inlined
+    # and Optional[X] (anyOf X / null) becomes a nullable X
+    if "$ref" in node:
+        node = defs[node["$ref"].rsplit("/", 1)[-1]]
+    if "anyOf" in node:
+        options = [option for option in node["anyOf"] if option.get("type") != "null"]
+        schema = _schema_node(options[0], defs)
+        if len(options) < len(node["anyOf"]):
+            schema["nullable"] = True
+        if "description" in node:
+            schema["description"] = node["description"]
+        return schema
+    schema = {key: node[key] for key in ("type", "description", "enum") if key in node}
+    if "properties" in node:
+        schema["properties"] = {name: _schema_node(sub, defs) for name, sub in node["properties"].items()}
+    if "items" in node:
+        schema["items"] = _schema_node(node["items"], defs)
+    return schema
+
+
+def response_schema(model, exclude=()):
+    # Response schema for a Gemini JSON-mode request, derived from the pydantic model
+    json_schema = model.model_json_schema()
+    schema = _schema_node(json_schema, json_schema.get("$defs", {}))
+    for name in exclude:
+        schema["properties"].pop(name, None)
+    return schema
+
+
+# ---------- Validation ----------
+
+def _drop(data, loc):
+    parent = data
+    for key in loc[:-1]:
+        try:
+            parent = parent[key]
+        except (KeyError, IndexError, TypeError):
+            return
+    if isinstance(parent, dict):
+        parent.pop(loc[-1], None)
+    elif isinstance(parent, list) and isinstance(loc[-1], int) and loc[-1] < len(parent):
+        parent[loc[-1]] = _DROPPED
+
+
+def _prune(value):
+    if isinstance(value, list):
+        return [_prune(v) for v in value if v is not _DROPPED]
+    if isinstance(value, dict):
+        return {k: _prune(v) for k, v in value.items()}
+    return value
+
+
+def validate(data, model=Receipt):
+    # Returns (validated dict, field errors); an invalid field is dropped instead of failing the whole object
+    if not isinstance(data, dict):
+        raise ReceiptParseError(f"Expected a JSON object, got {type(data).__name__}")
+    errors = []
+    context = {"dropped_item_price": False}
+    for _ in range(MAX_VALIDATION_PASSES):
+        try:
+            validated = model.model_validate(data, context=context).model_dump(exclude_none=True)
+            if context["dropped_item_price"] and "total" in model.model_fields and "total" not in validated:
+                errors.append("total: not filled from item prices, an item or its price was invalid")
+            return validated, errors
+        except ValidationError as e:
+            if not errors:
+                data = copy.deepcopy(data)
+            for error in e.errors():
+                errors.append(f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}")
+                _drop(data, error["loc"])
+                if error["loc"][:1] == ("items",) and (len(error["loc"]) == 2 or error["loc"][-1] == "price"):
+                    context["dropped_item_price"] = True
+            data = _prune(data)
+    raise ReceiptParseError(f"Validation failed: {errors}")
+
+
+def parse_model_output(text, model=Receipt):
+    # Model text -> ParsedOutput; raises ReceiptParseError only when no usable object can be recovered
+    data, repaired = load_json(text)
+    validated, errors = validate(data, model)
+    return ParsedOutput(validated, errors, repaired)
@@ -0,0 +1,213 @@
+import bisect
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Defaults for the shared Gemini scheduler; size the rate to the project's quota divided by max instances
+GEMINI_RATE_PER_SEC = float(os.environ.get("GEMINI_RATE_PER_SEC", "10"))
+GEMINI_BURST = int(os.environ.get("GEMINI_BURST", "10"))
+GEMINI_MAX_IN_FLIGHT = int(os.environ.get("GEMINI_MAX_IN_FLIGHT", "8"))
+GEMINI_MAX_ATTEMPTS = int(os.environ.get("GEMINI_MAX_ATTEMPTS", "4"))
+GEMINI_BACKOFF_BASE_S = float(os.environ.get("GEMINI_BACKOFF_BASE_S", "1.0"))
+GEMINI_BACKOFF_MAX_S = float(os.environ.get("GEMINI_BACKOFF_MAX_S", "30"))
+GEMINI_DEADLINE_S = float(os.environ.get("GEMINI_DEADLINE_S", "120"))  # per attempt, also sent as the request timeout
+# Longest wait for an in-flight slot or rate token before the attempt fails instead of queueing forever
+GEMINI_QUEUE_TIMEOUT_S = float(os.environ.get("GEMINI_QUEUE_TIMEOUT_S", "120"))
+GEMINI_HEDGE_AFTER_S = float(os.environ.get("GEMINI_HEDGE_AFTER_S", "0"))  # 0 disables hedging
+
+LATENCY_BUCKETS_MS = (100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+LATENCY_WINDOW = 1000  # recent latencies kept for percentiles
+
+
+class CallDeadlineExceeded(TimeoutError):
+    pass
+
+
+class CallQueueTimeout(CallDeadlineExceeded):
+    # No slot or rate token within queue_timeout, e.g. every slot is held by a call that hangs
+    pass
+
+
+# Quota (429) and server-side failures are worth retrying; anything else fails fast. Matched by
+# google.api_core.exceptions class name, so importing the scheduler does not pull in grpc.
+TRANSIENT_ERRORS = {"TooManyRequests", "ResourceExhausted", "ServiceUnavailable", "InternalServerError",
+                    "DeadlineExceeded", "GatewayTimeout", "Aborted"}
+
+
+def is_transient(error):
+    if isinstance(error, CallDeadlineExceeded):
+        return True
+    return any(cls.__name__ in TRANSIENT_ERRORS and cls.__module__.startswith("google.")
+               for cls in type(error).__mro__)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate  # seconds until a token is available
+
+    def acquire(self, block=True, timeout=None):
+        # Returns False when block=False and no token is available right now, or after timeout seconds
+        if self.rate <= 0:
+            return True
+        give_up = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait_s = self.try_acquire()
+            if not wait_s:
+                return True
+            if not block:
+                return False
+            if give_up is not None and time.monotonic() + wait_s > give_up:
+                return False
+            time.sleep(wait_s)
+
+
+class CallScheduler:
+    # Rate limit + in-flight cap + retries with jittered exponential backoff + per-attempt deadline
+    # + optional hedging, shared by every thread of the instance.
+    # timeout_kwarg names the keyword the called function takes a request timeout in (seconds left to the
+    # attempt's deadline): the SDK then ends a hung request itself, and its slot is freed for other calls.
+
+    def __init__(self, name, rate=GEMINI_RATE_PER_SEC, burst=GEMINI_BURST, max_in_flight=GEMINI_MAX_IN_FLIGHT,
+                 max_attempts=GEMINI_MAX_ATTEMPTS, backoff_base=GEMINI_BACKOFF_BASE_S,
+                 backoff_max=GEMINI_BACKOFF_MAX_S, deadline=GEMINI_DEADLINE_S, hedge_after=GEMINI_HEDGE_AFTER_S,
+                 queue_timeout=GEMINI_QUEUE_TIMEOUT_S, timeout_kwarg=None):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.deadline = deadline
+        self.hedge_after = hedge_after
+        self.queue_timeout = queue_timeout
+        self.timeout_kwarg = timeout_kwarg
+        # Twice the slots: a timed-out attempt keeps its thread and slot until the SDK call returns
+        self.pool = ThreadPoolExecutor(max_workers=max_in_flight * 2, thread_name_prefix=f"{name}-call")
+
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.in_flight = 0
+        self.counts = {"calls": 0, "attempts": 0, "retries": 0, "hedges": 0, "hedge_wins": 0,
+                       "deadline_exceeded": 0, "queue_timeouts": 0, "failures": 0}
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def _count(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    def _run(self, fn, args, kwargs):
+        with self.lock:
+            self.in_flight += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+            self.slots.release()
+
+    def _submit(self, fn, args, kwargs, timeout, block=True):
+        # Waits up to queue_timeout for an in-flight slot and a rate token, then raises CallQueueTimeout;
+        # returns None if block=False and either is not free right now. timeout goes to fn as timeout_kwarg.
+        acquired = self.slots.acquire(timeout=self.queue_timeout) if block else self.slots.acquire(blocking=False)
+        if acquired and not self.bucket.acquire(block, timeout=self.queue_timeout):
+            self.slots.release()
+            acquired = False
+        if not acquired:
+            if not block:
+                return None
+            self._count("queue_timeouts")
+            raise CallQueueTimeout(f"{self.name} call waited over {self.queue_timeout}s for a slot")
+        if self.timeout_kwarg:
+            kwargs = dict(kwargs, **{self.timeout_kwarg: timeout})
+        self._count("attempts")
+        return self.pool.submit(self._run, fn, args, kwargs)
+
+    def _attempt(self, fn, args, kwargs):
+        with self.lock:
+            self.queued += 1
+        try:
+            primary = self._submit(fn, args, kwargs, self.deadline)
+        finally:
+            with self.lock:
+                self.queued -= 1
+        futures = [primary]
+        started = time.monotonic()
+        deadline = started + self.deadline
+
+        # A hedge is a second copy of a slow request; whichever answers first wins.
+        # Hedges only use spare capacity, so they never queue behind real work.
+        if self.hedge_after and self.hedge_after < self.deadline:
+            done, _ = wait(futures, timeout=self.hedge_after)
+            if not done:
+                hedge = self._submit(fn, args, kwargs, max(0.0, deadline - time.monotonic()), block=False)
+                if hedge is not None:
+                    self._count("hedges")
+                    futures.append(hedge)
+
+        while futures:
+            done, _ = wait(futures, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                self._count("deadline_exceeded")
+                raise CallDeadlineExceeded(f"{self.name} call exceeded {self.deadline}s")
+            future = done.pop()
+            futures.remove(future)
+            if future.exception() is not None and futures:
+                continue  # one copy failed while the other is still running: wait for that one
+            if future.exception() is None:
+                self._observe(time.monotonic() - started)
+                if future is not primary:
+                    self._count("hedge_wins")
+            return future.result()
+
+    def _observe(self, seconds):
+        ms = seconds * 1000
+        with self.lock:
+            self.histogram[bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+            self.latencies.append(ms)
+
+    def call(self, fn, *args, **kwargs):
+        self._count("calls")
+        for attempt in range(self.max_attempts):
+            try:
+                return self._attempt(fn, args, kwargs)
+            except Exception as e:
+                if not is_transient(e) or attempt + 1 == self.max_attempts:
+                    self._count("failures")
+                    raise
+                # Full jitter: spreads retries from many instances instead of synchronizing them
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                print(f"⚠️ {self.name} call failed ({type(e).__name__}: {e}), retry {attempt + 1} in {delay:.2f}s")
+                self._count("retries")
+                time.sleep(delay)
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = dict(self.counts, queued=self.queued, in_flight=self.in_flight)
+            stats["latency_ms_histogram"] = {
+                f"le_{bound}": count for bound, count in zip(LATENCY_BUCKETS_MS + ("inf",), self.histogram)}
+        for p in (50, 95, 99):
+            stats[f"p{p}_ms"] = round(latencies[min(len(latencies) - 1, len(latencies) * p // 100)], 1) if latencies else None
+        return stats
+
+
+# One scheduler per instance for every Gemini call (extraction and enrichment share the quota)
+gemini_scheduler = CallScheduler("gemini", timeout_kwarg="timeout")
@@ -0,0 +1,344 @@
+import atexit
+import json
+import os
+import signal
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from clients import PROJECT_ID, get_bigquery, get_storage
+from tracing import span
+
+# streaming: every write is an insert_rows_json call (rows visible immediately).
+# buffered: every write is staged as one newline-JSON object in SINK_BUCKET before it returns, so a
+# caller that acks its message afterwards never acks rows held only in memory. Staged objects are
+# loaded in bulk (a free load job; quota is 1,500 per table per day, so keep MAX_AGE_S >= 60) when a
+# threshold is hit, by the background flusher and on shutdown, then deleted. Objects left behind by an
+# instance that died before its flush are picked up by the next instance after SINK_ORPHAN_AGE_S.
+# Delivery is at-least-once: load jobs have no insertId dedupe, so a crash between a load and the
+# delete can load a file twice; receipt_id stays in every row for dedupe at query time.
+SINK_MODE = os.environ.get("BIGQUERY_SINK_MODE", "streaming")
+# Not the receipt upload bucket: its finalize trigger would treat staged rows as receipts
+SINK_BUCKET = os.environ.get("BIGQUERY_SINK_BUCKET", f"{PROJECT_ID}-bigquery-staging")
+SINK_STAGING_PREFIX = "staging/"
+SINK_DEAD_LETTER_PREFIX = "dead-letter/"  # rows BigQuery rejected, with its errors, for inspection and replay
+SINK_MAX_ROWS = int(os.environ.get("BIGQUERY_SINK_MAX_ROWS", "500"))
+SINK_MAX_BYTES = int(os.environ.get("BIGQUERY_SINK_MAX_BYTES", str(5 * 1024 * 1024)))
+SINK_MAX_AGE_S = float(os.environ.get("BIGQUERY_SINK_MAX_AGE_S", "60"))
+SINK_ORPHAN_AGE_S = float(os.environ.get("BIGQUERY_SINK_ORPHAN_AGE_S", "900"))  # well past any live flush
+SINK_RECENT_KEYS = 10000  # keys of staged rows remembered to drop redeliveries
+
+
+class BigQuerySink:
+    def __init__(self, table, mode=SINK_MODE, bucket=SINK_BUCKET, max_rows=SINK_MAX_ROWS,
+                 max_bytes=SINK_MAX_BYTES, max_age=SINK_MAX_AGE_S, orphan_age=SINK_ORPHAN_AGE_S):
+        self.table = table
+        self.mode = mode
+        self.bucket = bucket
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.orphan_age = orphan_age
+        self.prefix = f"{SINK_STAGING_PREFIX}{table}/"
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()  # one flush at a time, so a retried batch keeps its order
+        self.pending = OrderedDict()  # staged object name -> (rows, bytes)
+        self.pending_rows = 0
+        self.pending_bytes = 0
+        self.oldest = None
+        self.recent = OrderedDict()
+        self.failures = 0  # flushes failed in a row
+        self.retry_at = 0.0
+        self.schema = None
+        self.counts = {"rows": 0, "duplicates": 0, "staged_rows": 0, "staging_failures": 0, "flushes": 0,
+                       "flushed_rows": 0, "failed_flushes": 0, "recovered_rows": 0, "dead_lettered_rows": 0}
+
+    def _count(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    def write(self, rows, keys=None):
+        # keys (receipt content hash / receipt_id) make redelivered rows no-ops.
+        # Returns {row_index: errors} for rows that were not written (streaming) or not staged (buffered).
+        if not rows:
+            return {}
+        self._count("rows", len(rows))
+        if self.mode != "buffered":
+            with span("bigquery.insert", table=self.table, rows=len(rows)):
+                errors = get_bigquery().insert_rows_json(self.table, rows, row_ids=keys)
+            return {e["index"]: e["errors"] for e in errors}
+
+        keys = keys or [row.get("receipt_id") for row in rows]
+        fresh = []
+        with self.lock:
+            for n, (row, key) in enumerate(zip(rows, keys)):
+                if key and key in self.recent:
+                    self.counts["duplicates"] += 1
+                    continue
+                if key:
+                    # Marked before staging: a redelivery arriving meanwhile is a duplicate too
+                    self.recent[key] = True
+                fresh.append((n, key))
+            while len(self.recent) > SINK_RECENT_KEYS:
+                self.recent.popitem(last=False)
+        if not fresh:
+            return {}
+
+        data = "".join(json.dumps(rows[n], default=str) + "\n" for n, _ in fresh)
+        name = f"{self.prefix}{time.time_ns()}-{uuid.uuid4().hex[:8]}.json"
+        try:
+            with span("bigquery.stage", table=self.table, rows=len(fresh)):
+                get_storage().bucket(self.bucket).blob(name).upload_from_string(
+                    data, content_type="application/x-ndjson", if_generation_match=0)
+        except Exception as e:
+            with self.lock:
+                for _, key in fresh:
+                    self.recent.pop(key, None)
+                self.counts["staging_failures"] += 1
+            print(f"❌ Staging {len(fresh)} rows for {self.table} failed: {e}")
+            return {n: [{"reason": "staging", "message": str(e)}] for n, _ in fresh}
+
+        with self.lock:
+            self._track(name, len(fresh), len(data))
+            self.counts["staged_rows"] += len(fresh)
+            full = self.pending_rows >= self.max_rows or self.pending_bytes >= self.max_bytes
+            full = full and time.monotonic() >= self.retry_at
+        if full:
+            self.flush()
+        return {}
+
+    def _track(self, name, rows, size):
+        # Caller holds self.lock
+        self.pending[name] = (rows, size)
+        self.pending_rows += rows
+        self.pending_bytes += size
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+
+    def due(self):
+        with self.lock:
+            now = time.monotonic()
+            return self.oldest is not None and now - self.oldest >= self.max_age and now >= self.retry_at
+
+    def flush(self):
+        # Loads staged objects (up to max_rows rows per job) and deletes them; returns rows written.
+        # A failed batch stays staged and pending, and is retried by the next flush.
+        with self.flush_lock:
+            with self.lock:
+                batch = []
+                rows = 0
+                for name, (count, _) in self.pending.items():
+                    if batch and rows + count > self.max_rows:
+                        break
+                    batch.append(name)
+                    rows += count
+            if not batch:
+                return 0
+            try:
+                with span("bigquery.flush", table=self.table, rows=rows, files=len(batch)):
+                    done, written = self._load_split(batch)
+            except Exception as e:
+                with self.lock:
+                    self.counts["failed_flushes"] += 1
+                    self.failures += 1
+                    # Backs off so that during an outage every request is not held up by a doomed load
+                    self.retry_at = time.monotonic() + min(self.max_age, 2 ** self.failures)
+                print(f"❌ Flush of {rows} rows to {self.table} failed, will retry: {e}")
+                return 0
+            self._finish(done)
+            with self.lock:
+                for name in done:
+                    count, size = self.pending.pop(name)
+                    self.pending_rows -= count
+                    self.pending_bytes -= size
+                self.oldest = time.monotonic() if self.pending else None
+                self.failures = 0
+                self.retry_at = 0.0
+                self.counts["flushes"] += 1
+                self.counts["flushed_rows"] += written
+            print(f"✅ Flushed {written} rows to {self.table}")
+            return written
+
+    def _load(self, names):
+        from google.cloud import bigquery
+        client = get_bigquery()
+        if self.schema is None:
+            # Explicit schema: autodetect could disagree with the table's column types
+            self.schema = client.get_table(self.table).schema
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+            schema=self.schema,
+        )
+        uris = [f"gs://{self.bucket}/{name}" for name in names]
+        client.load_table_from_uri(uris, self.table, job_config=job_config).result()
+
+    def _load_split(self, names):
+        # Returns (names done with, rows written). One bad row fails its whole load job, so a rejected
+        # batch is halved until the bad files are on their own, and those go through _salvage.
+        try:
+            self._load(names)
+        except Exception as e:
+            if not _is_rejection(e):
+                raise
+            if len(names) == 1:
+                return names, self._salvage(names[0], e)
+            print(f"⚠️ BigQuery rejected {len(names)} staged files for {self.table}, splitting: {e}")
+            done, written = [], 0
+            half = len(names) // 2
+            for part in (names[:half], names[half:]):
+                try:
+                    part_done, part_written = self._load_split(part)
+                except Exception as part_error:
+                    print(f"❌ Loading {len(part)} staged files into {self.table} failed, will retry: {part_error}")
+                    continue
+                done += part_done
+                written += part_written
+            return done, written
+        with self.lock:
+            return names, sum(self.pending[name][0] for name in names)
+
+    def _salvage(self, name, error):
+        # Streams a rejected file's rows, which reports the bad ones by index, and writes those to the
+        # dead-letter prefix with their errors instead of dropping them. Returns rows written.
+        bucket = get_storage().bucket(self.bucket)
+        rows = [json.loads(line) for line in bucket.blob(name).download_as_bytes().splitlines() if line]
+        errors = get_bigquery().insert_rows_json(self.table, rows, row_ids=[row.get("receipt_id") for row in rows])
+        rejected = {e["index"]: e["errors"] for e in errors}
+        if rejected:
+            target = SINK_DEAD_LETTER_PREFIX + name[len(SINK_STAGING_PREFIX):]
+            data = "".join(json.dumps({"row": rows[n], "errors": errs}, default=str) + "\n"
+                           for n, errs in sorted(rejected.items()))
+            bucket.blob(target).upload_from_string(data, content_type="application/x-ndjson")
+            self._count("dead_lettered_rows", len(rejected))
+            print(f"❌ BigQuery rejected {len(rejected)} rows for {self.table}, kept at gs://{self.bucket}/{target}: {error}")
+        return len(rows) - len(rejected)
+
+    def _finish(self, names):
+        bucket = get_storage().bucket(self.bucket)
+        for name in names:
+            try:
+                bucket.blob(name).delete()
+            except Exception as e:
+                # The rows are in the table; the leftover object would be loaded again as an orphan
+                print(f"⚠️ Could not delete staged {name}: {e}")
+
+    def recover(self):
+        # Adopts staged objects older than orphan_age that no live flush owns: an instance that
+        # stopped without flushing leaves them behind. Returns the number of objects adopted.
+        cutoff = time.time_ns() - int(self.orphan_age * 1e9)
+        adopted = 0
+        for blob in get_storage().bucket(self.bucket).list_blobs(prefix=self.prefix):
+            staged_at = blob.name[len(self.prefix):].split("-", 1)[0]
+            if not staged_at.isdigit() or int(staged_at) > cutoff:
+                continue
+            with self.lock:
+                if blob.name in self.pending:
+                    continue
+            try:
+                data = blob.download_as_bytes()
+            except Exception as e:
+                print(f"⚠️ Could not read staged {blob.name}, will look again: {e}")  # e.g. just loaded and deleted
+                continue
+            with self.lock:
+                if blob.name in self.pending:
+                    continue
+                rows = data.count(b"\n")
+                self._track(blob.name, rows, len(data))
+                self.counts["recovered_rows"] += rows
+            adopted += 1
+        if adopted:
+            print(f"♻️ Adopted {adopted} staged files left behind for {self.table}")
+        return adopted
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, pending=self.pending_rows, pending_files=len(self.pending),
+                        pending_bytes=self.pending_bytes, mode=self.mode)
+
+
+def _is_rejection(error):
+    # Invalid rows fail a load job with 400 Bad Request; anything else may pass on retry
+    from google.api_core import exceptions
+    return isinstance(error, exceptions.BadRequest)
+
+
+_sinks = {}
+_sinks_lock = threading.Lock()
+_flusher = None
+
+
+def get_sink(table):
+    # One sink per table per instance, shared by every request thread
+    with _sinks_lock:
+        sink = _sinks.get(table)
+        if sink is None:
+            sink = _sinks[table] = BigQuerySink(table)
+            if sink.mode == "buffered":
+                _start_flusher()
+    return sink
+
+
+def flush_all(max_failures=3):
+    # Drains every buffer, retrying failed flushes a few times; returns {table: rows written}.
+    # Whatever stays pending is still staged, and another instance adopts it after SINK_ORPHAN_AGE_S.
+    flushed = {}
+    for table, sink in list(_sinks.items()):
+        flushed[table] = 0
+        failures = 0
+        while sink.stats()["pending_files"] and failures < max_failures:
+            before = sink.stats()["pending_files"]
+            flushed[table] += sink.flush()
+            if sink.stats()["pending_files"] >= before:
+                failures += 1
+                time.sleep(0.2 * failures)
+    return flushed
+
+
+def sink_stats():
+    return {table: sink.stats() for table, sink in list(_sinks.items())}
+
+
+def _flush_loop():
+    last_recovery = None
+    while True:
+        time.sleep(max(0.1, SINK_MAX_AGE_S / 4))
+        # Looks for files left behind by stopped instances once at start, then every half orphan age
+        recover = last_recovery is None or time.monotonic() - last_recovery >= SINK_ORPHAN_AGE_S / 2
+        if recover:
+            last_recovery = time.monotonic()
+        for sink in list(_sinks.values()):
+            try:
+                if recover:
+                    sink.recover()
+                if sink.due():
+                    sink.flush()
+            except Exception as e:
+                print(f"❌ BigQuery sink flusher for {sink.table} failed, will retry: {e}")
+
+
+def _start_flusher():
+    global _flusher
+    if _flusher is None:
+        _flusher = threading.Thread(target=_flush_loop, name="bigquery-sink-flusher", daemon=True)
+        _flusher.start()
+
+
+def _on_sigterm(signum, frame):
+    # Cloud Functions/Run send SIGTERM before stopping an instance: loads what this instance staged now
+    # rather than after SINK_ORPHAN_AGE_S
+    print("SIGTERM: flushing BigQuery sinks", flush_all())
+    if callable(_previous_sigterm):
+        _previous_sigterm(signum, frame)
+    elif _previous_sigterm == signal.SIG_DFL:
+        raise SystemExit(0)
+
+
+_previous_sigterm = None
+if SINK_MODE == "buffered":
+    atexit.register(flush_all)
+    try:
+        _previous_sigterm = signal.signal(signal.SIGTERM, _on_sigterm)
+    except ValueError:
+        pass  # not imported on the main thread: atexit still flushes
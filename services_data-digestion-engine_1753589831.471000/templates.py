@@ -0,0 +1,447 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parseaddr
+from html.parser import HTMLParser
+
+from clients import get_firestore, get_storage
+from preprocess import VOID_TAGS, html_to_text
+from receipt_parser import ReceiptParseError, parse_date, parse_number, validate
+from tracing import bind, span
+
+# Known merchants' receipt emails are parsed with regexes instead of a model call. A template is
+# keyed by sender domain + a fingerprint of the HTML's tag structure, and is only used when its
+# output validates; anything else falls back to Gemini.
+TEMPLATES_ENABLED = os.environ.get("RECEIPT_TEMPLATES", "true").lower() == "true"
+TEMPLATE_COLLECTION = os.environ.get("RECEIPT_TEMPLATE_COLLECTION", "receipt_templates")
+TEMPLATE_REFRESH_S = float(os.environ.get("RECEIPT_TEMPLATE_REFRESH_S", "300"))
+# A learned template must reproduce this many model extractions exactly before it is registered
+TEMPLATE_MIN_SAMPLES = int(os.environ.get("RECEIPT_TEMPLATE_MIN_SAMPLES", "3"))
+AMOUNT_TOLERANCE = 0.02
+
+AMOUNT = r"-?[\d,]+(?:\.\d+)?"
+CAPTURES = {
+    "subtotal": AMOUNT,
+    "tax": AMOUNT,
+    "total": AMOUNT,
+    "receipt_id": r"[^\s|]+",
+    "time": r"\d{1,2}:\d{2}(?::\d{2})?(?:\s?[AaPp]\.?[Mm]\.?)?",
+    "phone": r"\+?\d[\d\s\-().]{5,}\d",
+    "store_address": r"[^|\n]+",
+}
+DATE_CAPTURES = {
+    "%Y-%m-%d": r"\d{4}-\d{1,2}-\d{1,2}",
+    "%m-%d-%Y": r"\d{1,2}-\d{1,2}-\d{4}",
+    "%d-%m-%Y": r"\d{1,2}-\d{1,2}-\d{4}",
+    "%m/%d/%Y": r"\d{1,2}/\d{1,2}/\d{4}",
+    "%d/%m/%Y": r"\d{1,2}/\d{1,2}/\d{4}",
+    "%d %b %Y": r"\d{1,2} [A-Za-z]{3} \d{4}",
+    "%b %d, %Y": r"[A-Za-z]{3} \d{1,2}, \d{4}",
+    "%d %B %Y": r"\d{1,2} [A-Za-z]+ \d{4}",
+    "%B %d, %Y": r"[A-Za-z]+ \d{1,2}, \d{4}",
+}
+ITEM_CAPTURES = {"name": r".+?", "qty": r"\d+(?:\.\d+)?", "price": AMOUNT}
+# Located in the email text; merchant-level fields are stored as constants instead
+LOCATED_FIELDS = ("receipt_id", "date", "time", "subtotal", "tax", "total", "phone", "store_address")
+CONSTANT_FIELDS = ("merchant", "currency", "category", "is_subscription", "merchant_category", "merchant_profile",
+                   "phone", "store_address")
+# A learned template has to reproduce every one of these that the model extracted
+COMPARED_FIELDS = ("merchant", "date", "time", "subtotal", "tax", "total", "currency", "receipt_id", "phone",
+                   "store_address")
+# Stored next to each extraction in Firestore `receipts`, so past model outputs can be learned from
+SOURCE_FIELDS = ("source_file", "sender", "extracted_by")
+
+
+class TemplateMismatch(ValueError):
+    pass
+
+
+# ---------- Matching ----------
+
+class _Skeleton(HTMLParser):
+    # Distinct tag paths: the same for every email from one layout, however many item rows it has
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack = []
+        self.paths = set()
+
+    def handle_starttag(self, tag, attrs):
+        path = "/".join(self.stack + [tag])
+        self.paths.add(path)
+        if tag not in VOID_TAGS:
+            self.stack.append(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self.stack:
+            while self.stack.pop() != tag:
+                pass
+
+
+def fingerprint(html):
+    parser = _Skeleton()
+    parser.feed(html)
+    parser.close()
+    return hashlib.sha256("\n".join(sorted(parser.paths)).encode("utf-8")).hexdigest()[:16]
+
+
+def sender_domain(sender):
+    return parseaddr(sender or "")[1].rpartition("@")[2].lower() or None
+
+
+def _equal(a, b):
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)) and not isinstance(a, bool):
+        return abs(a - b) <= AMOUNT_TOLERANCE
+    if isinstance(a, str) and isinstance(b, str):
+        return " ".join(a.split()).casefold() == " ".join(b.split()).casefold()
+    return a == b
+
+
+def amounts_consistent(receipt):
+    # Item prices (or qty x price) add up to the subtotal, the total, or the total before tax
+    items = receipt.get("items") or []
+    total, subtotal, tax = receipt.get("total"), receipt.get("subtotal"), receipt.get("tax")
+    targets = [t for t in (subtotal, total, total - tax if total is not None and tax is not None else None)
+               if t is not None]
+    if not items or not targets:
+        return True
+    sums = (sum(item.get("price", 0) for item in items), sum(item.get("price", 0) * item.get("qty", 1) for item in items))
+    return any(abs(s - t) <= AMOUNT_TOLERANCE + 0.005 * abs(t) for s in sums for t in targets)
+
+
+class ReceiptTemplate:
+    def __init__(self, spec):
+        # spec is the stored form: plain strings, so it round-trips through Firestore
+        self.spec = spec
+        self.template_id = spec["template_id"]
+        self.fields = {name: re.compile(pattern, re.MULTILINE) for name, pattern in spec.get("fields", {}).items()}
+        for name, pattern in self.fields.items():
+            if "value" not in pattern.groupindex:
+                raise ValueError(f"{self.template_id}: pattern for {name} has no (?P<value>...) group")
+        self.item_pattern = re.compile(spec["item_pattern"], re.MULTILINE) if spec.get("item_pattern") else None
+        self.date_format = spec.get("date_format")
+        self.constants = spec.get("constants", {})
+        self.check_amounts = spec.get("check_amounts", True)
+
+    def apply(self, text):
+        # Email text -> validated receipt dict (same shape as a model extraction), or TemplateMismatch
+        data = dict(self.constants)
+        for name, pattern in self.fields.items():
+            match = pattern.search(text)
+            if not match:
+                raise TemplateMismatch(f"{name} not found")
+            value = match.group("value").strip()
+            if name == "date" and self.date_format:
+                try:
+                    value = datetime.strptime(value, self.date_format).date().isoformat()
+                except ValueError:
+                    raise TemplateMismatch(f"date {value!r} is not {self.date_format}")
+            data[name] = value
+        if self.item_pattern:
+            data["items"] = [{k: v for k, v in m.groupdict().items() if v is not None}
+                             for m in self.item_pattern.finditer(text)]
+            if not data["items"]:
+                raise TemplateMismatch("no item rows")
+        try:
+            receipt, errors = validate(data)
+        except ReceiptParseError as e:
+            raise TemplateMismatch(str(e))
+        if errors:
+            raise TemplateMismatch(f"invalid fields: {errors}")
+        if self.check_amounts and not amounts_consistent(receipt):
+            raise TemplateMismatch("item prices do not add up to the totals")
+        return receipt
+
+
+# ---------- Index and metrics ----------
+
+_index = {}  # (sender domain, fingerprint) -> ReceiptTemplate
+_loaded_at = None
+_index_lock = threading.Lock()
+_counts = {"lookups": 0, "hits": 0, "no_match": 0, "mismatch": 0}
+_hits_by_template = {}
+_counts_lock = threading.Lock()
+
+
+def _count(key, template_id=None):
+    with _counts_lock:
+        _counts[key] += 1
+        if template_id:
+            _hits_by_template[template_id] = _hits_by_template.get(template_id, 0) + 1
+
+
+def _templates():
+    # Loaded from Firestore on first use and re-read every TEMPLATE_REFRESH_S, so new templates
+    # reach running instances without a deploy
+    global _loaded_at
+    with _index_lock:
+        if _loaded_at is not None and time.monotonic() - _loaded_at < TEMPLATE_REFRESH_S:
+            return _index
+        _loaded_at = time.monotonic()
+    try:
+        with span("firestore.load_templates") as attrs:
+            loaded = {}
+            for doc in get_firestore().collection(TEMPLATE_COLLECTION).stream():
+                try:
+                    template = ReceiptTemplate(doc.to_dict())
+                    loaded[(template.spec["sender_domain"], template.spec["fingerprint"])] = template
+                except (KeyError, ValueError, re.error) as e:
+                    print(f"⚠️ Skipping broken receipt template {doc.id}: {e}")
+            attrs["templates"] = len(loaded)
+        with _index_lock:
+            # Templates registered locally since the last load stay in place
+            _index.update(loaded)
+    except Exception as e:
+        print(f"⚠️ Could not load receipt templates, keeping {len(_index)} cached: {e}")
+    return _index
+
+
+def register_template(spec, persist=True):
+    # Compiles first, so a bad pattern never reaches the index or Firestore
+    template = ReceiptTemplate(spec)
+    with _index_lock:
+        _index[(spec["sender_domain"], spec["fingerprint"])] = template
+    if persist:
+        with span("firestore.set", collection=TEMPLATE_COLLECTION):
+            get_firestore().collection(TEMPLATE_COLLECTION).document(template.template_id).set(spec)
+    print(f"Registered receipt template {template.template_id}")
+    return template
+
+
+def match_template(html, sender):
+    # Returns (receipt, template_id) when a known template parses this email, else None
+    domain = sender_domain(sender)
+    if not TEMPLATES_ENABLED or not domain:
+        return None
+    with span("template.match", sender_domain=domain) as attrs:
+        _count("lookups")
+        template = _templates().get((domain, fingerprint(html)))
+        if template is None:
+            _count("no_match")
+            attrs["result"] = "no_match"
+            return None
+        attrs["template_id"] = template.template_id
+        try:
+            receipt = template.apply(html_to_text(html))
+        except TemplateMismatch as e:
+            _count("mismatch")
+            attrs["result"] = "mismatch"
+            print(f"Template {template.template_id} did not fit ({e}), falling back to the model")
+            return None
+        _count("hits", template.template_id)
+        attrs["result"] = "hit"
+        return receipt, template.template_id
+
+
+def template_stats():
+    with _counts_lock:
+        stats = dict(_counts, templates=len(_index), by_template=dict(_hits_by_template))
+    stats["hit_rate"] = round(stats["hits"] / stats["lookups"], 3) if stats["lookups"] else None
+    return stats
+
+
+# ---------- Learning from model extractions ----------
+
+def _literal(text):
+    # Fixed label text; digit runs (counts, percentages) may vary between emails
+    return r"\d+".join(re.escape(part) for part in re.split(r"\d+", text))
+
+
+def _amount_strings(value):
+    number = parse_number(value)
+    if number is None:
+        return []
+    strings = [f"{number:,.2f}", f"{number:.2f}"]
+    if number == int(number):
+        strings += [f"{int(number):,}", str(int(number))]
+    return list(dict.fromkeys(strings))
+
+
+def _find(text, candidates, start=0, end=None, before=r"(?<![\w.,])"):
+    # First standalone occurrence of any candidate string: (start, end, candidate) or None
+    end = len(text) if end is None else end
+    best = None
+    for candidate in candidates:
+        match = re.compile(before + re.escape(candidate) + r"(?![\w]|[.,]\d)").search(text, start, end)
+        if match and (best is None or match.start() < best[0]):
+            best = (match.start(), match.end(), candidate)
+    return best
+
+
+def _locate_field(text, name, value):
+    # Returns (pattern, date_format) reproducing value from text, or None
+    if name == "date":
+        parsed = parse_date(value)
+        if parsed is None:
+            return None
+        options = [(fmt, parsed.strftime(fmt)) for fmt in DATE_CAPTURES]
+    elif CAPTURES[name] == AMOUNT:
+        options = [(None, s) for s in _amount_strings(value)]
+    else:
+        options = [(None, str(value).strip())]
+    for date_format, candidate in options:
+        found = _find(text, [candidate])
+        if found is None:
+            continue
+        line_start = text.rfind("\n", 0, found[0]) + 1
+        label = text[line_start:found[0]]
+        if not re.search(r"[A-Za-z]", label):
+            continue  # a bare value is too ambiguous to anchor on
+        capture = DATE_CAPTURES[date_format] if date_format else CAPTURES[name]
+        pattern = f"^{_literal(label)}(?P<value>{capture})"
+        match = re.compile(pattern, re.MULTILINE).search(text)
+        if match and match.group("value").strip() == candidate:
+            return pattern, date_format
+    return None
+
+
+def _item_pattern(text, item):
+    # Pattern for one item row, built from the line the item's name appears on
+    name = str(item.get("name") or "").strip()
+    if not name:
+        return None
+    found = _find(text, [name])
+    if found is None:
+        return None
+    line_start = text.rfind("\n", 0, found[0]) + 1
+    line_end = text.find("\n", found[1])
+    line_end = len(text) if line_end < 0 else line_end
+    spans = [(found[0], found[1], "name")]
+    price = _find(text, _amount_strings(item.get("price")), found[1], line_end)
+    if price is None:
+        return None
+    spans.append((price[0], price[1], "price"))
+    qty = parse_number(item.get("qty"), 1.0)
+    qty_strings = [str(int(qty))] if qty == int(qty) else [f"{qty:g}", f"{qty:.2f}"]
+    for start, end in ((found[1], price[0]), (price[1], line_end)):
+        # "x2" and "2x" are common, so only digits and separators may touch a quantity
+        quantity = _find(text, qty_strings, start, end, before=r"(?<![\d.,])")
+        if quantity:
+            spans.append((quantity[0], quantity[1], "qty"))
+            break
+    else:
+        if qty != 1:
+            return None
+    spans.sort()
+    pattern, pos = "^", line_start
+    for start, end, group in spans:
+        pattern += _literal(text[pos:start]) + f"(?P<{group}>{ITEM_CAPTURES[group]})"
+        pos = end
+    return pattern + _literal(text[pos:line_end]) + "$"
+
+
+def _same_receipt(template_receipt, model_receipt):
+    for name in COMPARED_FIELDS:
+        if model_receipt.get(name) is not None and not _equal(template_receipt.get(name), model_receipt[name]):
+            return False
+    template_items = template_receipt.get("items") or []
+    model_items = model_receipt.get("items") or []
+    if len(template_items) != len(model_items):
+        return False
+    return all(_equal(a.get(k), b.get(k)) for a, b in zip(template_items, model_items) for k in ("name", "qty", "price"))
+
+
+def _build_spec(domain, fp, text, receipt):
+    fields = {}
+    date_format = None
+    for name in LOCATED_FIELDS:
+        if receipt.get(name) in (None, ""):
+            continue
+        located = _locate_field(text, name, receipt[name])
+        if located:
+            fields[name], found_format = located
+            date_format = found_format or date_format
+        elif name not in CONSTANT_FIELDS and name != "total":
+            return None  # total may be unprinted: validation fills it from the items, as for the model
+    item_pattern = None
+    if receipt.get("items"):
+        item_pattern = next(filter(None, (_item_pattern(text, item) for item in receipt["items"])), None)
+        if item_pattern is None:
+            return None
+    constants = {name: receipt[name] for name in CONSTANT_FIELDS if name not in fields and receipt.get(name) is not None}
+    return {"template_id": f"{domain}:{fp}", "sender_domain": domain, "fingerprint": fp, "fields": fields,
+            "date_format": date_format, "item_pattern": item_pattern, "constants": constants}
+
+
+def learn_template(sender, samples):
+    # samples: [(html, model receipt)] from one sender with one layout. Returns a template spec that
+    # reproduces every sample, or None. Merchant-level constants are kept only where all samples agree.
+    domain = sender_domain(sender)
+    if not domain or not samples:
+        return None
+    fp = fingerprint(samples[0][0])
+    if any(fingerprint(html) != fp for html, _ in samples[1:]):
+        return None
+    texts = [html_to_text(html) for html, _ in samples]
+    receipts = [receipt for _, receipt in samples]
+    for text, receipt in zip(texts, receipts):
+        spec = _build_spec(domain, fp, text, receipt)
+        if spec is None:
+            continue
+        spec["constants"] = {name: value for name, value in spec["constants"].items()
+                             if all(_equal(other.get(name), value) for other in receipts)}
+        spec["check_amounts"] = all(amounts_consistent(other) for other in receipts)
+        try:
+            template = ReceiptTemplate(spec)
+            if all(_same_receipt(template.apply(t), r) for t, r in zip(texts, receipts)):
+                spec["samples"] = len(samples)
+                spec["learned_at"] = datetime.now(timezone.utc).isoformat()
+                return spec
+        except (TemplateMismatch, re.error):
+            continue
+    return None
+
+
+def _load_source(source_file):
+    bucket_name, _, name = source_file.removeprefix("gs://").partition("/")
+    data = get_storage().bucket(bucket_name).blob(name).download_as_bytes()
+    return data.decode("utf-8", errors="replace")
+
+
+def learn_templates(limit=500, min_samples=TEMPLATE_MIN_SAMPLES, max_workers=8):
+    # Groups past model extractions in Firestore `receipts` by sender domain and layout, and registers
+    # a template for every group that has min_samples emails and that a template fully reproduces
+    with span("firestore.query", collection="receipts"):
+        docs = [doc.to_dict() for doc in get_firestore().collection("receipts")
+                .where("extracted_by", "==", "model").limit(limit).stream()]
+    docs = [d for d in docs if d.get("sender") and str(d.get("source_file", "")).endswith(".html")]
+    known = set(_templates())
+
+    def load(doc):
+        try:
+            return _load_source(doc["source_file"])
+        except Exception as e:
+            print(f"⚠️ Could not read {doc['source_file']}: {e}")
+        return None
+
+    with span("gcs.download_samples", files=len(docs)):
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            htmls = list(pool.map(bind(load), docs))
+
+    groups = {}
+    for doc, html in zip(docs, htmls):
+        if html is None:
+            continue
+        key = (sender_domain(doc["sender"]), fingerprint(html))
+        if key in known:
+            continue
+        try:
+            receipt, _ = validate({k: v for k, v in doc.items() if k not in SOURCE_FIELDS + ("trace_id",)})
+        except ReceiptParseError:
+            continue
+        groups.setdefault(key, (doc["sender"], []))[1].append((html, receipt))
+
+    learned, rejected = [], []
+    for (domain, fp), (sender, samples) in groups.items():
+        if len(samples) < min_samples:
+            continue
+        spec = learn_template(sender, samples)
+        if spec is None:
+            rejected.append(f"{domain}:{fp}")
+            continue
+        register_template(spec)
+        learned.append(spec["template_id"])
+    return {"receipts": len(docs), "groups": len(groups), "learned": learned, "rejected": rejected}
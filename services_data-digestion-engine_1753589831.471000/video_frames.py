@@ -0,0 +1,157 @@
+import math
+import os
+
+import cv2
+import numpy as np
+
+# Sampling settings
+VIDEO_MAX_FRAMES = int(os.environ.get("VIDEO_MAX_FRAMES", "3"))
+VIDEO_MAX_CANDIDATES = int(os.environ.get("VIDEO_MAX_CANDIDATES", "8"))
+VIDEO_SEEK_STRIDE = int(os.environ.get("VIDEO_SEEK_STRIDE", "30"))  # frames a seek decodes, back from the keyframe
+# Frames decoded per clip: clips up to this long are scanned in one pass, longer ones in VIDEO_SCAN_WINDOWS
+# evenly spaced windows that share the budget, so a blurred moment has sharper neighbours to lose to
+VIDEO_DECODE_BUDGET = int(os.environ.get("VIDEO_DECODE_BUDGET", "90"))
+VIDEO_SCAN_WINDOWS = int(os.environ.get("VIDEO_SCAN_WINDOWS", "3"))
+VIDEO_SKIP_LEADING_S = float(os.environ.get("VIDEO_SKIP_LEADING_S", "0.3"))  # the phone settling, usually
+VIDEO_MAX_DIM = int(os.environ.get("VIDEO_MAX_DIM", "1024"))
+VIDEO_JPEG_QUALITY = int(os.environ.get("VIDEO_JPEG_QUALITY", "80"))
+VIDEO_TILE_FRAMES = os.environ.get("VIDEO_TILE_FRAMES", "false").lower() == "true"
+VIDEO_MIN_DIFFERENCE = float(os.environ.get("VIDEO_MIN_DIFFERENCE", "6.0"))  # mean abs pixel diff between picks
+# A blurred or blank frame is not sent just because it differs from the sharp ones: fewer frames is better
+VIDEO_MIN_SHARPNESS_RATIO = float(os.environ.get("VIDEO_MIN_SHARPNESS_RATIO", "0.2"))  # of the sharpest candidate
+
+THUMB_WIDTH = 160  # near-duplicates are compared on small grayscale thumbnails
+SCORE_WIDTH = 640  # sharpness is scored at this size: at thumbnail size motion blur all but disappears
+VIDEO_POOL_FACTOR = 3  # full frames kept per requested frame while scanning
+
+
+def downscale(frame, max_dim):
+    height, width = frame.shape[:2]
+    scale = max_dim / max(height, width)
+    if scale >= 1:
+        return frame
+    return cv2.resize(frame, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+
+
+def encode_jpeg(frame, quality):
+    ok, buffer = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("JPEG encoding failed")
+    return buffer.tobytes()
+
+
+def tile_frames(frames):
+    # Grid of equally sized cells, as close to square as possible
+    cols = math.ceil(math.sqrt(len(frames)))
+    rows = math.ceil(len(frames) / cols)
+    cell_h = max(f.shape[0] for f in frames)
+    cell_w = max(f.shape[1] for f in frames)
+    canvas = np.full((rows * cell_h, cols * cell_w, 3), 255, dtype=np.uint8)
+    for n, frame in enumerate(frames):
+        r, c = divmod(n, cols)
+        canvas[r * cell_h:r * cell_h + frame.shape[0], c * cell_w:c * cell_w + frame.shape[1]] = frame
+    return canvas
+
+
+def scan_windows(frame_count, fps, max_candidates):
+    # [(first frame, frames to decode, candidates)] for one clip
+    if frame_count <= 0:
+        stride = max(1, int(fps // 4))  # unknown length: a candidate every quarter second from the start
+        return [(0, stride * max_candidates, max_candidates)]
+    start = min(int(fps * VIDEO_SKIP_LEADING_S), frame_count // 10)
+    span = frame_count - start
+    if span <= VIDEO_DECODE_BUDGET:
+        return [(start, span, max_candidates)]
+    count = max(1, min(VIDEO_SCAN_WINDOWS, max_candidates))
+    length = VIDEO_DECODE_BUDGET // count
+    gap = (span - length) / max(count - 1, 1)
+    return [(start + round(n * gap), length, math.ceil(max_candidates / count)) for n in range(count)]
+
+
+def iter_candidate_frames(cap, max_candidates, scan=None):
+    # Every frame in a window is grabbed (decoded); only the candidates, spread from its first frame to its
+    # last, are retrieved (converted to BGR). The pass ends at the first frame that does not decode, since
+    # CAP_PROP_FRAME_COUNT is only an estimate and a truncated file stops early. If that happens more than
+    # a second before the stated end, scan["incomplete"] is set: the file is probably cut short (e.g. a
+    # ranged download of a faststart MP4) and the frames near the cut may be damaged.
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    scan = {} if scan is None else scan
+
+    def stopped(index):
+        if frame_count > 0 and index < frame_count - fps:
+            scan["incomplete"] = True
+
+    position = 0
+    for first, length, candidates in scan_windows(frame_count, fps, max_candidates):
+        if first - position >= VIDEO_SEEK_STRIDE:
+            if not cap.set(cv2.CAP_PROP_POS_FRAMES, first):  # cheaper than grabbing through the gap
+                return stopped(first)
+        else:
+            for index in range(position, first):
+                if not cap.grab():
+                    return stopped(index)
+        picks = {first + round(n * (length - 1) / max(candidates - 1, 1)) for n in range(candidates)}
+        for index in range(first, first + length):
+            if not cap.grab():
+                return stopped(index)
+            position = index + 1
+            if index in picks:
+                success, frame = cap.retrieve()
+                if not success:
+                    return stopped(index)
+                yield index, frame
+
+
+def read_candidates(video_path, max_candidates, pool_size, scan=None):
+    # Only the pool_size sharpest candidates keep their full frame, which bounds memory
+    cap = cv2.VideoCapture(video_path)
+    try:
+        candidates = []
+        for index, frame in iter_candidate_frames(cap, max_candidates, scan):
+            # Every step-th pixel first: converting and area-resizing the full frame cost more than decoding it
+            step = max(1, max(frame.shape[:2]) // SCORE_WIDTH)
+            gray = cv2.cvtColor(frame[::step, ::step], cv2.COLOR_BGR2GRAY)
+            thumb = downscale(gray, THUMB_WIDTH)
+            candidates.append({
+                "index": index,
+                "sharpness": cv2.Laplacian(gray, cv2.CV_64F).var(),
+                "thumb": thumb.astype(np.int16),
+                "frame": frame,
+            })
+            if len(candidates) > pool_size:
+                candidates.remove(min(candidates, key=lambda c: c["sharpness"]))
+        return candidates
+    finally:
+        cap.release()
+
+
+def select_frames(candidates, max_frames, min_difference=VIDEO_MIN_DIFFERENCE):
+    # Sharpest first, skipping near-duplicates of frames already picked and frames far blurrier than the best
+    picked = []
+    floor = max((c["sharpness"] for c in candidates), default=0) * VIDEO_MIN_SHARPNESS_RATIO
+    for candidate in sorted(candidates, key=lambda c: c["sharpness"], reverse=True):
+        if candidate["sharpness"] < floor:
+            break
+        if all(np.abs(candidate["thumb"] - p["thumb"]).mean() >= min_difference for p in picked):
+            picked.append(candidate)
+            if len(picked) == max_frames:
+                break
+    return sorted(picked, key=lambda c: c["index"])
+
+
+def sample_frames(video_path, max_frames=VIDEO_MAX_FRAMES, max_dim=VIDEO_MAX_DIM,
+                  jpeg_quality=VIDEO_JPEG_QUALITY, tile=VIDEO_TILE_FRAMES,
+                  max_candidates=VIDEO_MAX_CANDIDATES, scan=None):
+    # Returns JPEG bytes for the best distinct frames (or one tiled image when tile=True);
+    # pass a dict as scan to learn whether the file decoded as far as its index says (see iter_candidate_frames)
+    candidates = read_candidates(video_path, max(max_candidates, max_frames), max_frames * VIDEO_POOL_FACTOR, scan)
+    if not candidates:
+        print(f"No frames could be decoded from {video_path}")
+        return []
+
+    # Resizing is the expensive step, so it only happens for the frames actually sent
+    frames = [downscale(c["frame"], max_dim) for c in select_frames(candidates, max_frames)]
+    if tile and len(frames) > 1:
+        return [encode_jpeg(downscale(tile_frames(frames), max_dim), jpeg_quality)]
+    return [encode_jpeg(frame, jpeg_quality) for frame in frames]
@@ -1,19 +1,62 @@
 import base64
+import html
 import json
+import mimetypes
 import os
-from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
-from google.cloud import storage
+import re
 import datetime
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
-from google.auth.transport.requests import Request
+from clients import get_gmail_service, get_storage, track_cold_start
+from tracing import bind, span, trace_context
 
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 BUCKET_NAME = "projectraseedrawdata"
 TOKEN_FILE = 'token.json'
 
+# Incremental sync state: last processed historyId and failed attempts per message, kept in GCS so
+# every instance shares it. Its own bucket, so saving it does not fire process_receipt on the upload bucket.
+STATE_BUCKET = os.environ.get("HISTORY_STATE_BUCKET", f"{BUCKET_NAME}-state")
+STATE_OBJECT = os.environ.get("HISTORY_STATE_OBJECT", "state/gmail_last_history_id")
+# A message that keeps failing holds the historyId back for the whole mailbox. Once it has failed this
+# many pushes and for at least MIN_AGE_S (so an outage does not skip healthy mail), it is recorded
+# under DEAD_LETTER_PREFIX in STATE_BUCKET and the historyId moves past it.
+MESSAGE_MAX_ATTEMPTS = int(os.environ.get("GMAIL_MESSAGE_MAX_ATTEMPTS", "5"))
+MESSAGE_MIN_AGE_S = float(os.environ.get("GMAIL_MESSAGE_MIN_AGE_S", "3600"))
+DEAD_LETTER_PREFIX = "dead-letter/gmail/"
+SEED_HISTORY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'last_history_id.txt')
+GMAIL_BATCH_SIZE = 50  # messages.get calls per batch HTTP request (Gmail allows up to 100)
+FULL_SYNC_MAX_RESULTS = 50  # messages scanned when the stored historyId is too old
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", "8"))  # concurrent attachment fetches + GCS uploads per instance
+# Attachment types process_receipt reads, by MIME type; anything else (invites, signatures) is skipped
+ATTACHMENT_TYPES = {
+    'application/pdf': '.pdf',
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/webp': '.webp',
+    'image/heic': '.heic',
+    'text/html': '.html',
+    'video/mp4': '.mp4',
+    'video/quicktime': '.mov',
+}
+ATTACHMENT_EXTENSIONS = set(ATTACHMENT_TYPES.values()) | {'.jpeg', '.avi', '.mkv'}
+
+# Shared by every push: its threads live as long as the instance, so each keeps the Gmail service
+# it built (see clients.get_gmail_service) instead of building a new one per push. Threads start on first use.
+_upload_pool = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="upload")
+
+
+@track_cold_start
 def gmail_push(request):
+    with trace_context(), span("gmail_push") as attrs:
+        body, status = handle_push(request)
+        attrs["http_status"] = status
+        return body, status
+
+
+def handle_push(request):
     try:
         envelope = request.get_json(force=True)
         if not envelope.get('message') or not envelope['message'].get('data'):
@@ -24,21 +67,53 @@ def gmail_push(request):
         message_data = json.loads(data)
 
         user_id = message_data.get('emailAddress')
-        print(f"Received Gmail Push for user {user_id}")
+        pushed_history_id = int(message_data.get('historyId', 0))
+        print(f"Received Gmail Push for user {user_id} (historyId {pushed_history_id})")
 
         service = authenticate()
+        storage_client = get_storage()
 
-        # ✅ Fetch latest email instead of using historyId
-        results = service.users().messages().list(userId='me', labelIds=['INBOX'], maxResults=1).execute()
-        messages = results.get('messages', [])
+        with span("gcs.load_history_id"):
+            start_history_id, attempts, generation = load_last_history_id(storage_client)
+        if start_history_id is not None and pushed_history_id and pushed_history_id <= start_history_id:
+            print(f"Already synced past historyId {pushed_history_id}, nothing to do.")
+            return ('OK', 200)
 
-        if messages:
-            msg_id = messages[0]['id']
-            msg_detail = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
-            upload_body_to_gcs(msg_detail)
-            print("Fetched and uploaded the most recent email.")
-        else:
-            print("No new messages found.")
+        with span("gmail.list_new_messages") as attrs:
+            message_ids, latest_history_id = list_new_message_ids(service, start_history_id)
+            attrs["messages"] = len(message_ids)
+        print(f"{len(message_ids)} new message(s) since historyId {start_history_id}")
+
+        with span("gmail.fetch_messages", messages=len(message_ids)):
+            messages, failed = fetch_messages(service, message_ids)
+        uploads = []
+        for msg_detail in messages:
+            try:
+                uploads.extend(plan_uploads(msg_detail))
+            except Exception as e:
+                print(f"Failed to read message {msg_detail.get('id')}: {e}")
+                failed[msg_detail.get('id')] = e
+        with span("gcs.upload_artifacts", files=len(uploads)):
+            uploaded, present, upload_failed = upload_all(uploads, storage_client)
+        failed.update(upload_failed)
+        print(f"Uploaded {uploaded} new object(s) from {len(messages)} email(s), {present} already present.")
+
+        # Only move the watermark once everything up to it is safely in the bucket or dead-lettered;
+        # on partial failure the next push replays the range and duplicates are skipped.
+        if failed:
+            count_attempts(attempts, failed)
+            retry = [msg_id for msg_id in failed if not given_up(attempts[msg_id])]
+            if retry:
+                print(f"⚠️ {len(failed)} message(s) failed, keeping historyId {start_history_id}: {list(failed)}")
+                with span("gcs.save_history_id"):
+                    save_last_history_id(storage_client, start_history_id, generation, attempts)
+                return ('Partial failure', 500)
+            with span("gcs.dead_letter", messages=len(failed)):
+                dead_letter(storage_client, failed, attempts)
+        for msg_id in message_ids:
+            attempts.pop(msg_id, None)
+        with span("gcs.save_history_id"):
+            save_last_history_id(storage_client, max(latest_history_id or 0, pushed_history_id), generation, attempts)
 
         return ('OK', 200)
 
@@ -48,52 +123,291 @@ def gmail_push(request):
         return ('Internal Server Error', 500)
 
 
-def authenticate():
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-        # If there are no (valid) credentials available, let the user log in.
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-                creds = flow.run_local_server(port=0)
+def load_credentials():
+    from google.oauth2.credentials import Credentials
+    creds = None
+    if os.path.exists(TOKEN_FILE):
+        creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+    # If there are no usable credentials available, let the user log in.
+    # Expired tokens are refreshed by the client registry, which caches the result for the process.
+    if not creds or not (creds.valid or creds.refresh_token):
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
+        creds = flow.run_local_server(port=0)
         # Save the credentials for the next run
-            with open('token.json', 'w') as token:
+        try:
+            with open(TOKEN_FILE, 'w') as token:
                 token.write(creds.to_json())
+        except OSError as e:
+            print(f"Could not persist token: {e}")
+    return creds
+
+
+def authenticate():
+    return get_gmail_service(load_credentials)
 
 
+def load_last_history_id(storage_client):
+    # Returns (history_id, attempts, generation); generation guards the write against concurrent pushes.
+    # attempts: {message id: {"attempts", "first_failed", "error"}} for messages that failed
+    from google.api_core.exceptions import NotFound
+    blob = storage_client.bucket(STATE_BUCKET).blob(STATE_OBJECT)
+    try:
+        value = blob.download_as_text().strip()
+        if not value.startswith('{'):
+            return int(value), {}, blob.generation  # a bare historyId, as written before attempts were kept
+        state = json.loads(value)
+        return state.get('history_id'), state.get('attempts') or {}, blob.generation
+    except NotFound:
+        pass
+    if os.path.exists(SEED_HISTORY_FILE):
+        with open(SEED_HISTORY_FILE) as f:
+            value = f.read().strip()
+        if value:
+            return int(value), {}, 0
+    return None, {}, 0
+
+
+def save_last_history_id(storage_client, history_id, generation, attempts=None):
+    from google.api_core.exceptions import PreconditionFailed
+    blob = storage_client.bucket(STATE_BUCKET).blob(STATE_OBJECT)
+    state = json.dumps({'history_id': history_id, 'attempts': attempts or {}})
+    try:
+        blob.upload_from_string(state, content_type='application/json', if_generation_match=generation)
+        print(f"Saved last historyId {history_id}")
+    except PreconditionFailed:
+        # Another push advanced the state first; it covered at least as much history as we did
+        print(f"historyId state changed concurrently, not overwriting with {history_id}")
+
+
+def count_attempts(attempts, failed):
+    # failed: {message id: error}
+    now = time.time()
+    for msg_id, error in failed.items():
+        entry = attempts.setdefault(msg_id, {'attempts': 0, 'first_failed': now})
+        entry['attempts'] += 1
+        entry['error'] = str(error)[:500]
+
+
+def given_up(entry):
+    return entry['attempts'] >= MESSAGE_MAX_ATTEMPTS and time.time() - entry['first_failed'] >= MESSAGE_MIN_AGE_S
+
+
+def dead_letter(storage_client, msg_ids, attempts):
+    # One record per message, enough to find it in the mailbox and replay it
+    bucket = storage_client.bucket(STATE_BUCKET)
+    for msg_id in msg_ids:
+        record = {'message_id': msg_id, **attempts[msg_id],
+                  'dead_lettered': datetime.datetime.utcnow().isoformat()}
+        bucket.blob(f"{DEAD_LETTER_PREFIX}{msg_id}.json").upload_from_string(
+            json.dumps(record), content_type='application/json')
+        print(f"❌ Giving up on message {msg_id} after {record['attempts']} attempts: {record['error']}")
+
+
+def list_new_message_ids(service, start_history_id):
+    # Returns (message ids in arrival order, latest historyId seen)
+    from googleapiclient.errors import HttpError
+    if start_history_id is None:
+        return list_recent_message_ids(service)
+
+    message_ids = []
+    seen = set()
+    latest_history_id = start_history_id
+    page_token = None
+    try:
+        while True:
+            response = service.users().history().list(
+                userId='me', startHistoryId=start_history_id, historyTypes=['messageAdded'],
+                labelId='INBOX', pageToken=page_token).execute()
+            for record in response.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    msg_id = added['message']['id']
+                    if msg_id not in seen:
+                        seen.add(msg_id)
+                        message_ids.append(msg_id)
+            latest_history_id = max(latest_history_id, int(response.get('historyId', 0)))
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return message_ids, latest_history_id
+    except HttpError as e:
+        if e.resp.status != 404:
+            raise
+        # historyId older than Gmail keeps (about a week): rescan recent mail instead
+        print(f"historyId {start_history_id} expired, falling back to a full sync")
+        return list_recent_message_ids(service)
 
-def upload_body_to_gcs(msg_detail):
+
+def list_recent_message_ids(service):
+    # historyId is read before the list: mail arriving in between is listed and replayed by the
+    # next push (uploads are create-only), where reading it after the list would skip that mail
+    profile = service.users().getProfile(userId='me').execute()
+    results = service.users().messages().list(
+        userId='me', labelIds=['INBOX'], maxResults=FULL_SYNC_MAX_RESULTS).execute()
+    message_ids = [m['id'] for m in reversed(results.get('messages', []))]
+    return message_ids, int(profile['historyId'])
+
+
+def fetch_messages(service, message_ids):
+    # Many messages.get per HTTP round trip; returns (messages, {failed message id: error})
+    from googleapiclient.errors import HttpError
+    messages = {}
+    failed = {}
+
+    def on_response(request_id, response, exception):
+        if exception is not None:
+            # Deleted between the history event and now: nothing to upload
+            if isinstance(exception, HttpError) and exception.resp.status == 404:
+                return
+            print(f"Failed to fetch message {request_id}: {exception}")
+            failed[request_id] = exception
+        else:
+            messages[request_id] = response
+
+    for start in range(0, len(message_ids), GMAIL_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=on_response)
+        for msg_id in message_ids[start:start + GMAIL_BATCH_SIZE]:
+            batch.add(service.users().messages().get(userId='me', id=msg_id, format='full'), request_id=msg_id)
+        batch.execute()
+
+    return [messages[m] for m in message_ids if m in messages], failed
+
+
+def walk_parts(payload):
+    # Depth-first in document order with an explicit stack: linear in the number of parts,
+    # however deeply the multiparts are nested
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        yield part
+        stack.extend(reversed(part.get('parts') or []))
+
+
+def part_header(part, name):
+    return next((h['value'] for h in part.get('headers') or [] if h['name'].lower() == name), '')
+
+
+def decode_text(data, part):
+    charset = re.search(r'charset="?([\w.:-]+)', part_header(part, 'content-type'), re.IGNORECASE)
+    try:
+        return data.decode(charset.group(1) if charset else 'utf-8', errors='replace')
+    except LookupError:
+        return data.decode('utf-8', errors='replace')
+
+
+def body_html(data, part):
+    # process_receipt reads .html objects; plain-text mail keeps its line breaks as <br>
+    text = decode_text(data, part)
+    if (part.get('mimeType') or '').lower() == 'text/plain':
+        text = html.escape(text).replace('\n', '<br>\n')
+    return text.encode('utf-8')
+
+
+def attachment_extension(part):
+    # The pipeline picks its parser by extension: the filename's when it is one it reads, else the MIME type's
+    ext = os.path.splitext(part.get('filename') or '')[1].lower()
+    if ext in ATTACHMENT_EXTENSIONS:
+        return ext
+    return ATTACHMENT_TYPES.get((part.get('mimeType') or '').lower())
+
+
+def plan_uploads(msg_detail):
+    # One upload per receipt artifact in the message: the best body part (HTML over plain text),
+    # then every attachment the pipeline can read, each as its own object
     msg_id = msg_detail.get('id')
-    subject = next((h['value'] for h in msg_detail['payload']['headers'] if h['name'] == 'Subject'), 'no-subject')
-    timestamp = datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+    payload = msg_detail.get('payload', {})
+    sender = part_header(payload, 'from')
+    # Received time keeps object names stable across redeliveries
+    received = datetime.datetime.utcfromtimestamp(int(msg_detail.get('internalDate', 0)) / 1000)
+    prefix = f"email-{received.strftime('%Y%m%d-%H%M%S')}-{msg_id}"
+    # Delivered with the GCS event, so process_receipt picks up the trace (and the sender, which
+    # selects a merchant template) without another read
+    metadata = {'trace_id': msg_id, 'sender': sender}
 
-    def extract_parts(part):
-        body = ""
-        if part.get('body', {}).get('data'):
-            try:
-                body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-            except Exception as e:
-                body = f"[Decoding Error: {e}]"
-        if 'parts' in part:
-            for subpart in part['parts']:
-                body += extract_parts(subpart)
-        return body
+    bodies = {}
+    attachments = []
+    for part in walk_parts(payload):
+        mime_type = (part.get('mimeType') or '').lower()
+        body = part.get('body') or {}
+        if part.get('filename') and (body.get('attachmentId') or body.get('data')):
+            attachments.append(part)
+        elif mime_type in ('text/html', 'text/plain') and mime_type not in bodies and (body.get('data') or body.get('attachmentId')):
+            bodies[mime_type] = part
+
+    uploads = []
+    body_part = bodies.get('text/html') or bodies.get('text/plain')
+    body_text = ''
+    if body_part:
+        if body_part['body'].get('data'):
+            body_text = base64.urlsafe_b64decode(body_part['body']['data']).decode('utf-8', errors='replace')
+        uploads.append({'msg_id': msg_id, 'name': f"{prefix}.html", 'part': body_part, 'kind': 'body',
+                        'content_type': 'text/html', 'metadata': metadata})
+    for part in attachments:
+        ext = attachment_extension(part)
+        content_id = part_header(part, 'content-id').strip('<>')
+        if content_id and f"cid:{content_id}" in body_text:
+            continue  # a logo or banner drawn inside the HTML body, not a receipt
+        if ext is None:
+            print(f"Skipping attachment {part.get('filename')} ({part.get('mimeType')}) of {msg_id}: not a receipt type")
+            continue
+        stem = re.sub(r'[^\w.-]+', '_', os.path.splitext(part['filename'])[0])[:80]
+        content_type = part.get('mimeType')
+        if not content_type or content_type == 'application/octet-stream':
+            content_type = mimetypes.guess_type(f"x{ext}")[0] or 'application/octet-stream'
+        uploads.append({'msg_id': msg_id, 'name': f"{prefix}-{part.get('partId', '')}-{stem}{ext}", 'part': part,
+                        'kind': 'attachment', 'content_type': content_type, 'metadata': metadata})
+    if not uploads:
+        print(f"No readable body or receipt attachment in {msg_id}")
+    return uploads
+
+
+def part_bytes(upload):
+    body = upload['part'].get('body') or {}
+    if body.get('data'):
+        return base64.urlsafe_b64decode(body['data'])
+    # Large parts only carry an attachmentId; this runs on a pool thread, which has its own service
+    with span("gmail.get_attachment", file=upload['name']):
+        response = authenticate().users().messages().attachments().get(
+            userId='me', messageId=upload['msg_id'], id=body['attachmentId']).execute()
+    return base64.urlsafe_b64decode(response['data'])
+
+
+def upload_artifact(upload, storage_client=None):
+    # Returns True if uploaded, False if it was already in the bucket
+    from google.api_core.exceptions import PreconditionFailed
+    with trace_context(upload['msg_id']):
+        data = part_bytes(upload)
+        if upload['kind'] == 'body':
+            data = body_html(data, upload['part'])
+        storage_client = storage_client or get_storage()
+        blob = storage_client.bucket(BUCKET_NAME).blob(upload['name'])
+        blob.metadata = upload['metadata']
+        try:
+            # Create-only write: an artifact we already uploaded is skipped, not re-uploaded
+            with span("gcs.upload", file=upload['name'], bytes=len(data), kind=upload['kind']):
+                blob.upload_from_string(data, content_type=upload['content_type'], if_generation_match=0)
+        except PreconditionFailed:
+            print(f"{upload['name']} already uploaded, skipping")
+            return False
+        print(f"Uploaded {upload['kind']} to {upload['name']} in bucket {BUCKET_NAME}")
+        return True
 
-    email_body = extract_parts(msg_detail.get('payload', {}))
 
-    if not email_body:
-        print("No readable body found")
-        return
+def upload_all(uploads, storage_client):
+    # Every artifact of every message in the push goes up concurrently.
+    # Returns (uploaded, already present, {id of a message with a failed artifact: error}).
+    if not uploads:
+        return 0, 0, {}
 
-    file_name = f"email-{timestamp}-{msg_id}.html"
+    def run(upload):
+        try:
+            return upload_artifact(upload, storage_client)
+        except Exception as e:
+            print(f"Failed to upload {upload['name']}: {e}")
+            return e
 
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(file_name)
-    blob.upload_from_string(email_body, content_type='text/html')
-    print(f"Uploaded email body to {file_name} in bucket {BUCKET_NAME}")
+    results = list(_upload_pool.map(bind(run), uploads))
+    failed = {u['msg_id']: r for u, r in zip(uploads, results) if isinstance(r, Exception)}
+    return sum(1 for r in results if r is True), sum(1 for r in results if r is False), failed
 
 
 # def upload_body_to_gcs(msg_detail):
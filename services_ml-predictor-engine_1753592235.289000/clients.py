@@ -0,0 +1,64 @@
+import functools
+import threading
+import time
+
+# Process-wide client registry: each client is built once per instance and reused by warm invocations
+_clients = {}
+_locks = {}
+_registry_lock = threading.Lock()
+_init_seconds = {}
+_process_started = time.monotonic()
+_first_request = True
+
+
+def get_client(name, factory):
+    client = _clients.get(name)
+    if client is not None:
+        return client
+    with _registry_lock:
+        lock = _locks.setdefault(name, threading.Lock())
+    # Per-name lock: a slow client build does not block lookups of the others
+    with lock:
+        client = _clients.get(name)
+        if client is None:
+            started = time.perf_counter()
+            client = factory()
+            _init_seconds[name] = time.perf_counter() - started
+            print(f"Initialized {name} client in {_init_seconds[name] * 1000:.1f} ms")
+            _clients[name] = client
+    return client
+
+
+def cold_start_report():
+    return {
+        "process_age_seconds": round(time.monotonic() - _process_started, 3),
+        "client_init_ms": {name: round(s * 1000, 1) for name, s in _init_seconds.items()},
+    }
+
+
+def track_cold_start(fn):
+    # Wraps an entry point; logs request time and client build times once, for the instance's first request
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        global _first_request
+        cold, _first_request = _first_request, False
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if cold:
+                report = cold_start_report()
+                report["first_request_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                print("Cold start:", report)
+    return wrapper
+
+
+# SDK imports live inside the factories: each module is loaded on first use, not at cold start
+
+def _bigquery_client():
+    from google.cloud import bigquery
+    return bigquery.Client()
+
+
+def get_bigquery():
+    return get_client("bigquery", _bigquery_client)
@@ -1,102 +1,266 @@
-from google.cloud import bigquery
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import random
+import time
 import functions_framework
+from clients import get_bigquery, track_cold_start
+from tracing import bind, span, trace_context
 
-bq_client = bigquery.Client()
 PROJECT_ID = "agenticai-467004"
 DATASET = "receipts"
 ENRICHED_TABLE = f"{PROJECT_ID}.{DATASET}.enriched_receipts"
 PREDICTION_TABLE = f"{PROJECT_ID}.{DATASET}.prediction_results"
 
-def write_predictions_to_bigquery(records):
-    errors = bq_client.insert_rows_json(PREDICTION_TABLE, records)
-    if errors:
-        print("❌ Insert errors:", errors)
-    else:
-        print(f"✅ Inserted {len(records)} predictions.")
+WATERMARK_TABLE = f"{PROJECT_ID}.{DATASET}.prediction_watermarks"
+# Re-read this much before the stored watermark so rows streamed in late are not skipped;
+# per-user jobs replace their rows, so the overlap is harmless.
+WATERMARK_LAG_MINUTES = 10
+# Every server-side job mutates prediction_results; BigQuery aborts a transaction that conflicts with
+# another mutation of the same table ("concurrent update"). The scripts are idempotent, so they are rerun.
+CONCURRENT_UPDATE_RETRIES = 3
 
-def predict_refund():
-    query = f"""
-    SELECT receipt_id, total, category, is_subscription, predicted_refund_eligible
+# Each prediction job is a SELECT producing prediction_results rows (minus created_at).
+# {scope} restricts which enriched rows are scored: everything, or only what is new.
+# Boolean predictions go through INITCAP so they read "True"/"False", as str() produced before.
+REFUND_SELECT = f"""
+    SELECT receipt_id, CAST(NULL AS STRING) AS user_id, 'refund' AS model_type,
+           INITCAP(CAST(predicted_refund_eligible AS STRING)) AS prediction_result
     FROM ML.PREDICT(MODEL `{PROJECT_ID}.{DATASET}.ml_refund_predictor`,
       (SELECT receipt_id, total, category, is_subscription
-       FROM `{ENRICHED_TABLE}`
-       WHERE refund_eligible IS NULL))
+       FROM `{ENRICHED_TABLE}` e
+       WHERE refund_eligible IS NULL AND {{scope}}))
     """
-    results = bq_client.query(query).result()
-    records = [{
-        "receipt_id": row["receipt_id"],
-        "model_type": "refund",
-        "prediction_result": str(row["predicted_refund_eligible"]),
-        "created_at": datetime.utcnow().isoformat()
-    } for row in results]
-    write_predictions_to_bigquery(records)
-
-def predict_subscription():
-    query = f"""
-    SELECT receipt_id, merchant, total, predicted_is_subscription
+
+SUBSCRIPTION_SELECT = f"""
+    SELECT receipt_id, CAST(NULL AS STRING) AS user_id, 'subscription' AS model_type,
+           INITCAP(CAST(predicted_is_subscription AS STRING)) AS prediction_result
     FROM ML.PREDICT(MODEL `{PROJECT_ID}.{DATASET}.ml_subscription_predictor`,
       (SELECT receipt_id, merchant, total
-       FROM `{ENRICHED_TABLE}`
-       WHERE is_subscription IS NULL))
+       FROM `{ENRICHED_TABLE}` e
+       WHERE is_subscription IS NULL AND {{scope}}))
     """
-    results = bq_client.query(query).result()
-    records = [{
-        "receipt_id": row["receipt_id"],
-        "model_type": "subscription",
-        "prediction_result": str(row["predicted_is_subscription"]),
-        "created_at": datetime.utcnow().isoformat()
-    } for row in results]
-    write_predictions_to_bigquery(records)
-
-def predict_next_purchase():
-    query = f"""
-    SELECT user_id, category,
-           MAX(DATE(date)) AS last_purchase_date,
-           DATE_ADD(MAX(DATE(date)), INTERVAL 30 DAY) AS predicted_next_purchase_date
-    FROM `{ENRICHED_TABLE}`
-    WHERE date IS NOT NULL
+
+NEXT_PURCHASE_SELECT = f"""
+    SELECT CAST(NULL AS STRING) AS receipt_id, user_id, 'next_purchase' AS model_type,
+           CAST(DATE_ADD(MAX(DATE(date)), INTERVAL 30 DAY) AS STRING) AS prediction_result
+    FROM `{ENRICHED_TABLE}` e
+    WHERE date IS NOT NULL AND {{scope}}
     GROUP BY user_id, category
     """
-    results = bq_client.query(query).result()
-    records = [{
-        "receipt_id": None,
-        "user_id": row["user_id"],
-        "model_type": "next_purchase",
-        "prediction_result": str(row["predicted_next_purchase_date"]),
-        "created_at": datetime.utcnow().isoformat()
-    } for row in results]
-    write_predictions_to_bigquery(records)
-
-def cluster_user_spend():
-    query = f"""
-    SELECT user_id, total_spent, spend_cluster
+
+SPEND_CLUSTER_SELECT = f"""
+    SELECT CAST(NULL AS STRING) AS receipt_id, user_id, 'spend_cluster' AS model_type,
+           CAST(spend_cluster AS STRING) AS prediction_result
     FROM ML.PREDICT(MODEL `{PROJECT_ID}.{DATASET}.ml_spend_cluster`,
       (SELECT user_id, SUM(total) AS total_spent
-       FROM `{ENRICHED_TABLE}`
+       FROM `{ENRICHED_TABLE}` e
+       WHERE {{scope}}
        GROUP BY user_id))
     """
-    results = bq_client.query(query).result()
-    records = [{
-        "receipt_id": None,
-        "user_id": row["user_id"],
-        "model_type": "spend_cluster",
-        "prediction_result": str(row["spend_cluster"]),
-        "created_at": datetime.utcnow().isoformat()
-    } for row in results]
-    write_predictions_to_bigquery(records)
+
+# receipt: one prediction per receipt_id, upserted with MERGE
+# user: aggregates over a user's history, replaced for every user with new receipts
+PREDICTION_SCOPES = {
+    "refund": "receipt",
+    "subscription": "receipt",
+    "next_purchase": "user",
+    "spend_cluster": "user",
+}
+
+def receipt_merge_sql(model_type, select_template, incremental):
+    # Incremental: anti-join so only receipts without a prediction of this type are scored
+    scope = "receipt_id IS NOT NULL"
+    if incremental:
+        scope += f"""
+         AND NOT EXISTS (SELECT 1 FROM `{PREDICTION_TABLE}` p
+                         WHERE p.model_type = '{model_type}' AND p.receipt_id = e.receipt_id)"""
+    return f"""
+    MERGE `{PREDICTION_TABLE}` T
+    USING (
+      SELECT * FROM ({select_template.format(scope=scope)})
+      WHERE TRUE
+      QUALIFY ROW_NUMBER() OVER (PARTITION BY receipt_id) = 1
+    ) S
+    ON T.model_type = S.model_type AND T.receipt_id = S.receipt_id
+    WHEN MATCHED AND T.prediction_result IS DISTINCT FROM S.prediction_result THEN
+      UPDATE SET prediction_result = S.prediction_result, created_at = CURRENT_TIMESTAMP()
+    WHEN NOT MATCHED THEN
+      INSERT (receipt_id, user_id, model_type, prediction_result, created_at)
+      VALUES (S.receipt_id, S.user_id, S.model_type, S.prediction_result, CURRENT_TIMESTAMP())
+    """
+
+def user_replace_sql(model_type, select_template, incremental):
+    # Incremental: only users with receipts enriched since the last run are recomputed
+    changed = "TRUE"
+    if incremental:
+        changed = f"watermark IS NULL OR enriched_timestamp > TIMESTAMP_SUB(watermark, INTERVAL {WATERMARK_LAG_MINUTES} MINUTE)"
+    scope = "COALESCE(user_id, '') IN (SELECT user_key FROM affected_users)"
+    # DECLAREs must open the script, and the watermark table may not exist yet: declare, create, then SET
+    return f"""
+    DECLARE watermark TIMESTAMP;
+    DECLARE new_watermark TIMESTAMP;
+
+    CREATE TABLE IF NOT EXISTS `{WATERMARK_TABLE}` (model_type STRING, watermark TIMESTAMP);
+    SET watermark = (SELECT MAX(watermark) FROM `{WATERMARK_TABLE}` WHERE model_type = '{model_type}');
+    SET new_watermark = (SELECT MAX(enriched_timestamp) FROM `{ENRICHED_TABLE}`);
+
+    CREATE TEMP TABLE affected_users AS
+    SELECT DISTINCT COALESCE(user_id, '') AS user_key
+    FROM `{ENRICHED_TABLE}`
+    WHERE {changed};
+
+    BEGIN TRANSACTION;
+    DELETE FROM `{PREDICTION_TABLE}`
+    WHERE model_type = '{model_type}' AND COALESCE(user_id, '') IN (SELECT user_key FROM affected_users);
+
+    INSERT INTO `{PREDICTION_TABLE}` (receipt_id, user_id, model_type, prediction_result, created_at)
+    SELECT receipt_id, user_id, model_type, prediction_result, CURRENT_TIMESTAMP()
+    FROM ({select_template.format(scope=scope)});
+
+    MERGE `{WATERMARK_TABLE}` T
+    USING (SELECT '{model_type}' AS model_type, new_watermark AS watermark) S
+    ON T.model_type = S.model_type
+    WHEN MATCHED THEN UPDATE SET watermark = S.watermark
+    WHEN NOT MATCHED THEN INSERT (model_type, watermark) VALUES (S.model_type, S.watermark);
+    COMMIT TRANSACTION;
+    """
+
+def rows_written(bq_client, job):
+    # A multi-statement script reports DML counts on its child jobs; its only INSERT writes predictions
+    if job.num_dml_affected_rows is not None:
+        return job.num_dml_affected_rows
+    return sum(child.num_dml_affected_rows or 0
+               for child in bq_client.list_jobs(parent_job=job.job_id)
+               if child.statement_type == "INSERT")
+
+def query_with_retry(bq_client, sql, model_type):
+    for attempt in range(CONCURRENT_UPDATE_RETRIES + 1):
+        job = bq_client.query(sql)
+        try:
+            job.result()
+            return job
+        except Exception as e:
+            if "concurrent update" not in str(e).lower() or attempt == CONCURRENT_UPDATE_RETRIES:
+                raise
+            delay = random.uniform(0.5, 1.0) * 2 ** attempt
+            print(f"⚠️ {model_type}: prediction_results updated concurrently, retry {attempt + 1} in {delay:.1f}s")
+            time.sleep(delay)
+
+def write_predictions_to_bigquery(records):
+    with span("bigquery.insert_predictions", table=PREDICTION_TABLE, rows=len(records)):
+        errors = get_bigquery().insert_rows_json(PREDICTION_TABLE, records)
+    if errors:
+        print("❌ Insert errors:", errors)
+    else:
+        print(f"✅ Inserted {len(records)} predictions.")
+
+def run_prediction(model_type, select_template, server_side=True, incremental=True):
+    # Returns {"rows": prediction rows written, "bytes_billed": ...}
+    bq_client = get_bigquery()
+    if server_side:
+        # Rows go straight from ML.PREDICT into prediction_results without passing through the function;
+        # both write paths are idempotent, so re-running never duplicates predictions
+        if PREDICTION_SCOPES[model_type] == "receipt":
+            sql = receipt_merge_sql(model_type, select_template, incremental)
+        else:
+            sql = user_replace_sql(model_type, select_template, incremental)
+        with span("bigquery.predict", model_type=model_type, incremental=incremental) as attrs:
+            job = query_with_retry(bq_client, sql, model_type)
+            rows = rows_written(bq_client, job)
+            attrs.update(job_id=job.job_id, rows=rows, bytes_billed=job.total_bytes_billed)
+        print(f"✅ {model_type}: wrote {rows} predictions (job {job.job_id}, {job.total_bytes_billed} bytes billed).")
+        return {"rows": rows, "bytes_billed": job.total_bytes_billed}
+
+    # Client path: full recompute pulled into the function and streamed back
+    created_at = datetime.utcnow().isoformat()
+    with span("bigquery.predict", model_type=model_type, mode="client") as attrs:
+        records = [{
+            "receipt_id": row["receipt_id"],
+            "user_id": row["user_id"],
+            "model_type": row["model_type"],
+            "prediction_result": row["prediction_result"],
+            "created_at": created_at
+        } for row in bq_client.query(select_template.format(scope="TRUE")).result()]
+        attrs["rows"] = len(records)
+    if records:
+        write_predictions_to_bigquery(records)
+    return {"rows": len(records)}
+
+def predict_refund(server_side=True, incremental=True):
+    return run_prediction("refund", REFUND_SELECT, server_side, incremental)
+
+def predict_subscription(server_side=True, incremental=True):
+    return run_prediction("subscription", SUBSCRIPTION_SELECT, server_side, incremental)
+
+def predict_next_purchase(server_side=True, incremental=True):
+    return run_prediction("next_purchase", NEXT_PURCHASE_SELECT, server_side, incremental)
+
+def cluster_user_spend(server_side=True, incremental=True):
+    return run_prediction("spend_cluster", SPEND_CLUSTER_SELECT, server_side, incremental)
+
+PREDICTION_JOBS = {
+    "refund": predict_refund,
+    "subscription": predict_subscription,
+    "next_purchase": predict_next_purchase,
+    "spend_cluster": cluster_user_spend,
+}
+
+def job_groups(server_side):
+    # Groups run concurrently, the jobs inside a group one after another. The per-user scripts are
+    # transactions on prediction_results and prediction_watermarks, so they share a group; the
+    # per-receipt MERGEs are single statements and keep their own.
+    if not server_side:
+        return [[name] for name in PREDICTION_JOBS]
+    user_jobs = [name for name in PREDICTION_JOBS if PREDICTION_SCOPES[name] == "user"]
+    return [[name] for name in PREDICTION_JOBS if name not in user_jobs] + [user_jobs]
+
+def run_jobs(server_side=True, incremental=True):
+    # Each job reports its own timing, row count or error
+    def timed(name):
+        started = time.perf_counter()
+        try:
+            stats = PREDICTION_JOBS[name](server_side, incremental)
+            return {"status": "ok", **stats, "seconds": round(time.perf_counter() - started, 3)}
+        except Exception as e:
+            print(f"❌ {name} failed: {e}")
+            return {"status": "error", "error": str(e), "seconds": round(time.perf_counter() - started, 3)}
+
+    def run_group(names):
+        return {name: timed(name) for name in names}
+
+    groups = job_groups(server_side)
+    with ThreadPoolExecutor(max_workers=len(groups)) as pool:
+        results = {}
+        for group_results in pool.map(bind(run_group), groups):
+            results.update(group_results)
+    return {name: results[name] for name in PREDICTION_JOBS}
 
 # ---------- HTTP Entry Point ----------
 @functions_framework.http
+@track_cold_start
 def run_all_predictions(request):
     if request.method != "GET":
         return ("Method Not Allowed", 405)
 
-    try:
-        predict_refund()
-        predict_subscription()
-        predict_next_purchase()
-        cluster_user_spend()
-        return ("✅ ML predictions executed and saved to BigQuery.", 200)
-    except Exception as e:
-        return (f"❌ Error: {str(e)}", 500)
+    # ?mode=client keeps the old path that pulls rows into the function and streams them back
+    mode = request.args.get("mode", "server")
+    if mode not in ("server", "client"):
+        return (f"❌ Unknown mode: {mode}", 400)
+    # ?incremental=false rescores everything (still idempotent); the default only scores new data
+    incremental = request.args.get("incremental", "true").lower() != "false"
+
+    started = time.perf_counter()
+    with trace_context(), span("run_all_predictions", mode=mode, incremental=incremental):
+        jobs = run_jobs(server_side=(mode == "server"), incremental=incremental)
+    failed = [name for name, result in jobs.items() if result["status"] != "ok"]
+    body = {
+        "mode": mode,
+        "incremental": incremental and mode == "server",
+        "seconds": round(time.perf_counter() - started, 3),
+        "jobs": jobs,
+    }
+    if failed:
+        body["message"] = f"❌ Failed jobs: {', '.join(failed)}"
+        return (body, 500)
+    body["message"] = "✅ ML predictions executed and saved to BigQuery."
+    return (body, 200)
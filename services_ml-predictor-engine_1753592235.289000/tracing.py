@@ -0,0 +1,124 @@
+import contextlib
+import contextvars
+import functools
+import hashlib
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+
+PROJECT_ID = "agenticai-467004"
+SERVICE_NAME = os.environ.get("K_SERVICE", "ml-predictor-engine")
+# log: one structured JSON line per span; otel: also export spans through OpenTelemetry
+# (needs opentelemetry-sdk, plus opentelemetry-exporter-gcp-trace for Cloud Trace); none: spans off
+TRACE_EXPORTER = os.environ.get("TRACE_EXPORTER", "log")
+TRACE_MIN_SPAN_MS = float(os.environ.get("TRACE_MIN_SPAN_MS", "0"))  # spans faster than this are not logged
+
+# The receipt's trace id (the Gmail message id when it came by mail) and the innermost open span.
+# contextvars keep concurrent requests apart; use bind() to carry them into worker threads.
+_trace_id = contextvars.ContextVar("trace_id", default=None)
+_span_id = contextvars.ContextVar("span_id", default=None)
+_tracer = None
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+
+def cloud_trace_id(trace_id):
+    # Cloud Trace wants 32 hex chars; hashing keeps every service's logs for one receipt under one trace
+    return hashlib.sha256(trace_id.encode("utf-8")).hexdigest()[:32]
+
+
+def log(message, severity="INFO", **fields):
+    # stdout JSON lines become structured entries in Cloud Logging (severity, trace and span are lifted out)
+    entry = {"severity": severity, "message": message, "service": SERVICE_NAME,
+             "time": datetime.now(timezone.utc).isoformat()}
+    trace_id = _trace_id.get()
+    if trace_id:
+        entry["trace_id"] = trace_id
+        entry["logging.googleapis.com/trace"] = f"projects/{PROJECT_ID}/traces/{cloud_trace_id(trace_id)}"
+        if _span_id.get():
+            entry["logging.googleapis.com/spanId"] = _span_id.get()
+    entry.update(fields)
+    # One write per entry, so lines from concurrent threads never interleave
+    sys.stdout.write(json.dumps(entry, default=str) + "\n")
+    sys.stdout.flush()
+
+
+@contextlib.contextmanager
+def trace_context(trace_id=None):
+    # Everything logged inside belongs to trace_id (a fresh one when not given)
+    token = _trace_id.set(trace_id or new_trace_id())
+    try:
+        yield _trace_id.get()
+    finally:
+        _trace_id.reset(token)
+
+
+def _otel_tracer():
+    global _tracer
+    if _tracer is None:
+        try:
+            from opentelemetry import trace
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+            provider = TracerProvider()
+            try:
+                from opentelemetry.exporter.cloud_trace import CloudTraceSpanExporter
+                provider.add_span_processor(BatchSpanProcessor(CloudTraceSpanExporter(project_id=PROJECT_ID)))
+            except ImportError:
+                print("opentelemetry-exporter-gcp-trace not installed, spans go to the default provider only")
+            trace.set_tracer_provider(provider)
+            _tracer = trace.get_tracer(SERVICE_NAME)
+        except ImportError:
+            print("opentelemetry-sdk not installed, falling back to log-only spans")
+            _tracer = False
+    return _tracer
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    # Times the block and logs it as one entry; the yielded dict takes extra attributes (row counts etc.)
+    if TRACE_EXPORTER == "none":
+        yield attributes
+        return
+    span_id = uuid.uuid4().hex[:16]
+    parent = _span_id.get()
+    token = _span_id.set(span_id)
+    tracer = _otel_tracer() if TRACE_EXPORTER == "otel" else None
+    otel_span = contextlib.nullcontext()
+    if tracer:
+        otel_span = tracer.start_as_current_span(name)
+    started = time.perf_counter()
+    status, error = "ok", None
+    with otel_span as current:
+        try:
+            yield attributes
+        except BaseException as e:
+            status, error = "error", f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            duration_ms = round((time.perf_counter() - started) * 1000, 2)
+            if current is not None:
+                current.set_attribute("trace_id", _trace_id.get() or "")
+                for key, value in attributes.items():
+                    if isinstance(value, (str, bool, int, float)):
+                        current.set_attribute(key, value)
+            if status == "error" or duration_ms >= TRACE_MIN_SPAN_MS:
+                log(f"{name} {status} in {duration_ms} ms", severity="ERROR" if error else "INFO",
+                    span=name, span_id=span_id, parent_span_id=parent, duration_ms=duration_ms,
+                    status=status, error=error, **attributes)
+            _span_id.reset(token)
+
+
+def bind(fn):
+    # Thread pools don't inherit contextvars: bind() carries the caller's trace and span into fn
+    context = contextvars.copy_context()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+    return wrapper